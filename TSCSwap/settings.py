@@ -56,6 +56,13 @@ else:
     MPESA_STK_PUSH_URL = MPESA_SANDBOX_STK_PUSH_URL
     MPESA_QUERY_URL = MPESA_SANDBOX_QUERY_URL
 
+# Point every M-Pesa API call at another host, e.g. a local Daraja stand-in
+MPESA_API_BASE_URL = os.getenv('MPESA_API_BASE_URL')
+if MPESA_API_BASE_URL:
+    MPESA_AUTH_URL = f"{MPESA_API_BASE_URL.rstrip('/')}/oauth/v1/generate?grant_type=client_credentials"
+    MPESA_STK_PUSH_URL = f"{MPESA_API_BASE_URL.rstrip('/')}/mpesa/stkpush/v1/processrequest"
+    MPESA_QUERY_URL = f"{MPESA_API_BASE_URL.rstrip('/')}/mpesa/stkpushquery/v1/query"
+
 # M-Pesa Credentials from .env
 MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY')
 MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
@@ -76,6 +83,44 @@ for name, value in required_mpesa_settings:
     if not value or value.startswith('YOUR_'):
         raise ImproperlyConfigured(f"Setting {name} is not properly configured in .env file")
 
+# OAuth token reuse (see payments.mpesa_utils.get_access_token): refresh this
+# many seconds before expiry, and how long a worker waits for another
+# worker's token fetch before fetching its own.
+MPESA_TOKEN_REFRESH_AHEAD_SECONDS = 300
+MPESA_TOKEN_WAIT_SECONDS = 10
+
+# STK pushes run in a background thread after the request commits
+# (payments.mpesa_utils.start_stk_push); the payment page long-polls for the
+# result. Each wait holds a sync worker, so it lasts at most
+# MPESA_STATUS_WAIT_SECONDS and the page pauses before asking again. A wait
+# that saw no change re-reads the database unless the cache is shared
+# (REDIS_URL), where every worker's status updates are visible.
+MPESA_STK_IN_BACKGROUND = True
+MPESA_STATUS_WAIT_SECONDS = 2
+MPESA_STATUS_TRUST_CACHE = bool(os.getenv('REDIS_URL'))
+
+# A callback whose CheckoutRequestID is unknown is matched to a pending
+# transaction from at most this many hours ago (payments.callback_matching);
+# the payment page stops waiting for older ones.
+MPESA_CALLBACK_MATCH_HOURS = 24
+
+# Shared cache for state that must be the same in every worker (M-Pesa token).
+# Without REDIS_URL Django's per-process local-memory cache is used; the
+# Redis backend needs the ``redis`` package.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+
+# Subscription entitlements (payments.entitlements) are cached across requests
+# only when the cache is shared: a per-process cache could not be cleared by
+# the worker or cron job that changes a subscription. Without it each request
+# reads the subscription once.
+ENTITLEMENT_CACHE_SECONDS = 24 * 60 * 60 if os.getenv('REDIS_URL') else 0
+
 # Authentication
 LOGIN_URL = '/users/login/'
 LOGIN_REDIRECT_URL = 'home:home'  # Updated to use the correct URL name with namespace
@@ -146,6 +191,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'payments.context_processors.entitlement',
             ],
         },
     },
@@ -248,6 +294,26 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER)
 SERVER_EMAIL = DEFAULT_FROM_EMAIL
 
+# Registration, profile and welcome emails go through the users.mail_queue
+# outbox, sent by the send_queued_emails worker in batches over one SMTP
+# connection. Admin notifications are mailed as one digest at most every
+# ADMIN_DIGEST_MINUTES.
+MAIL_QUEUE_BATCH_SIZE = 50
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+MAIL_QUEUE_KEEP_DAYS = 7
+ADMIN_DIGEST_MINUTES = 60
+
+# ErrorLog rows are written in bulk (home.error_log): repeats of an error are
+# counted on one row, and the buffer is flushed every ERROR_LOG_FLUSH_SECONDS
+# or once ERROR_LOG_FLUSH_SIZE errors are waiting. A failed flush is kept and
+# retried; at most ERROR_LOG_MAX_BUFFERED distinct errors are held meanwhile.
+# ERROR_LOG_SAMPLE_RATES keeps only a share of an error type, e.g.
+# {'not_found': 0.1}.
+ERROR_LOG_FLUSH_SECONDS = 5
+ERROR_LOG_FLUSH_SIZE = 100
+ERROR_LOG_MAX_BUFFERED = 1000
+ERROR_LOG_SAMPLE_RATES = {}
+
 # Google Forms Integration
 GOOGLE_FORM_WEBHOOK_TOKEN = os.getenv('GOOGLE_FORM_WEBHOOK_TOKEN', '')
 SITE_URL = os.getenv('SITE_URL', 'http://localhost:8000')
@@ -4,7 +4,8 @@ from django.urls import reverse
 from django.utils import timezone
 from .models import (
     MySubject, Subject, Level, Curriculum, Counties, Constituencies, 
-    Wards, Swaps, SwapRequests, Schools, SwapPreference, ErrorLog
+    Wards, Swaps, SwapRequests, Schools, SwapPreference, ErrorLog, CountyStats,
+    TriangleSnapshot, MatchPair
 )
 
 
@@ -13,7 +14,7 @@ class ErrorLogAdmin(admin.ModelAdmin):
     """Admin interface for ErrorLog model."""
     list_display = [
         'id', 'error_type', 'user_display', 'status_code', 'request_path_short', 
-        'created_at', 'resolved', 'ip_address'
+        'occurrences', 'created_at', 'last_seen_at', 'resolved', 'ip_address'
     ]
     list_filter = [
         'error_type', 'status_code', 'resolved', 'created_at', 'request_method'
@@ -25,24 +26,25 @@ class ErrorLogAdmin(admin.ModelAdmin):
     readonly_fields = [
         'user', 'error_type', 'error_message', 'page_url', 'request_path', 
         'request_method', 'status_code', 'exception_type', 'traceback', 
-        'user_agent', 'ip_address', 'created_at', 'resolved_at'
+        'user_agent', 'ip_address', 'created_at', 'resolved_at',
+        'fingerprint', 'occurrences', 'last_seen_at'
     ]
     fieldsets = (
         ('Error Information', {
-            'fields': ('error_type', 'status_code', 'error_message', 'exception_type')
+            'fields': ('error_type', 'status_code', 'error_message', 'exception_type', 'occurrences')
         }),
         ('Request Details', {
             'fields': ('user', 'request_path', 'page_url', 'request_method', 'user_agent', 'ip_address')
         }),
         ('Technical Details', {
-            'fields': ('traceback',),
+            'fields': ('traceback', 'fingerprint'),
             'classes': ('collapse',)
         }),
         ('Resolution', {
             'fields': ('resolved', 'resolved_at', 'notes')
         }),
         ('Timestamps', {
-            'fields': ('created_at',)
+            'fields': ('created_at', 'last_seen_at')
         }),
     )
     date_hierarchy = 'created_at'
@@ -83,6 +85,42 @@ class ErrorLogAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(CountyStats)
+class CountyStatsAdmin(admin.ModelAdmin):
+    list_display = ('county', 'level', 'teachers', 'inbound', 'outbound', 'updated_at')
+    list_filter = ('level',)
+    ordering = ('county__name',)
+    readonly_fields = ('county', 'level', 'teachers', 'inbound', 'outbound', 'updated_at')
+
+    def has_add_permission(self, request):
+        """Rows are maintained by signals and the rebuild_county_stats command."""
+        return False
+
+
+@admin.register(TriangleSnapshot)
+class TriangleSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('level', 'triangle_count', 'teacher_count', 'duration_ms', 'computed_at', 'requested_at')
+    readonly_fields = ('level', 'triangle_count', 'teacher_count', 'duration_ms', 'computed_at', 'requested_at')
+
+    def has_add_permission(self, request):
+        """Snapshots are written by the refresh_triangle_swaps command."""
+        return False
+
+
+@admin.register(MatchPair)
+class MatchPairAdmin(admin.ModelAdmin):
+    list_display = ('user', 'partner', 'level')
+    list_filter = ('level',)
+    search_fields = ('user__email', 'partner__email')
+    # Also serves the user search of the MyUser "Potential Swap Matches" filter
+    autocomplete_fields = ('user', 'partner')
+    list_select_related = ('user', 'partner', 'level')
+
+    def has_add_permission(self, request):
+        """Pairs are maintained by signals and the rebuild_match_pairs command."""
+        return False
+
+
 admin.site.register(MySubject)
 admin.site.register(Subject)
 admin.site.register(Level)
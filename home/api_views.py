@@ -1,40 +1,150 @@
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_cache_control
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from .models import Constituencies, Wards
+from .demand_matrix import get_demand_matrix
+from .gazetteer import get_gazetteer
+from .models import subject_key_for
+
+
+def geography_response(request, gazetteer, key, data):
+    """
+    Serve geography JSON from the gazetteer with a strong ETag and a long
+    Cache-Control lifetime. The ETag changes whenever the gazetteer version
+    (database checksum) changes.
+    """
+    etag = f'"geo-{gazetteer.version}-{key}"'
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(data, safe=False)
+    response['ETag'] = etag
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=getattr(settings, 'GEOGRAPHY_CACHE_MAX_AGE', 60 * 60 * 24),
+    )
+    return response
+
+
+def places_as_dicts(places):
+    return [{'id': place.id, 'name': place.name} for place in places]
+
 
 class ConstituencyAPIView(View):
     @method_decorator(csrf_exempt)
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
-        
+
     def get(self, request):
-        county_id = request.GET.get('county')
+        county_id = request.GET.get('county') or request.GET.get('county_id')
         if not county_id:
             return JsonResponse([], safe=False)
-            
-        try:
-            constituencies = Constituencies.objects.filter(county_id=county_id).values('id', 'name').order_by('name')
-            return JsonResponse(list(constituencies), safe=False)
-        except Exception as e:
-            print(f"Error in ConstituencyAPIView: {str(e)}")
-            return JsonResponse([], safe=False)
+
+        gazetteer = get_gazetteer()
+        constituencies = places_as_dicts(gazetteer.constituencies_for(county_id))
+        return geography_response(request, gazetteer, f'county-{county_id}', constituencies)
 
 class WardAPIView(View):
     @method_decorator(csrf_exempt)
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
-        
+
     def get(self, request):
-        constituency_id = request.GET.get('constituency')
+        constituency_id = request.GET.get('constituency') or request.GET.get('constituency_id')
         if not constituency_id:
             return JsonResponse([], safe=False)
-            
+
+        gazetteer = get_gazetteer()
+        wards = places_as_dicts(gazetteer.wards_for(constituency_id))
+        return geography_response(request, gazetteer, f'constituency-{constituency_id}', wards)
+
+
+def id_list(value):
+    """Parse a comma separated id list ('3,7,12'); raises ValueError."""
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+class DemandAPIView(View):
+    """
+    Base for the staff-only demand matrix endpoints. Every request needs a
+    'level' id and may narrow the matrix to one subject signature with
+    'subjects' (comma separated subject ids).
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated or not request.user.is_staff:
+            return JsonResponse({'error': 'Staff access required'}, status=403)
         try:
-            wards = Wards.objects.filter(constituency_id=constituency_id).values('id', 'name').order_by('name')
-            return JsonResponse(list(wards), safe=False)
-        except Exception as e:
-            print(f"Error in WardAPIView: {str(e)}")
-            return JsonResponse([], safe=False)
-        return JsonResponse(list(wards), safe=False)
+            self.level_id = int(request.GET.get('level', ''))
+            subjects = request.GET.get('subjects', '')
+            self.subject_key = subject_key_for(id_list(subjects)) if subjects else None
+        except ValueError:
+            return JsonResponse({'error': 'Invalid level or subjects'}, status=400)
+        self.matrix = get_demand_matrix()
+        return super().dispatch(request, *args, **kwargs)
+
+
+class DemandMatrixAPIView(DemandAPIView):
+    """
+    Demand matrix slice: rows are origin counties, columns destination
+    counties. Optional 'origins' / 'destinations' id lists narrow the slice.
+    """
+
+    def get(self, request):
+        try:
+            origin_ids = id_list(request.GET.get('origins', ''))
+            destination_ids = id_list(request.GET.get('destinations', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid county ids'}, status=400)
+
+        origins, destinations, rows = self.matrix.slice(
+            self.level_id, self.subject_key, origin_ids, destination_ids
+        )
+        gazetteer = get_gazetteer()
+        return JsonResponse({
+            'level': self.level_id,
+            'subjects': self.subject_key,
+            'origins': places_as_dicts(gazetteer.county(county_id) for county_id in origins),
+            'destinations': places_as_dicts(gazetteer.county(county_id) for county_id in destinations),
+            'matrix': rows,
+        })
+
+
+class DemandCorridorsAPIView(DemandAPIView):
+    """
+    Top corridors. 'order=demand' (default) ranks directed corridors by
+    teachers wanting the move; 'order=mutual' ranks county pairs by
+    mutual-pair potential. 'limit' defaults to 20 (max 500).
+    """
+
+    def get(self, request):
+        order = request.GET.get('order', 'demand')
+        if order not in ('demand', 'mutual'):
+            return JsonResponse({'error': 'Invalid order'}, status=400)
+        try:
+            limit = min(int(request.GET.get('limit', 20)), 500)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+        gazetteer = get_gazetteer()
+        corridors = [
+            {
+                'from': {'id': from_id, 'name': gazetteer.county(from_id).name},
+                'to': {'id': to_id, 'name': gazetteer.county(to_id).name},
+                'teachers': teachers,
+                'reverse': reverse,
+                'mutual_potential': mutual,
+            }
+            for from_id, to_id, teachers, reverse, mutual in self.matrix.corridors(
+                self.level_id, self.subject_key, limit, order
+            )
+        ]
+        return JsonResponse({
+            'level': self.level_id,
+            'subjects': self.subject_key,
+            'order': order,
+            'corridors': corridors,
+        })
@@ -0,0 +1,108 @@
+"""
+Maintenance of the CountyStats rollup.
+
+For every (county, level) pair the rollup stores:
+
+- ``teachers``: teachers whose current school is in the county
+- ``inbound``: teachers of that level who want to move to the county, either
+  as their desired county or through ``open_to_all``
+- ``outbound``: teachers in the county with at least one destination preference
+
+``compute_county_stats`` runs the three GROUP BY aggregates, optionally
+restricted to some counties and a level. Signals call
+``refresh_county_stats`` with just the pairs a change can touch, and the
+``rebuild_county_stats`` command recomputes everything.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from .models import CountyStats, SwapPreference
+
+
+def compute_county_stats(county_ids=None, level_ids=None):
+    """Return ``{(county_id, level_id): [teachers, inbound, outbound]}``."""
+    from users.models import PersonalProfile
+
+    rows = {}
+
+    def add(key, position, count):
+        if key[0] is None or key[1] is None:
+            return
+        rows.setdefault(key, [0, 0, 0])[position] += count
+
+    profiles = PersonalProfile.objects.filter(user__role='Teacher')
+    preferences = SwapPreference.objects.filter(user__role='Teacher')
+    open_to_all = SwapPreference.open_to_all.through.objects.filter(swappreference__user__role='Teacher')
+    if county_ids is not None:
+        profiles = profiles.filter(current_county_id__in=county_ids)
+        preferences = preferences.filter(desired_county_id__in=county_ids)
+        open_to_all = open_to_all.filter(counties_id__in=county_ids)
+    if level_ids is not None:
+        profiles = profiles.filter(level_id__in=level_ids)
+        preferences = preferences.filter(user__profile__level_id__in=level_ids)
+        open_to_all = open_to_all.filter(swappreference__user__profile__level_id__in=level_ids)
+
+    for row in profiles.values('current_county_id', 'level_id').annotate(n=Count('id')).order_by():
+        add((row['current_county_id'], row['level_id']), 0, row['n'])
+
+    # Inbound: desired county, plus open_to_all entries that don't repeat it
+    for row in preferences.values('desired_county_id', 'user__profile__level_id').annotate(n=Count('id')).order_by():
+        add((row['desired_county_id'], row['user__profile__level_id']), 1, row['n'])
+    open_to_all = open_to_all.exclude(
+        swappreference__desired_county_id=F('counties')
+    )
+    for row in open_to_all.values('counties_id', 'swappreference__user__profile__level_id').annotate(n=Count('id')).order_by():
+        add((row['counties_id'], row['swappreference__user__profile__level_id']), 1, row['n'])
+
+    leaving = profiles.filter(
+        Q(user__swappreference__desired_county__isnull=False)
+        | Q(user__swappreference__open_to_all__isnull=False)
+    )
+    for row in leaving.values('current_county_id', 'level_id').annotate(n=Count('id', distinct=True)).order_by():
+        add((row['current_county_id'], row['level_id']), 2, row['n'])
+
+    return rows
+
+
+def refresh_county_stats(county_ids, level_ids):
+    """Recompute the rollup rows for every combination of the given counties and levels."""
+    county_ids = {county_id for county_id in county_ids if county_id}
+    level_ids = {level_id for level_id in level_ids if level_id}
+    if not county_ids or not level_ids:
+        return
+
+    rows = compute_county_stats(county_ids, level_ids)
+    with transaction.atomic():
+        for county_id in county_ids:
+            for level_id in level_ids:
+                teachers, inbound, outbound = rows.get((county_id, level_id), (0, 0, 0))
+                CountyStats.objects.update_or_create(
+                    county_id=county_id,
+                    level_id=level_id,
+                    defaults={'teachers': teachers, 'inbound': inbound, 'outbound': outbound},
+                )
+
+
+def rebuild_county_stats():
+    """Replace the whole rollup. Returns the number of rows written."""
+    rows = compute_county_stats()
+    with transaction.atomic():
+        CountyStats.objects.all().delete()
+        CountyStats.objects.bulk_create([
+            CountyStats(county_id=county_id, level_id=level_id, teachers=teachers, inbound=inbound, outbound=outbound)
+            for (county_id, level_id), (teachers, inbound, outbound) in rows.items()
+        ], batch_size=1000)
+    return len(rows)
+
+
+def user_county_ids(user_id):
+    """Current county plus every destination county of a user."""
+    from users.models import PersonalProfile
+
+    county_ids = set(PersonalProfile.objects.filter(user_id=user_id).values_list('current_county_id', flat=True))
+    for desired_county_id, open_county_id in SwapPreference.objects.filter(user_id=user_id).values_list(
+        'desired_county_id', 'open_to_all'
+    ):
+        county_ids.update((desired_county_id, open_county_id))
+    county_ids.discard(None)
+    return county_ids
@@ -0,0 +1,251 @@
+"""
+County-to-county demand matrix.
+
+For a teacher level (optionally narrowed to one subject signature),
+``matrix[i, j]`` is the number of teachers currently in county ``i`` who want
+county ``j``, as their desired county or through ``open_to_all``. Each
+teacher counts once per destination, and a teacher's own county is never a
+destination.
+
+The matrix is held in-process as NumPy arrays, following the gazetteer:
+
+- every teacher's contribution ``(level, subject_key, origin, destinations)``
+  is loaded once, and the per-level / per-signature arrays are built from it
+  on first use
+- signals call ``update_teacher_demand`` so a change moves only that
+  teacher's cells in this process
+- other processes pick changes up by revalidating against a checksum of the
+  CountyStats rollup at most every ``DEMAND_MATRIX_RECHECK_SECONDS``. A
+  change that only touches a teacher's subjects is not part of that checksum
+  and reaches other processes on their next reload.
+
+Besides slices, the matrix answers the corridor questions the matching
+engines care about: the busiest corridors, the mutual-pair potential of a
+corridor (``min(M[i, j], M[j, i])``, an upper bound on direct swaps between
+the two counties) and which counties lie on a three-county cycle, which is
+where triangle swaps can exist.
+"""
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .gazetteer import get_gazetteer
+from .models import CountyStats, SwapPreference
+
+
+class DemandMatrix:
+    def __init__(self, county_ids, contributions, version):
+        self.county_ids = tuple(county_ids)
+        self.index = {county_id: position for position, county_id in enumerate(self.county_ids)}
+        self.version = version
+        # user_id -> (level_id, subject_key, origin index, destination indexes)
+        self._contributions = contributions
+        # (level_id, subject_key or None) -> int32 array, built on first use
+        self._matrices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.county_ids)
+
+    @staticmethod
+    def _matches(key, contribution):
+        level_id, subject_key = key
+        return contribution[0] == level_id and subject_key in (None, contribution[1])
+
+    def _build(self, key):
+        size = len(self.county_ids)
+        rows, cols = [], []
+        for contribution in self._contributions.values():
+            if self._matches(key, contribution):
+                rows.extend([contribution[2]] * len(contribution[3]))
+                cols.extend(contribution[3])
+        matrix = np.zeros((size, size), dtype=np.int32)
+        np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1)
+        return matrix
+
+    def matrix(self, level_id, subject_key=None):
+        """Return a copy of the demand matrix for a level (and subject signature)."""
+        key = (level_id, subject_key or None)
+        with self._lock:
+            if key not in self._matrices:
+                self._matrices[key] = self._build(key)
+            return self._matrices[key].copy()
+
+    def contribution_for(self, level_id, subject_key, origin_id, destination_ids):
+        """Translate ids into a contribution tuple, or None if it adds nothing."""
+        origin = self.index.get(origin_id)
+        if level_id is None or origin is None:
+            return None
+        destinations = tuple(sorted({
+            self.index[county_id] for county_id in destination_ids
+            if county_id in self.index and self.index[county_id] != origin
+        }))
+        if not destinations:
+            return None
+        return (level_id, subject_key or '', origin, destinations)
+
+    def apply(self, user_id, contribution):
+        """Replace one teacher's contribution and adjust every built matrix in place."""
+        with self._lock:
+            old = self._contributions.pop(user_id, None)
+            if contribution is not None:
+                self._contributions[user_id] = contribution
+            for key, matrix in self._matrices.items():
+                if old is not None and self._matches(key, old):
+                    matrix[old[2], list(old[3])] -= 1
+                if contribution is not None and self._matches(key, contribution):
+                    matrix[contribution[2], list(contribution[3])] += 1
+
+    def slice(self, level_id, subject_key=None, origin_ids=None, destination_ids=None):
+        """Return ``(origin_ids, destination_ids, rows)`` for a sub-matrix."""
+        origin_ids = [cid for cid in (origin_ids or self.county_ids) if cid in self.index]
+        destination_ids = [cid for cid in (destination_ids or self.county_ids) if cid in self.index]
+        matrix = self.matrix(level_id, subject_key)
+        rows = matrix[np.ix_([self.index[cid] for cid in origin_ids], [self.index[cid] for cid in destination_ids])]
+        return origin_ids, destination_ids, rows.tolist()
+
+    def corridors(self, level_id, subject_key=None, limit=20, order='demand'):
+        """
+        Busiest corridors as ``[(from_id, to_id, teachers, reverse, mutual_potential)]``.
+
+        ``order='demand'`` ranks directed corridors by teachers wanting to make
+        the move; ``order='mutual'`` ranks county pairs (each pair once) by
+        mutual-pair potential.
+        """
+        matrix = self.matrix(level_id, subject_key)
+        mutual = np.minimum(matrix, matrix.T)
+        scores = np.triu(mutual, 1) if order == 'mutual' else matrix
+
+        flat = scores.ravel()
+        nonzero = int(np.count_nonzero(flat))
+        limit = min(limit, nonzero)
+        if limit <= 0:
+            return []
+        top = np.argpartition(-flat, limit - 1)[:limit]
+        top = top[np.lexsort((top, -flat[top]))]
+
+        size = len(self.county_ids)
+        result = []
+        for position in top.tolist():
+            i, j = divmod(position, size)
+            result.append((
+                self.county_ids[i], self.county_ids[j],
+                int(matrix[i, j]), int(matrix[j, i]), int(mutual[i, j]),
+            ))
+        return result
+
+    def cycle_counties(self, level_id, subject_key=None):
+        """
+        County ids that lie on at least one three-county demand cycle. Only
+        teachers in these counties can be part of a triangle swap.
+        """
+        edges = (self.matrix(level_id, subject_key) > 0).astype(np.int64)
+        on_cycle = np.diagonal(edges @ edges @ edges) > 0
+        return {self.county_ids[i] for i in np.flatnonzero(on_cycle)}
+
+
+def compute_version():
+    """Checksum of the counties and the CountyStats rollup the signals maintain."""
+    stats = CountyStats.objects.aggregate(rows=Count('id'), updated=Max('updated_at'))
+    updated = stats['updated'].timestamp() if stats['updated'] else 0
+    return f"{get_gazetteer().version}-{stats['rows']}-{updated}"
+
+
+def destination_ids(user_ids=None):
+    """``{user_id: {county_id, ...}}`` from desired_county and open_to_all."""
+    preferences = SwapPreference.objects.filter(desired_county__isnull=False)
+    open_to_all = SwapPreference.open_to_all.through.objects.all()
+    if user_ids is not None:
+        preferences = preferences.filter(user_id__in=user_ids)
+        open_to_all = open_to_all.filter(swappreference__user_id__in=user_ids)
+
+    destinations = {}
+    for user_id, county_id in preferences.values_list('user_id', 'desired_county_id'):
+        destinations.setdefault(user_id, set()).add(county_id)
+    for user_id, county_id in open_to_all.values_list('swappreference__user_id', 'counties_id'):
+        destinations.setdefault(user_id, set()).add(county_id)
+    return destinations
+
+
+def teacher_demand(user_ids=None):
+    """
+    ``{user_id: (level_id, subject_key, current_county_id, destination_ids)}``
+    for teachers with a level and a current county.
+    """
+    from users.models import PersonalProfile
+
+    profiles = PersonalProfile.objects.filter(
+        user__role='Teacher', level__isnull=False, current_county__isnull=False
+    )
+    if user_ids is not None:
+        profiles = profiles.filter(user_id__in=user_ids)
+    destinations = destination_ids(user_ids)
+
+    return {
+        user_id: (level_id, subject_key, county_id, destinations.get(user_id, set()))
+        for user_id, level_id, subject_key, county_id in profiles.values_list(
+            'user_id', 'level_id', 'subject_key', 'current_county_id'
+        )
+    }
+
+
+def load_demand_matrix():
+    version = compute_version()
+    county_ids = [county.id for county in get_gazetteer().counties()]
+    matrix = DemandMatrix(county_ids, {}, version)
+    for user_id, (level_id, subject_key, origin_id, destination_ids) in teacher_demand().items():
+        contribution = matrix.contribution_for(level_id, subject_key, origin_id, destination_ids)
+        if contribution is not None:
+            matrix._contributions[user_id] = contribution
+    return matrix
+
+
+_lock = threading.Lock()
+_state = {'matrix': None, 'checked_at': 0.0}
+
+
+def get_demand_matrix():
+    """Return the process-wide demand matrix, reloading it when the data has changed."""
+    recheck_after = getattr(settings, 'DEMAND_MATRIX_RECHECK_SECONDS', 60)
+    matrix = _state['matrix']
+    if matrix is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+        return matrix
+
+    with _lock:
+        matrix = _state['matrix']
+        if matrix is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+            return matrix
+        if matrix is None or compute_version() != matrix.version:
+            matrix = load_demand_matrix()
+            _state['matrix'] = matrix
+        _state['checked_at'] = time.monotonic()
+        return matrix
+
+
+def update_teacher_demand(user_ids):
+    """
+    Move the given teachers' cells in the loaded matrix. Does nothing when no
+    matrix is loaded in this process.
+    """
+    matrix = _state['matrix']
+    if matrix is None:
+        return
+    user_ids = set(user_ids)
+    demand = teacher_demand(user_ids)
+    for user_id in user_ids:
+        if user_id in demand:
+            level_id, subject_key, origin_id, destination_ids = demand[user_id]
+            contribution = matrix.contribution_for(level_id, subject_key, origin_id, destination_ids)
+        else:
+            contribution = None
+        matrix.apply(user_id, contribution)
+
+
+def reset_demand_matrix():
+    """Drop the loaded matrix (e.g. after counties change, or in tests)."""
+    with _lock:
+        _state['matrix'] = None
+        _state['checked_at'] = 0.0
@@ -0,0 +1,214 @@
+"""
+Buffered, deduplicated ErrorLog writes.
+
+``record_error`` runs on the request path, so it only touches memory:
+
+- the error is fingerprinted by error type, exception type, the innermost
+  project frame it passed through (file and function) and the request path
+- repeats of a fingerprint bump the buffered entry's ``occurrences`` and
+  ``last_seen_at``; the message and traceback are formatted once
+- ``ERROR_LOG_SAMPLE_RATES`` (``{error_type: rate}``) keeps only that share
+  of an error type, each kept one counting for ``1 / rate``; errors are
+  always recorded at most once per request (the middleware and the error
+  page both report them)
+
+``flush_errors`` writes the buffer: one UPDATE per fingerprint that already
+has an unresolved ErrorLog row, one bulk_create for the rest (a resolved
+error that comes back gets a new row). It runs once ``ERROR_LOG_FLUSH_SIZE``
+errors are buffered, from a timer ``ERROR_LOG_FLUSH_SECONDS`` after the
+first buffered error, and at exit. ``ERROR_LOG_FLUSH_SECONDS = 0`` writes
+every error straight away. When a flush fails (the database is down) its
+entries go back in the buffer, merged with anything buffered since, and the
+timer retries; the buffer holds at most ``ERROR_LOG_MAX_BUFFERED``
+fingerprints, further new ones are dropped until it has been written.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import random
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = {}  # fingerprint -> unsaved ErrorLog
+_pending_count = 0
+_timer = None
+
+
+def client_ip(request):
+    forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def error_location(exception):
+    """
+    ``file:function`` of the innermost project frame the exception passed
+    through (the innermost frame when none is in the project).
+    """
+    tb = getattr(exception, '__traceback__', None)
+    if tb is None:
+        return ''
+    frames = traceback.extract_tb(tb)
+    base_dir = str(settings.BASE_DIR)
+    project = [
+        frame for frame in frames
+        if frame.filename.startswith(base_dir) and 'site-packages' not in frame.filename
+    ]
+    frame = (project or frames)[-1]
+    return f'{os.path.relpath(frame.filename, base_dir)}:{frame.name}'
+
+
+def fingerprint(error_type, exception, path):
+    parts = [error_type, type(exception).__name__ if exception else '', error_location(exception), path or '']
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _sample_weight(error_type):
+    """How many errors this one stands for, or 0 to drop it."""
+    rate = settings.ERROR_LOG_SAMPLE_RATES.get(error_type, 1.0)
+    if rate >= 1:
+        return 1
+    if rate <= 0 or random.random() >= rate:
+        return 0
+    return max(1, round(1 / rate))
+
+
+def record_error(request, error_type, status_code, exception=None, message=''):
+    """Buffer an ErrorLog entry for the request's error (once per request)."""
+    if getattr(request, '_error_logged', False):
+        return
+    request._error_logged = True
+    weight = _sample_weight(error_type)
+    if not weight:
+        return
+
+    global _pending_count
+    try:
+        key = fingerprint(error_type, exception, getattr(request, 'path', None))
+        now = timezone.now()
+        with _lock:
+            entry = _pending.get(key)
+            if entry is not None:
+                entry.occurrences += weight
+                entry.last_seen_at = now
+            elif len(_pending) < settings.ERROR_LOG_MAX_BUFFERED:
+                _pending[key] = _new_entry(request, key, error_type, status_code, exception, message, weight, now)
+            else:
+                return
+            _pending_count += weight
+            flush_now = settings.ERROR_LOG_FLUSH_SECONDS <= 0 or _pending_count >= settings.ERROR_LOG_FLUSH_SIZE
+            if not flush_now:
+                _schedule_flush()
+    except Exception as e:
+        # Never let error logging break the error page
+        logger.error(f"Failed to record error log: {str(e)}")
+        return
+    if flush_now:
+        flush_errors()
+
+
+def _new_entry(request, key, error_type, status_code, exception, message, weight, now):
+    from home.models import ErrorLog
+
+    user = getattr(request, 'user', None)
+    exception_traceback = None
+    if exception is not None:
+        exception_traceback = ''.join(
+            traceback.format_exception(type(exception), exception, exception.__traceback__)
+        )[-5000:]
+    return ErrorLog(
+        fingerprint=key,
+        occurrences=weight,
+        last_seen_at=now,
+        user_id=user.pk if user is not None and user.is_authenticated else None,
+        error_type=error_type,
+        error_message=(str(exception) if exception else message)[:1000],
+        page_url=request.build_absolute_uri()[:500] if hasattr(request, 'build_absolute_uri') else None,
+        request_path=request.path[:500] if hasattr(request, 'path') else None,
+        request_method=getattr(request, 'method', None),
+        status_code=status_code,
+        exception_type=type(exception).__name__ if exception else None,
+        traceback=exception_traceback,
+        user_agent=request.META.get('HTTP_USER_AGENT', '')[:500] if hasattr(request, 'META') else '',
+        ip_address=client_ip(request) if hasattr(request, 'META') else None,
+    )
+
+
+def _schedule_flush():
+    # Called with _lock held
+    global _timer
+    if _timer is None:
+        # At least a second, so a failing flush is not retried in a busy loop
+        _timer = threading.Timer(max(settings.ERROR_LOG_FLUSH_SECONDS, 1), _flush_in_background)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush_in_background():
+    try:
+        flush_errors()
+    finally:
+        close_old_connections()
+
+
+def flush_errors():
+    """Write the buffered errors; returns how many rows were touched."""
+    from home.models import ErrorLog
+
+    global _pending, _pending_count, _timer
+    with _lock:
+        pending, _pending, _pending_count = _pending, {}, 0
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+    if not pending:
+        return 0
+
+    try:
+        with transaction.atomic():
+            open_ids = dict(
+                ErrorLog.objects.filter(fingerprint__in=pending, resolved=False)
+                .order_by('created_at')
+                .values_list('fingerprint', 'id')
+            )
+            for key, row_id in open_ids.items():
+                entry = pending[key]
+                ErrorLog.objects.filter(id=row_id).update(
+                    occurrences=F('occurrences') + entry.occurrences, last_seen_at=entry.last_seen_at
+                )
+            ErrorLog.objects.bulk_create([entry for key, entry in pending.items() if key not in open_ids])
+    except Exception as e:
+        # Never let error logging break anything
+        logger.error(f"Failed to save {len(pending)} error log(s): {str(e)}")
+        _requeue(pending)
+        return 0
+    return len(pending)
+
+
+def _requeue(pending):
+    """Put the entries of a failed flush back in the buffer and retry later."""
+    with _lock:
+        for key, entry in pending.items():
+            newer = _pending.get(key)
+            if newer is not None:
+                entry.occurrences += newer.occurrences
+                entry.last_seen_at = max(entry.last_seen_at, newer.last_seen_at)
+            elif len(_pending) >= settings.ERROR_LOG_MAX_BUFFERED:
+                continue
+            _pending[key] = entry
+        # Not added to _pending_count: the retry is left to the timer, rather
+        # than to the next request reaching ERROR_LOG_FLUSH_SIZE
+        _schedule_flush()
+
+
+atexit.register(flush_errors)
@@ -0,0 +1,232 @@
+"""
+Streaming exports of teachers, swaps, fast swaps, mutual pairs and triangles.
+
+Each dataset is a header plus a generator of rows built from ``values_list``
+querysets read with ``.iterator(chunk_size=EXPORT_CHUNK_SIZE)`` (server-side
+cursors where the database supports them), so memory stays constant
+whatever the table size:
+
+- place names come from the in-process gazetteer and subject names from the
+  subject key, instead of joins or per-row lookups
+- many-to-many columns (``open_to_all``, ``acceptable_county``) are read as a
+  second id-ordered stream and merged with the main rows as both advance
+
+``stream_export`` renders a dataset as CSV or JSON Lines, a few hundred rows
+per chunk; the staff export view wraps it in a StreamingHttpResponse and the
+``export_data`` command writes it to a file.
+"""
+import csv
+import json
+from itertools import groupby
+from operator import itemgetter
+
+from django.db.models import F
+
+from .gazetteer import get_gazetteer
+from .models import FastSwap, MatchPair, Subject, SwapPreference, Swaps, TriangleSwap
+
+EXPORT_CHUNK_SIZE = 2000
+# Rows rendered per chunk handed to the response / file
+WRITE_BATCH = 500
+
+FORMATS = ('csv', 'jsonl')
+
+
+def _merge(rows, related):
+    """
+    Yield ``(row, [related values])`` for id-ordered ``rows`` and id-ordered
+    ``(id, value)`` pairs, walking both streams side by side.
+    """
+    groups = groupby(related, key=itemgetter(0))
+    current = next(groups, None)
+    for row in rows:
+        while current is not None and current[0] < row[0]:
+            current = next(groups, None)
+        if current is not None and current[0] == row[0]:
+            yield row, [value for _, value in current[1]]
+            current = next(groups, None)
+        else:
+            yield row, []
+
+
+class _Names:
+    """Id -> name lookups for places and subject keys."""
+
+    def __init__(self):
+        self.gazetteer = get_gazetteer()
+        self.subjects = dict(Subject.objects.values_list('id', 'name'))
+
+    def county(self, county_id):
+        place = self.gazetteer.county(county_id) if county_id else None
+        return place.name if place else ''
+
+    def constituency(self, constituency_id):
+        place = self.gazetteer.constituency(constituency_id) if constituency_id else None
+        return place.name if place else ''
+
+    def ward(self, ward_id):
+        place = self.gazetteer.ward(ward_id) if ward_id else None
+        return place.name if place else ''
+
+    def counties(self, county_ids):
+        return '; '.join(sorted(self.county(county_id) for county_id in county_ids))
+
+    def subject_key(self, key):
+        return '; '.join(self.subjects.get(int(subject_id), subject_id) for subject_id in key.split(',') if subject_id)
+
+
+def export_teachers():
+    from users.models import MyUser
+
+    names = _Names()
+    header = [
+        'user_id', 'email', 'first_name', 'last_name', 'phone', 'level', 'school',
+        'county', 'constituency', 'ward', 'desired_county', 'open_to_all', 'subjects',
+        'is_active', 'date_joined',
+    ]
+    users = MyUser.objects.filter(role='Teacher').order_by('id').values_list(
+        'id', 'email', 'profile__first_name', 'profile__last_name', 'profile__phone',
+        'profile__level__name', 'profile__school__name', 'profile__current_county_id',
+        'profile__current_constituency_id', 'profile__current_ward_id',
+        'swappreference__desired_county_id', 'profile__subject_key', 'is_active', 'date_joined',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    open_to_all = SwapPreference.open_to_all.through.objects.filter(
+        swappreference__user__role='Teacher'
+    ).order_by('swappreference__user_id').values_list(
+        'swappreference__user_id', 'counties_id'
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    def rows():
+        for row, open_county_ids in _merge(users, open_to_all):
+            (user_id, email, first_name, last_name, phone, level, school, county_id,
+             constituency_id, ward_id, desired_county_id, subject_key, is_active, date_joined) = row
+            yield [
+                user_id, email, first_name or '', last_name or '', phone or '', level or '', school or '',
+                names.county(county_id), names.constituency(constituency_id), names.ward(ward_id),
+                names.county(desired_county_id), names.counties(open_county_ids),
+                names.subject_key(subject_key or ''), is_active, date_joined.isoformat(),
+            ]
+    return header, rows()
+
+
+def export_swaps():
+    names = _Names()
+    header = [
+        'swap_id', 'email', 'county', 'constituency', 'ward', 'gender', 'boarding',
+        'status', 'archived', 'closed', 'created_at',
+    ]
+    swaps = Swaps.objects.order_by('id').values_list(
+        'id', 'user__email', 'county_id', 'constituency_id', 'ward_id', 'gender', 'boarding',
+        'status', 'archived', 'closed', 'created_at',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    def rows():
+        for (swap_id, email, county_id, constituency_id, ward_id, gender, boarding,
+             status, archived, closed, created_at) in swaps:
+            yield [
+                swap_id, email, names.county(county_id), names.constituency(constituency_id),
+                names.ward(ward_id), gender, boarding, status, archived, closed, created_at.isoformat(),
+            ]
+    return header, rows()
+
+
+def export_fast_swaps():
+    names = _Names()
+    header = [
+        'fast_swap_id', 'names', 'phone', 'level', 'school', 'county', 'constituency', 'ward',
+        'most_preferred', 'acceptable_counties', 'subjects', 'created_at',
+    ]
+    fast_swaps = FastSwap.objects.order_by('id').values_list(
+        'id', 'names', 'phone', 'level__name', 'school__name', 'current_county_id',
+        'current_constituency_id', 'current_ward_id', 'most_preferred_id', 'subject_key', 'created_at',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    acceptable = FastSwap.acceptable_county.through.objects.order_by('fastswap_id').values_list(
+        'fastswap_id', 'counties_id'
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    def rows():
+        for row, acceptable_ids in _merge(fast_swaps, acceptable):
+            (fast_swap_id, swap_names, phone, level, school, county_id, constituency_id,
+             ward_id, most_preferred_id, subject_key, created_at) = row
+            yield [
+                fast_swap_id, swap_names, phone, level, school or '', names.county(county_id),
+                names.constituency(constituency_id), names.ward(ward_id), names.county(most_preferred_id),
+                names.counties(acceptable_ids), names.subject_key(subject_key), created_at.isoformat(),
+            ]
+    return header, rows()
+
+
+def export_pairs():
+    names = _Names()
+    header = ['level', 'teacher_a', 'county_a', 'teacher_b', 'county_b']
+    pairs = MatchPair.objects.filter(user_id__lt=F('partner_id')).order_by('user_id', 'partner_id').values_list(
+        'level__name', 'user__email', 'user__profile__current_county_id',
+        'partner__email', 'partner__profile__current_county_id',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    def rows():
+        for level, email_a, county_a, email_b, county_b in pairs:
+            yield [level, email_a, names.county(county_a), email_b, names.county(county_b)]
+    return header, rows()
+
+
+def export_triangles():
+    names = _Names()
+    header = ['level', 'teacher_a', 'county_a', 'teacher_b', 'county_b', 'teacher_c', 'county_c', 'subjects']
+    triangles = TriangleSwap.objects.order_by('snapshot_id', 'id').values_list(
+        'snapshot__level__name', 'teacher_a__email', 'county_a_id', 'teacher_b__email', 'county_b_id',
+        'teacher_c__email', 'county_c_id', 'subject_key',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    def rows():
+        for level, email_a, county_a, email_b, county_b, email_c, county_c, subject_key in triangles:
+            yield [
+                level, email_a, names.county(county_a), email_b, names.county(county_b),
+                email_c, names.county(county_c), names.subject_key(subject_key),
+            ]
+    return header, rows()
+
+
+DATASETS = {
+    'teachers': export_teachers,
+    'swaps': export_swaps,
+    'fast-swaps': export_fast_swaps,
+    'pairs': export_pairs,
+    'triangles': export_triangles,
+}
+
+DATASET_LABELS = [
+    ('teachers', 'Teachers'),
+    ('swaps', 'Swaps'),
+    ('fast-swaps', 'Fast Swaps'),
+    ('pairs', 'Mutual Pairs'),
+    ('triangles', 'Triangles'),
+]
+
+
+class _Echo:
+    """File-like object whose write() returns the text, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_export(dataset, fmt='csv'):
+    """Yield a dataset as CSV or JSON Lines text, ``WRITE_BATCH`` rows per chunk."""
+    header, rows = DATASETS[dataset]()
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        render = writer.writerow
+        yield render(header)
+    else:
+        def render(row):
+            return json.dumps(dict(zip(header, row)), default=str) + '\n'
+
+    batch = []
+    for row in rows:
+        batch.append(render(row))
+        if len(batch) >= WRITE_BATCH:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
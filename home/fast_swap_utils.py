@@ -6,11 +6,8 @@ def get_fast_swap_current_county(fs):
     return fs.current_county
 
 def get_user_current_county(user):
-    if hasattr(user, 'profile') and user.profile and user.profile.school and user.profile.school.ward:
-        try:
-            return user.profile.school.ward.constituency.county
-        except:
-            return None
+    if hasattr(user, 'profile') and user.profile and user.profile.current_county_id:
+        return user.profile.current_county
     return None
 
 def fs_wants_county(fs, county):
@@ -50,7 +47,6 @@ def find_mutual_matches_for_fast_swap(fs):
     fs_level = fs.level
     fs_county = fs.current_county
     is_secondary = 'secondary' in fs_level.name.lower() or 'high' in fs_level.name.lower()
-    fs_subjects = get_fs_subjects(fs) if is_secondary else set()
 
     # 1. Match with other FastSwaps
     # They want MY county AND I want THEIR county
@@ -74,17 +70,14 @@ def find_mutual_matches_for_fast_swap(fs):
         ).distinct()
 
         if is_secondary:
-            valid_ids = []
-            for ofs in matching_fs:
-                if get_fs_subjects(ofs) == fs_subjects:
-                    valid_ids.append(ofs.id)
-            matching_fs = matching_fs.filter(id__in=valid_ids)
+            # Same portfolio == same subject signature
+            matching_fs = matching_fs.filter(subject_key=fs.subject_key)
 
     # 2. Match with MyUsers
     matching_users = MyUser.objects.filter(
         is_active=True,
         profile__level=fs_level,
-        profile__school__ward__constituency__county__id__in=fs_target_counties
+        profile__current_county_id__in=fs_target_counties
     ).filter(
         Q(swappreference__desired_county=fs_county) | Q(swappreference__open_to_all=fs_county)
     ).select_related(
@@ -93,14 +86,10 @@ def find_mutual_matches_for_fast_swap(fs):
     ).distinct()
 
     if is_secondary:
-        valid_user_ids = []
-        if not fs_subjects: #fs has no subjects
+        if not fs.subject_key: #fs has no subjects
              matching_users = MyUser.objects.none()
         else:
-            for user in matching_users:
-                if get_user_subjects(user) == fs_subjects:
-                    valid_user_ids.append(user.id)
-            matching_users = matching_users.filter(id__in=valid_user_ids)
+            matching_users = matching_users.filter(profile__subject_key=fs.subject_key)
 
     return {
         'fast_swaps': list(matching_fs),
@@ -120,7 +109,6 @@ def find_triangle_matches_for_fast_swap(fs, fast_swap_only=True, level_strict=Tr
         return []
         
     is_secondary = 'secondary' in fs_level.name.lower() or 'high' in fs_level.name.lower()
-    fs_subjects = get_fs_subjects(fs) if is_secondary else set()
 
     # Participants pool
     potential_participants = []
@@ -128,48 +116,50 @@ def find_triangle_matches_for_fast_swap(fs, fast_swap_only=True, level_strict=Tr
     # FastSwaps
     p_fs_queryset = FastSwap.objects.filter(
         current_county__isnull=False
-    ).exclude(id=fs.id).prefetch_related('acceptable_county', 'subjects')
+    ).exclude(id=fs.id).select_related('current_county').prefetch_related('acceptable_county', 'subjects')
     
     if level_strict:
         p_fs_queryset = p_fs_queryset.filter(level=fs_level)
+    if is_secondary:
+        # Same portfolio == same subject signature
+        p_fs_queryset = p_fs_queryset.filter(subject_key=fs.subject_key)
     
     for ofs in p_fs_queryset:
-        if not is_secondary or get_fs_subjects(ofs) == fs_subjects:
-            targets = set([ofs.most_preferred.id] if ofs.most_preferred else [])
-            targets.update(ofs.acceptable_county.values_list('id', flat=True))
-            potential_participants.append({
-                'type': 'fastswap',
-                'obj': ofs,
-                'county': ofs.current_county,
-                'targets': targets
-            })
+        targets = set([ofs.most_preferred_id] if ofs.most_preferred_id else [])
+        targets.update(county.id for county in ofs.acceptable_county.all())
+        potential_participants.append({
+            'type': 'fastswap',
+            'obj': ofs,
+            'county': ofs.current_county,
+            'targets': targets
+        })
 
     # Users
     if not fast_swap_only:
         p_u_queryset = MyUser.objects.filter(
             is_active=True,
-            profile__school__ward__constituency__county__isnull=False,
+            profile__current_county__isnull=False,
             swappreference__isnull=False
         ).select_related(
-            'profile__school__ward__constituency__county',
+            'profile__current_county',
             'swappreference__desired_county'
         ).prefetch_related('swappreference__open_to_all')
         
         if level_strict:
             p_u_queryset = p_u_queryset.filter(profile__level=fs_level)
+        if is_secondary:
+            p_u_queryset = p_u_queryset.filter(profile__subject_key=fs.subject_key)
             
         for u in p_u_queryset:
-            if not is_secondary or get_user_subjects(u) == fs_subjects:
-                u_county = get_user_current_county(u)
-                if u_county:
-                    targets = set([u.swappreference.desired_county.id] if u.swappreference.desired_county else [])
-                    targets.update(u.swappreference.open_to_all.values_list('id', flat=True))
-                    potential_participants.append({
-                        'type': 'user',
-                        'obj': u,
-                        'county': u_county,
-                        'targets': targets
-                    })
+            u_county = u.profile.current_county
+            targets = set([u.swappreference.desired_county_id] if u.swappreference.desired_county_id else [])
+            targets.update(county.id for county in u.swappreference.open_to_all.all())
+            potential_participants.append({
+                'type': 'user',
+                'obj': u,
+                'county': u_county,
+                'targets': targets
+            })
 
     # A's targets
     fs_targets = set([fs.most_preferred.id] if fs.most_preferred else [])
@@ -0,0 +1,184 @@
+"""
+In-process gazetteer for Kenya's administrative hierarchy.
+
+Counties, constituencies and wards are populated once (see the
+``populate_kenya_admin`` command) and almost never change, yet nearly every
+page and every cascading dropdown used to query them. The gazetteer loads the
+whole hierarchy once per worker into immutable structures:
+
+- ID -> place lookups for each level
+- parent -> children tuples (county -> constituencies -> wards), name ordered
+- a version string derived from a checksum of the three tables
+
+The loaded copy is revalidated against the database checksum at most every
+``GAZETTEER_RECHECK_SECONDS`` (one cheap aggregate query per table), and is
+dropped immediately in the current process when a place is saved or deleted.
+
+The same snapshot can be exported as a compact columnar JSON bundle (see the
+``build_geography_bundle`` command) so browsers can cascade the dropdowns
+locally instead of calling the constituency/ward endpoints on every change.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Constituencies, Counties, Wards
+
+# Lightweight stand-in for a place row. Templates only use ``id`` and ``name``.
+Place = namedtuple('Place', ['id', 'name', 'parent_id'])
+
+_EMPTY = ()
+
+# Location of the client-side bundle inside the static files tree.
+BUNDLE_PATH = 'geography/kenya.json'
+
+
+class Gazetteer:
+    """Immutable snapshot of the county -> constituency -> ward hierarchy."""
+
+    def __init__(self, counties, constituencies, wards, version):
+        self.version = version
+
+        self._counties = tuple(sorted(counties, key=lambda p: p.name))
+        self._county_by_id = MappingProxyType({p.id: p for p in counties})
+        self._constituency_by_id = MappingProxyType({p.id: p for p in constituencies})
+        self._ward_by_id = MappingProxyType({p.id: p for p in wards})
+
+        self._constituencies_by_county = self._group(constituencies)
+        self._wards_by_constituency = self._group(wards)
+
+    @staticmethod
+    def _group(places):
+        grouped = {}
+        for place in sorted(places, key=lambda p: p.name):
+            grouped.setdefault(place.parent_id, []).append(place)
+        return MappingProxyType({parent_id: tuple(children) for parent_id, children in grouped.items()})
+
+    # Lookups ---------------------------------------------------------------
+
+    def counties(self):
+        """All counties, ordered by name."""
+        return self._counties
+
+    def county(self, county_id):
+        return self._county_by_id.get(_as_int(county_id))
+
+    def constituency(self, constituency_id):
+        return self._constituency_by_id.get(_as_int(constituency_id))
+
+    def ward(self, ward_id):
+        return self._ward_by_id.get(_as_int(ward_id))
+
+    def constituencies_for(self, county_id):
+        """Constituencies in a county, ordered by name."""
+        return self._constituencies_by_county.get(_as_int(county_id), _EMPTY)
+
+    def wards_for(self, constituency_id):
+        """Wards in a constituency, ordered by name."""
+        return self._wards_by_constituency.get(_as_int(constituency_id), _EMPTY)
+
+    def county_id_for_ward(self, ward_id):
+        ward = self.ward(ward_id)
+        if not ward:
+            return None
+        constituency = self._constituency_by_id.get(ward.parent_id)
+        return constituency.parent_id if constituency else None
+
+    def as_bundle(self):
+        """
+        Columnar representation of the hierarchy for the client-side bundle.
+
+        Each level is a dict of parallel lists (``id``, ``name`` and, below
+        county level, ``parent``) ordered by name, which is roughly half the
+        size of a list of objects once compressed.
+        """
+        def columns(places, with_parent=True):
+            data = {'id': [p.id for p in places], 'name': [p.name for p in places]}
+            if with_parent:
+                data['parent'] = [p.parent_id for p in places]
+            return data
+
+        constituencies = [p for group in self._constituencies_by_county.values() for p in group]
+        wards = [p for group in self._wards_by_constituency.values() for p in group]
+        return {
+            'version': self.version,
+            'counties': columns(self._counties, with_parent=False),
+            'constituencies': columns(constituencies),
+            'wards': columns(wards),
+        }
+
+    def __len__(self):
+        return len(self._county_by_id) + len(self._constituency_by_id) + len(self._ward_by_id)
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compute_checksum():
+    """
+    Checksum of the three geography tables.
+
+    Uses row counts, max IDs and the latest ``updated_at`` so inserts, deletes
+    and renames all change the result.
+    """
+    digest = hashlib.sha1()
+    for model in (Counties, Constituencies, Wards):
+        stats = model.objects.aggregate(rows=Count('id'), last_id=Max('id'), last_update=Max('updated_at'))
+        digest.update(f"{model._meta.db_table}:{stats['rows']}:{stats['last_id']}:{stats['last_update']}|".encode())
+    return digest.hexdigest()[:16]
+
+
+def load_gazetteer():
+    """Build a fresh :class:`Gazetteer` from the database."""
+    version = compute_checksum()
+    counties = [Place(pk, name, None) for pk, name in Counties.objects.values_list('id', 'name')]
+    constituencies = [
+        Place(pk, name, county_id)
+        for pk, name, county_id in Constituencies.objects.values_list('id', 'name', 'county_id')
+    ]
+    wards = [
+        Place(pk, name, constituency_id)
+        for pk, name, constituency_id in Wards.objects.values_list('id', 'name', 'constituency_id')
+    ]
+    return Gazetteer(counties, constituencies, wards, version)
+
+
+_lock = threading.Lock()
+_state = {'gazetteer': None, 'checked_at': 0.0}
+
+
+def get_gazetteer():
+    """
+    Return the worker's gazetteer, loading or revalidating it when needed.
+    """
+    recheck_after = getattr(settings, 'GAZETTEER_RECHECK_SECONDS', 300)
+    gazetteer = _state['gazetteer']
+    if gazetteer is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+        return gazetteer
+
+    with _lock:
+        gazetteer = _state['gazetteer']
+        if gazetteer is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+            return gazetteer
+
+        if gazetteer is None or compute_checksum() != gazetteer.version:
+            gazetteer = load_gazetteer()
+            _state['gazetteer'] = gazetteer
+        _state['checked_at'] = time.monotonic()
+        return gazetteer
+
+
+def reset_gazetteer():
+    """Drop this worker's copy so the next lookup reloads from the database."""
+    with _lock:
+        _state['gazetteer'] = None
+        _state['checked_at'] = 0.0
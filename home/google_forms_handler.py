@@ -8,13 +8,13 @@ import logging
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import transaction
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 
 from .models import (
     Level, Subject, MySubject, Counties, SwapPreference
 )
+from users.mail_queue import queue_email
 from users.models import PersonalProfile
 
 User = get_user_model()
@@ -90,7 +90,7 @@ class GoogleFormProcessor:
     
     
     def send_welcome_email(self, user, phone_number):
-        """Send welcome email with login credentials."""
+        """Queue the welcome email with login credentials (users.mail_queue)."""
         try:
             subject = 'Welcome to TSCSwap - Your Account Has Been Created'
             
@@ -105,20 +105,13 @@ class GoogleFormProcessor:
             html_message = render_to_string('emails/welcome_email.html', context)
             plain_message = strip_tags(html_message)
             
-            send_mail(
-                subject=subject,
-                message=plain_message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email],
-                html_message=html_message,
-                fail_silently=False,
-            )
+            queue_email(subject, plain_message, user.email, html_body=html_message)
             
-            logger.info(f"Welcome email sent to {user.email}")
+            logger.info(f"Welcome email queued for {user.email}")
             return True
             
         except Exception as e:
-            logger.error(f"Failed to send welcome email to {user.email}: {str(e)}")
+            logger.error(f"Failed to queue welcome email to {user.email}: {str(e)}")
             # Don't fail the whole process if email fails
             return False
     
@@ -0,0 +1,51 @@
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from home.gazetteer import BUNDLE_PATH, load_gazetteer
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the county/constituency/ward hierarchy as a compact JSON bundle into the static '
+        'files tree so the cascading dropdowns can work without server calls'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output-dir',
+            help='Static directory to write into (defaults to the first STATICFILES_DIRS entry)',
+        )
+        parser.add_argument(
+            '--collectstatic',
+            action='store_true',
+            help='Run collectstatic afterwards so the bundle is hashed and gzip/brotli compressed',
+        )
+
+    def handle(self, *args, **options):
+        output_dir = options['output_dir'] or settings.STATICFILES_DIRS[0]
+        path = os.path.join(output_dir, BUNDLE_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        gazetteer = load_gazetteer()
+        payload = json.dumps(gazetteer.as_bundle(), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+        with open(path, 'wb') as bundle_file:
+            bundle_file.write(payload)
+
+        self.stdout.write(
+            f'Wrote {path} ({len(gazetteer)} places, version {gazetteer.version}): '
+            f'{len(payload)} bytes, {len(gzip.compress(payload, 9))} bytes gzipped'
+        )
+
+        if options['collectstatic']:
+            # CompressedManifestStaticFilesStorage fingerprints the file name
+            # (served by WhiteNoise as immutable) and writes .gz/.br siblings.
+            call_command('collectstatic', interactive=False, verbosity=0)
+            self.stdout.write('Collected static files')
+
+        self.stdout.write(self.style.SUCCESS('Geography bundle built successfully'))
@@ -0,0 +1,105 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from home.models import Swaps, SwapPreference, SwapRequests
+from payments.models import MpesaTransaction
+from users.models import MyUser, PersonalProfile
+
+
+def hot_queries():
+    """
+    Representative versions of the queries behind matching, swap listings,
+    swap requests and payment history. IDs are placeholders; the plan only
+    depends on the shape of the query.
+    """
+    return [
+        ('matching: candidates by level and county', MyUser.objects.filter(
+            is_active=True,
+            profile__level_id=1,
+            profile__current_county_id__in=[1, 2],
+            swappreference__isnull=False,
+        ).filter(
+            Q(swappreference__desired_county_id=1) | Q(swappreference__open_to_all=1)
+        )),
+        ('matching: profiles in a county', PersonalProfile.objects.filter(level_id=1, current_county_id=1)),
+        ('matching: open_to_all membership', SwapPreference.objects.filter(open_to_all=1)),
+        ('swaps: active listings', Swaps.objects.filter(status=True, archived=False).order_by('-created_at')),
+        ('swaps: user active swaps', Swaps.objects.filter(user_id=1, status=True)),
+        ('swap requests: received', SwapRequests.objects.filter(target_id=1, is_active=True)),
+        ('swap requests: sent', SwapRequests.objects.filter(requester_id=1, is_active=True)),
+        ('payments: user history', MpesaTransaction.objects.filter(user_id=1, status='completed').order_by('-created_at')),
+    ]
+
+
+def explain(queryset):
+    """
+    Return ``(plan_lines, full_scans)`` for a queryset on the current backend.
+
+    SQLite reports ``SCAN <table>`` for a full table scan (``SCAN ... USING
+    INDEX`` walks an index and is not flagged); MySQL reports ``type = ALL``.
+    Other backends only get the plan printed.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            lines = [row[-1] for row in cursor.fetchall()]
+            scans = [line for line in lines if line.startswith('SCAN ') and ' USING ' not in line]
+            return lines, scans
+
+        if connection.vendor == 'mysql':
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            lines = [
+                f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row.get('Extra') or ''}".strip()
+                for row in rows
+            ]
+            scans = [line for row, line in zip(rows, lines) if row['type'] == 'ALL']
+            return lines, scans
+
+    return queryset.explain().splitlines(), []
+
+
+class Command(BaseCommand):
+    help = 'EXPLAINs the hot matching, swap and payment queries and flags full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ignore-table',
+            action='append',
+            default=['home_counties', 'home_level'],
+            help='Table whose full scans are acceptable (small lookup tables). Can be repeated.',
+        )
+        parser.add_argument(
+            '--fail-on-scan',
+            action='store_true',
+            help='Exit with an error if any query still does a full scan',
+        )
+
+    def handle(self, *args, **options):
+        ignored = set(options['ignore_table'])
+        flagged = 0
+
+        self.stdout.write(f'Query plans on {connection.vendor}\n')
+        for name, queryset in hot_queries():
+            lines, scans = explain(queryset)
+            scans = [line for line in scans if not any(table in line for table in ignored)]
+
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for line in lines:
+                self.stdout.write(f'  {line}')
+            if scans:
+                flagged += 1
+                for line in scans:
+                    self.stdout.write(self.style.WARNING(f'  FULL SCAN: {line}'))
+            self.stdout.write('')
+
+        if flagged and options['fail_on_scan']:
+            raise CommandError(f'{flagged} hot query(ies) use a full table scan')
+
+        if flagged:
+            self.stdout.write(self.style.WARNING(f'{flagged} hot query(ies) use a full table scan'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No full table scans in hot queries'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from home.exports import DATASETS, FORMATS, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Streams teachers, swaps, fast swaps, mutual pairs or triangles as CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write (defaults to stdout)')
+
+    def handle(self, *args, **options):
+        chunks = stream_export(options['dataset'], options['format'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Wrote {options['dataset']} to {options['output']}"))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.county_stats import compute_county_stats, rebuild_county_stats
+from home.models import CountyStats
+
+
+class Command(BaseCommand):
+    help = 'Checks and rebuilds the CountyStats rollup (teachers, inbound and outbound per county and level)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare the rollup with a fresh computation; exit with an error if they differ',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            expected = {key: tuple(counts) for key, counts in compute_county_stats().items() if any(counts)}
+            stored = {
+                (county_id, level_id): (teachers, inbound, outbound)
+                for county_id, level_id, teachers, inbound, outbound in CountyStats.objects.values_list(
+                    'county_id', 'level_id', 'teachers', 'inbound', 'outbound'
+                )
+                if teachers or inbound or outbound
+            }
+            stale = {key for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)}
+            if stale:
+                for county_id, level_id in sorted(stale)[:20]:
+                    self.stdout.write(f'  county={county_id} level={level_id}: '
+                                      f'stored={stored.get((county_id, level_id))} '
+                                      f'expected={expected.get((county_id, level_id))}')
+                raise CommandError(f'{len(stale)} county stats row(s) are out of date')
+            self.stdout.write(self.style.SUCCESS('County stats are consistent'))
+            return
+
+        written = rebuild_county_stats()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt county stats: {written} row(s)'))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.match_pairs import compute_match_pairs, rebuild_match_pairs
+from home.models import MatchPair, PotentialMatchCount
+
+
+class Command(BaseCommand):
+    help = 'Checks and rebuilds the mutual match pairs and potential-match counters used by the user admin'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare the stored pairs and counters with a fresh computation; exit with an error if they differ',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            expected = compute_match_pairs()
+            stored = dict(
+                ((user_id, partner_id), level_id)
+                for user_id, partner_id, level_id in MatchPair.objects.values_list('user_id', 'partner_id', 'level_id')
+            )
+            stale = {key for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)}
+
+            expected_counts = {}
+            for user_id, _ in expected:
+                expected_counts[user_id] = expected_counts.get(user_id, 0) + 1
+            stored_counts = dict(PotentialMatchCount.objects.filter(count__gt=0).values_list('user_id', 'count'))
+            stale_counts = {
+                user_id for user_id in expected_counts.keys() | stored_counts.keys()
+                if expected_counts.get(user_id) != stored_counts.get(user_id)
+            }
+
+            if stale or stale_counts:
+                for user_id, partner_id in sorted(stale)[:20]:
+                    self.stdout.write(f'  pair {user_id} -> {partner_id}: '
+                                      f'stored={stored.get((user_id, partner_id))} '
+                                      f'expected={expected.get((user_id, partner_id))}')
+                for user_id in sorted(stale_counts)[:20]:
+                    self.stdout.write(f'  user={user_id}: stored count={stored_counts.get(user_id)} '
+                                      f'expected={expected_counts.get(user_id)}')
+                raise CommandError(f'{len(stale)} pair(s) and {len(stale_counts)} counter(s) are out of date')
+            self.stdout.write(self.style.SUCCESS('Match pairs are consistent'))
+            return
+
+        written = rebuild_match_pairs()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt match pairs: {written} pair(s)'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Q
+
+from home.models import Level, TriangleSnapshot
+from home.triangle_snapshots import refresh_triangle_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the precomputed triangle swap listings shown on the staff triangle pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--level',
+            action='append',
+            default=[],
+            help='Level id or name to refresh (defaults to every level). Can be repeated.',
+        )
+        parser.add_argument(
+            '--pending',
+            action='store_true',
+            help='Only refresh levels where staff requested a refresh since the last run',
+        )
+
+    def handle(self, *args, **options):
+        levels = Level.objects.order_by('name')
+        if options['level']:
+            lookup = Q()
+            for value in options['level']:
+                lookup |= Q(pk=value) if value.isdigit() else Q(name__iexact=value)
+            levels = levels.filter(lookup)
+            if not levels:
+                raise CommandError(f"No level matches {', '.join(options['level'])}")
+
+        if options['pending']:
+            pending = TriangleSnapshot.objects.filter(requested_at__isnull=False).filter(
+                Q(computed_at__isnull=True) | Q(requested_at__gt=F('computed_at'))
+            )
+            levels = levels.filter(pk__in=pending.values('level_id'))
+
+        for level in levels:
+            snapshot = refresh_triangle_snapshot(level)
+            self.stdout.write(
+                f'{level.name}: {snapshot.triangle_count} triangle(s) from '
+                f'{snapshot.teacher_count} teacher(s) in {snapshot.duration_ms} ms'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {len(levels)} level(s)'))
@@ -0,0 +1,126 @@
+"""
+Maintenance of the MatchPair table and the PotentialMatchCount counters
+behind the user admin's potential-match column and filter.
+
+A pair is a mutual match as on the staff matched-swaps pages (see
+home.pair_matching): same school level, each teacher's current county is
+among the other's wanted counties, and for secondary a shared subject.
+
+Signals call ``refresh_match_pairs`` with the teachers whose location,
+preferences, subjects or active flag changed; only their pairs and the
+counters of the teachers on either side are rewritten. The
+``rebuild_match_pairs`` command recomputes everything.
+"""
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .demand_matrix import destination_ids
+from .models import Level, MatchPair, PotentialMatchCount
+from .pair_matching import mutual_pairs, subject_masks
+from .triangle_snapshots import level_uses_subjects
+
+
+def partner_ids(user_id):
+    """``(level_id, {partner_id, ...})`` for one teacher, or ``(None, set())``."""
+    from users.models import PersonalProfile
+
+    profile = PersonalProfile.objects.filter(
+        user_id=user_id,
+        user__is_active=True,
+        user__role='Teacher',
+        school__level__isnull=False,
+        current_county__isnull=False,
+        user__swappreference__isnull=False,
+    ).select_related('school__level').first()
+    if profile is None:
+        return None, set()
+    level = profile.school.level
+    county_id = profile.current_county_id
+
+    wants = destination_ids([user_id]).get(user_id, set()) - {county_id}
+    if not wants:
+        return level.id, set()
+    candidates = list(PersonalProfile.objects.filter(
+        user__is_active=True,
+        user__role='Teacher',
+        school__level=level,
+        current_county_id__in=wants,
+        user__swappreference__isnull=False,
+    ).exclude(user_id=user_id).values_list('user_id', flat=True))
+    their_wants = destination_ids(candidates)
+    partners = {candidate for candidate in candidates if county_id in their_wants.get(candidate, ())}
+
+    if partners and level_uses_subjects(level):
+        masks, _ = subject_masks([user_id, *partners])
+        mine = masks.get(user_id, 0)
+        partners = {partner for partner in partners if masks.get(partner, 0) & mine}
+    return level.id, partners
+
+
+def compute_match_pairs():
+    """Every pair as ``{(user_id, partner_id): level_id}``, in both directions."""
+    pairs = {}
+    for level in Level.objects.all():
+        level_pairs, _ = mutual_pairs(level, level_uses_subjects(level))
+        for a_id, b_id, _, _, _ in level_pairs:
+            pairs[(a_id, b_id)] = level.id
+            pairs[(b_id, a_id)] = level.id
+    return pairs
+
+
+def refresh_match_counts(user_ids):
+    """Rewrite the PotentialMatchCount rows of the given users from MatchPair."""
+    user_ids = set(user_ids)
+    counts = dict(
+        MatchPair.objects.filter(user_id__in=user_ids)
+        .values('user_id').annotate(n=Count('id')).order_by()
+        .values_list('user_id', 'n')
+    )
+    with transaction.atomic():
+        PotentialMatchCount.objects.filter(user_id__in=user_ids).delete()
+        PotentialMatchCount.objects.bulk_create([
+            PotentialMatchCount(user_id=user_id, count=count) for user_id, count in counts.items()
+        ])
+
+
+def refresh_match_pairs(user_ids):
+    """Recompute the pairs of the given teachers and every affected counter."""
+    user_ids = {user_id for user_id in user_ids if user_id}
+    if not user_ids:
+        return
+
+    rows = {}
+    for user_id in user_ids:
+        level_id, partners = partner_ids(user_id)
+        for partner_id in partners:
+            rows[(user_id, partner_id)] = level_id
+            rows[(partner_id, user_id)] = level_id
+
+    with transaction.atomic():
+        involved = MatchPair.objects.filter(Q(user_id__in=user_ids) | Q(partner_id__in=user_ids))
+        affected = set(involved.values_list('user_id', flat=True)) | {user_id for user_id, _ in rows}
+        involved.delete()
+        MatchPair.objects.bulk_create([
+            MatchPair(user_id=user_id, partner_id=partner_id, level_id=level_id)
+            for (user_id, partner_id), level_id in rows.items()
+        ])
+        refresh_match_counts(affected | user_ids)
+
+
+def rebuild_match_pairs():
+    """Replace every pair and counter. Returns the number of pairs (each counted once)."""
+    pairs = compute_match_pairs()
+    with transaction.atomic():
+        MatchPair.objects.all().delete()
+        MatchPair.objects.bulk_create([
+            MatchPair(user_id=user_id, partner_id=partner_id, level_id=level_id)
+            for (user_id, partner_id), level_id in pairs.items()
+        ], batch_size=1000)
+        PotentialMatchCount.objects.all().delete()
+        counts = {}
+        for user_id, _ in pairs:
+            counts[user_id] = counts.get(user_id, 0) + 1
+        PotentialMatchCount.objects.bulk_create([
+            PotentialMatchCount(user_id=user_id, count=count) for user_id, count in counts.items()
+        ], batch_size=1000)
+    return len(pairs) // 2
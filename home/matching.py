@@ -26,18 +26,13 @@ def find_matches(user):
         return MyUser.objects.none()
 
     # User's current details
-    user_school = user.profile.school
     user_level = user.profile.level  # IMPORTANT: Use teacher's level, not school's level!
     
-    # Check ward/constituency/county exist
-    if not user_school.ward:
-        return MyUser.objects.none()
-    if not user_school.ward.constituency:
-        return MyUser.objects.none()
-    if not user_school.ward.constituency.county:
+    # Location is denormalized onto the profile from school -> ward -> constituency -> county
+    if not user.profile.current_county_id:
         return MyUser.objects.none()
     
-    user_county = user_school.ward.constituency.county
+    user_county = user.profile.current_county_id
     
     # User's preferences
     user_desired_county = user_prefs.desired_county
@@ -54,12 +49,11 @@ def find_matches(user):
         profile__isnull=False,
         profile__level=user_level,  # Match by TEACHER's level, not school level
         profile__school__isnull=False,
-        profile__school__ward__isnull=False,
-        profile__school__ward__constituency__isnull=False,
-        profile__school__ward__constituency__county__isnull=False,
+        profile__current_county__isnull=False,
         swappreference__isnull=False
     ).select_related(
         'profile__school__ward__constituency__county',
+        'profile__current_county',
         'swappreference__desired_county',
         'profile__level'  # Select teacher's level
     ).prefetch_related(
@@ -83,7 +77,7 @@ def find_matches(user):
     if not my_target_counties:
         return MyUser.objects.none()
         
-    i_want_them = Q(profile__school__ward__constituency__county__id__in=my_target_counties)
+    i_want_them = Q(profile__current_county_id__in=my_target_counties)
     
     potential_matches = potential_matches.filter(they_want_me & i_want_them)
 
@@ -108,3 +102,71 @@ def find_matches(user):
         potential_matches = potential_matches.filter(id__in=matches_with_correct_subjects)
 
     return potential_matches.distinct()
+
+
+def classify_level_matches(user, level_keywords, by_subjects=False):
+    """
+    Perfect and partial matches for ``user`` among teachers whose school level
+    name contains one of ``level_keywords``.
+
+    - perfect: the other teacher wants the user's county and the user wants
+      theirs
+    - partial: only one of the two directions holds
+
+    With ``by_subjects`` both must also share at least one subject. Candidates
+    come from one indexed query (teachers in a county the user wants, or
+    wanting the user's county); their preferences and subjects are then
+    compared as ids and bitmasks, so the cost does not grow with the level.
+
+    Returns ``(perfect_matches, partial_matches)`` as lists of MyUser with
+    profile, school location and subjects loaded.
+    """
+    from .demand_matrix import destination_ids
+    from .pair_matching import subject_masks
+
+    profile = getattr(user, 'profile', None)
+    if not profile or not profile.current_county_id:
+        return [], []
+    user_county = profile.current_county_id
+    user_wants = destination_ids([user.id]).get(user.id, set())
+
+    level_filter = Q()
+    for keyword in level_keywords:
+        level_filter |= Q(profile__school__level__name__icontains=keyword)
+
+    candidates = dict(MyUser.objects.filter(
+        level_filter,
+        ~Q(id=user.id),
+        is_active=True,
+        profile__current_county__isnull=False,
+        swappreference__isnull=False,
+    ).filter(
+        Q(profile__current_county_id__in=user_wants)
+        | Q(swappreference__desired_county_id=user_county)
+        | Q(swappreference__open_to_all=user_county)
+    ).values_list('id', 'profile__current_county_id').distinct())
+    if not candidates:
+        return [], []
+
+    wants = destination_ids(list(candidates))
+    if by_subjects:
+        masks, _ = subject_masks([user.id, *candidates])
+        user_mask = masks.get(user.id, 0)
+
+    perfect_ids, partial_ids = [], []
+    for candidate_id in sorted(candidates):
+        if by_subjects and not masks.get(candidate_id, 0) & user_mask:
+            continue
+        they_want_me = user_county in wants.get(candidate_id, ())
+        i_want_them = candidates[candidate_id] in user_wants
+        if they_want_me and i_want_them:
+            perfect_ids.append(candidate_id)
+        elif they_want_me or i_want_them:
+            partial_ids.append(candidate_id)
+
+    users = MyUser.objects.filter(id__in=perfect_ids + partial_ids).select_related(
+        'profile__school__ward__constituency__county',
+        'profile__current_county',
+        'swappreference__desired_county',
+    ).prefetch_related('mysubject_set__subject').in_bulk()
+    return [users[i] for i in perfect_ids], [users[i] for i in partial_ids]
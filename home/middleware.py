@@ -4,7 +4,8 @@ Custom middleware to catch exceptions and redirect to error page.
 import logging
 from django.shortcuts import redirect
 from django.urls import reverse
-from django.http import HttpResponseServerError
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponseServerError
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +34,11 @@ class ErrorHandlingMiddleware:
         if settings.DEBUG:
             return None  # Let Django handle it with debug page
         
+        # Not found and permission denied keep their own status codes and
+        # error pages (handler404 and friends)
+        if isinstance(exception, (Http404, PermissionDenied)):
+            return None
+        
         # Log the exception
         logger.error(
             f"Unhandled exception: {str(exception)}",
@@ -44,45 +50,10 @@ class ErrorHandlingMiddleware:
             }
         )
         
-        # Save error to database (error_page will handle this, but we can also do it here for middleware exceptions)
-        try:
-            from home.models import ErrorLog
-            import traceback
-            
-            # Get user (may be AnonymousUser)
-            user = None
-            if hasattr(request, 'user') and request.user.is_authenticated:
-                user = request.user
-            
-            # Get IP address
-            ip_address = None
-            if hasattr(request, 'META'):
-                x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-                if x_forwarded_for:
-                    ip_address = x_forwarded_for.split(',')[0].strip()
-                else:
-                    ip_address = request.META.get('REMOTE_ADDR')
-            
-            # Get user agent
-            user_agent = request.META.get('HTTP_USER_AGENT', '')[:500] if hasattr(request, 'META') else ''
-            
-            # Create error log entry
-            ErrorLog.objects.create(
-                user=user,
-                error_type='exception',
-                error_message=str(exception)[:1000],
-                page_url=request.build_absolute_uri()[:500] if hasattr(request, 'build_absolute_uri') else None,
-                request_path=request.path[:500] if hasattr(request, 'path') else None,
-                request_method=request.method if hasattr(request, 'method') else None,
-                status_code=500,
-                exception_type=type(exception).__name__,
-                traceback=traceback.format_exc()[:5000],
-                user_agent=user_agent,
-                ip_address=ip_address,
-            )
-        except Exception as e:
-            # If saving error log fails, just log it (don't break error handling)
-            logger.error(f"Failed to save error log in middleware: {str(e)}")
+        # Counted in the buffered error log; error_page below sees the request
+        # is already recorded and does not log it again
+        from home.error_log import record_error
+        record_error(request, 'exception', 500, exception)
         
         # Redirect to error page
         try:
@@ -3,6 +3,15 @@ from django.db import models
 from django.utils import timezone
 
 User = settings.AUTH_USER_MODEL
+
+
+def subject_key_for(subject_ids):
+    """
+    Signature of a subject portfolio: sorted, comma-separated subject IDs
+    (e.g. "3,7,12"). Two portfolios are identical exactly when their keys are.
+    """
+    return ','.join(str(subject_id) for subject_id in sorted(set(subject_ids)))
+
 # Create your models here.
 class Curriculum(models.Model):
     name = models.CharField(max_length=255)
@@ -123,6 +132,14 @@ class Swaps(models.Model):
     status = models.BooleanField(default=True)
     archived = models.BooleanField(default=False)
     closed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Swap listings filter on status/archived and order by newest
+            models.Index(fields=['status', 'archived', '-created_at']),
+            models.Index(fields=['user', 'status']),
+        ]
+
     def __str__(self):
         return f"{self.user}"
 
@@ -137,6 +154,10 @@ class SwapRequests(models.Model):
     class Meta:
         unique_together = [['requester', 'target']]
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['target', 'is_active']),
+            models.Index(fields=['requester', 'is_active']),
+        ]
     
     def __str__(self):
         return f"{self.requester} -> {self.target}"
@@ -174,6 +195,8 @@ class FastSwap(models.Model):
     acceptable_county = models.ManyToManyField(Counties, related_name='acceptable_county')
     level = models.ForeignKey(Level, on_delete=models.CASCADE)
     subjects = models.ManyToManyField(Subject)
+    # Signature of ``subjects`` (see subject_key_for), kept in step by signals
+    subject_key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     def __str__(self):
@@ -212,6 +235,115 @@ class Bookmark(models.Model):
         return f"{self.user} bookmark"
 
 
+class CountyStats(models.Model):
+    """
+    Rollup of teacher supply and swap demand per county and teacher level.
+    Kept up to date by signals (see home.county_stats) and fully rebuildable
+    with ``manage.py rebuild_county_stats``.
+    """
+    county = models.ForeignKey(Counties, on_delete=models.CASCADE, related_name='stats')
+    level = models.ForeignKey(Level, on_delete=models.CASCADE, related_name='county_stats')
+    teachers = models.PositiveIntegerField(default=0, help_text='Teachers currently teaching in the county')
+    inbound = models.PositiveIntegerField(default=0, help_text='Teachers who want to move to the county')
+    outbound = models.PositiveIntegerField(default=0, help_text='Teachers in the county who want to move out')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['county', 'level']]
+        verbose_name = 'County Stats'
+        verbose_name_plural = 'County Stats'
+
+    def __str__(self):
+        return f"{self.county} / {self.level}"
+
+
+class TriangleSnapshot(models.Model):
+    """
+    The latest precomputed triangle swap listing for a level. The rows live in
+    TriangleSwap; ``refresh_triangle_swaps`` (or the staff refresh button)
+    recomputes them, so page loads never run the triangle search.
+    """
+    level = models.OneToOneField(Level, on_delete=models.CASCADE, related_name='triangle_snapshot')
+    computed_at = models.DateTimeField(null=True, blank=True)
+    requested_at = models.DateTimeField(null=True, blank=True, help_text='Last time staff asked for a refresh')
+    teacher_count = models.PositiveIntegerField(default=0, help_text='Teachers considered by the last run')
+    triangle_count = models.PositiveIntegerField(default=0)
+    duration_ms = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Triangle Snapshot'
+        verbose_name_plural = 'Triangle Snapshots'
+
+    def __str__(self):
+        return f"{self.level} triangles ({self.triangle_count})"
+
+    @property
+    def refresh_pending(self):
+        return bool(self.requested_at and (self.computed_at is None or self.requested_at > self.computed_at))
+
+
+class TriangleSwap(models.Model):
+    """
+    One triangle from a snapshot: teacher A (in county A) wants county B,
+    teacher B wants county C and teacher C wants county A.
+    """
+    snapshot = models.ForeignKey(TriangleSnapshot, on_delete=models.CASCADE, related_name='triangles')
+    teacher_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    teacher_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    teacher_c = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    county_a = models.ForeignKey(Counties, on_delete=models.CASCADE, related_name='+')
+    county_b = models.ForeignKey(Counties, on_delete=models.CASCADE, related_name='+')
+    county_c = models.ForeignKey(Counties, on_delete=models.CASCADE, related_name='+')
+    subject_key = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['snapshot', 'subject_key']),
+            models.Index(fields=['snapshot', 'county_a']),
+            models.Index(fields=['snapshot', 'county_b']),
+            models.Index(fields=['snapshot', 'county_c']),
+        ]
+
+    def __str__(self):
+        return f"{self.teacher_a_id} -> {self.teacher_b_id} -> {self.teacher_c_id}"
+
+
+class MatchPair(models.Model):
+    """
+    A mutual swap match: ``partner`` teaches where ``user`` wants to go and
+    the other way round (same level, and a shared subject for secondary).
+    Stored in both directions so "matches of X" is one indexed lookup.
+    Maintained by signals (see home.match_pairs) and rebuildable with
+    ``manage.py rebuild_match_pairs``.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='match_pairs')
+    partner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matched_by')
+    level = models.ForeignKey(Level, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = [['user', 'partner']]
+        verbose_name = 'Match Pair'
+        verbose_name_plural = 'Match Pairs'
+
+    def __str__(self):
+        return f"{self.user_id} <-> {self.partner_id}"
+
+
+class PotentialMatchCount(models.Model):
+    """Number of MatchPair partners of a user; users without matches have no row."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='potential_match_count')
+    count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Potential Match Count'
+        verbose_name_plural = 'Potential Match Counts'
+
+    def __str__(self):
+        return f"{self.user_id}: {self.count}"
+
+
 class ErrorLog(models.Model):
     """
     Model to store error logs for debugging and monitoring.
@@ -305,12 +437,28 @@ class ErrorLog(models.Model):
         blank=True,
         help_text='Admin notes about this error'
     )
+    fingerprint = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+        help_text='Groups repeats of the same error (see home.error_log)'
+    )
+    occurrences = models.PositiveIntegerField(
+        default=1,
+        help_text='How many times this error happened while unresolved'
+    )
+    last_seen_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='When this error last happened'
+    )
     
     class Meta:
         ordering = ['-created_at']
         verbose_name = 'Error Log'
         verbose_name_plural = 'Error Logs'
         indexes = [
+            models.Index(fields=['fingerprint', 'resolved']),
             models.Index(fields=['-created_at']),
             models.Index(fields=['error_type']),
             models.Index(fields=['resolved']),
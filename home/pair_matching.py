@@ -0,0 +1,86 @@
+"""
+Level-wide mutual swap pairs for the staff matched-swaps pages.
+
+Two teachers of a level form a pair when each one's current county is among
+the other's wanted counties (desired county or ``open_to_all``). For
+secondary the two must also share at least one subject.
+
+Everything is loaded as plain ids in a handful of queries and joined in
+memory:
+
+- ``wanting[(wanted county, current county)]`` lists the teachers in
+  ``current county`` who want ``wanted county``, so the partners of teacher A
+  (in county X) who want X and sit in county Y come from one lookup
+- subjects are integer bitmasks over the subject ids in play, so an overlap
+  test is ``mask_a & mask_b``
+
+The work is O(teachers + pairs) instead of a query per candidate.
+"""
+from .demand_matrix import destination_ids
+from .models import MySubject
+
+
+def subject_masks(user_ids):
+    """
+    ``({user_id: mask}, [subject_id by bit])`` for the given users' subjects.
+    Bit ``i`` of a mask stands for ``subject_ids[i]``.
+    """
+    rows = MySubject.subject.through.objects.filter(
+        mysubject__user_id__in=user_ids
+    ).values_list('mysubject__user_id', 'subject_id')
+
+    bits = {}
+    masks = {}
+    for user_id, subject_id in rows:
+        bit = bits.setdefault(subject_id, len(bits))
+        masks[user_id] = masks.get(user_id, 0) | (1 << bit)
+    subject_ids = sorted(bits, key=bits.get)
+    return masks, subject_ids
+
+
+def mask_subject_ids(mask, subject_ids):
+    """Subject ids whose bits are set in ``mask``."""
+    return [subject_id for bit, subject_id in enumerate(subject_ids) if mask >> bit & 1]
+
+
+def mutual_pairs(level, by_subjects):
+    """
+    All mutual pairs of a level as ``(a_id, b_id, county_a_id, county_b_id,
+    common_mask)`` tuples with ``a_id < b_id``, plus the subject id list the
+    masks refer to. ``common_mask`` is 0 when subjects are not compared.
+    """
+    from users.models import PersonalProfile
+
+    teachers = dict(PersonalProfile.objects.filter(
+        user__is_active=True,
+        user__role='Teacher',
+        school__level=level,
+        current_county__isnull=False,
+        user__swappreference__isnull=False,
+    ).values_list('user_id', 'current_county_id'))
+    wanted = destination_ids(list(teachers))
+
+    masks, subject_ids = subject_masks(list(teachers)) if by_subjects else ({}, [])
+
+    wanting = {}
+    for user_id, county_id in teachers.items():
+        for wanted_county_id in wanted.get(user_id, ()):
+            if wanted_county_id != county_id:
+                wanting.setdefault((wanted_county_id, county_id), []).append(user_id)
+
+    pairs = []
+    for a_id in sorted(teachers):
+        county_a = teachers[a_id]
+        for county_b in sorted(wanted.get(a_id, ())):
+            if county_b == county_a:
+                continue
+            for b_id in wanting.get((county_a, county_b), ()):
+                if b_id <= a_id:
+                    continue
+                common_mask = 0
+                if by_subjects:
+                    common_mask = masks.get(a_id, 0) & masks.get(b_id, 0)
+                    if not common_mask:
+                        continue
+                pairs.append((a_id, b_id, county_a, county_b, common_mask))
+    return pairs, subject_ids
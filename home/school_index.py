@@ -0,0 +1,202 @@
+"""
+In-process search index for school names.
+
+``SchoolSearchView`` used to run ``name__icontains`` (a full table scan) plus a
+``count()`` on every keystroke. The index keeps one entry per school and a
+sorted list of ``(token, school_id)`` pairs built from the normalized name, so
+a prefix lookup is two bisects followed by a small candidate filter:
+
+- names are lower-cased, accent-stripped and split on anything that is not a
+  letter or digit
+- every query token has to be a prefix of some token of the school name
+- results rank full-name prefix matches first, then schools in the caller's
+  county, then by name
+
+Like the gazetteer, the index is loaded once per worker, revalidated against a
+checksum of the schools table every ``SCHOOL_INDEX_RECHECK_SECONDS`` and
+patched in place when a school is saved or deleted in this process.
+"""
+import bisect
+import hashlib
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .gazetteer import get_gazetteer
+from .models import Schools
+
+SchoolEntry = namedtuple(
+    'SchoolEntry',
+    ['id', 'name', 'level', 'gender', 'boarding', 'ward_id', 'county_id', 'normalized', 'tokens'],
+)
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+# Sorts after every character a normalized token can contain.
+_PREFIX_END = '\x7f'
+
+
+def normalize(text):
+    """Lower-case, strip accents and collapse punctuation to single spaces."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_ALNUM.sub(' ', text.lower()).strip()
+
+
+def make_entry(pk, name, level, gender, boarding, ward_id, county_id):
+    normalized = normalize(name)
+    return SchoolEntry(
+        pk, name, level, gender, boarding, ward_id, county_id,
+        normalized, tuple(sorted(set(normalized.split()))),
+    )
+
+
+class SchoolIndex:
+    """Token-prefix index over school names."""
+
+    def __init__(self, entries, version, keys=None):
+        self.version = version
+        self._entries = entries
+        if keys is None:
+            keys = sorted((token, entry.id) for entry in entries.values() for token in entry.tokens)
+        self._keys = keys
+        self._tokens = [token for token, _ in keys]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, school_id):
+        return self._entries.get(school_id)
+
+    def _prefix_ids(self, prefix):
+        lo = bisect.bisect_left(self._tokens, prefix)
+        hi = bisect.bisect_left(self._tokens, prefix + _PREFIX_END, lo)
+        return {school_id for _, school_id in self._keys[lo:hi]}
+
+    def search(self, query, county_id=None, near_county_id=None, limit=10):
+        """
+        Return up to ``limit`` entries whose name tokens start with every
+        query token, optionally restricted to ``county_id``.
+        """
+        normalized = normalize(query)
+        terms = normalized.split()
+        if not terms:
+            return []
+
+        # Drive the lookup with the longest term; it has the narrowest range.
+        driver = max(terms, key=len)
+        others = [term for term in terms if term != driver]
+
+        ranked = []
+        for school_id in self._prefix_ids(driver):
+            entry = self._entries[school_id]
+            if county_id is not None and entry.county_id != county_id:
+                continue
+            if not all(any(token.startswith(term) for token in entry.tokens) for term in others):
+                continue
+            ranked.append((
+                not entry.normalized.startswith(normalized),
+                near_county_id is None or entry.county_id != near_county_id,
+                entry.normalized,
+                entry.id,
+            ))
+
+        return [self._entries[key[-1]] for key in heapq.nsmallest(limit, ranked)]
+
+    # Copy-on-write updates so searches running in other threads never see
+    # a half-updated index.
+
+    def with_entry(self, entry):
+        index = self.without(entry.id)
+        entries = dict(index._entries)
+        entries[entry.id] = entry
+        keys = list(index._keys)
+        for token in entry.tokens:
+            bisect.insort(keys, (token, entry.id))
+        return SchoolIndex(entries, self.version, keys)
+
+    def without(self, school_id):
+        old = self._entries.get(school_id)
+        if old is None:
+            return self
+        entries = dict(self._entries)
+        del entries[school_id]
+        stale = {(token, school_id) for token in old.tokens}
+        keys = [key for key in self._keys if key not in stale]
+        return SchoolIndex(entries, self.version, keys)
+
+
+def compute_checksum():
+    stats = Schools.objects.aggregate(rows=Count('id'), last_id=Max('id'), last_update=Max('updated_at'))
+    return hashlib.sha1(f"{stats['rows']}:{stats['last_id']}:{stats['last_update']}".encode()).hexdigest()[:16]
+
+
+def _entry_for_row(gazetteer, row):
+    pk, name, level, gender, boarding, ward_id = row
+    return make_entry(pk, name, level, gender, boarding, ward_id, gazetteer.county_id_for_ward(ward_id))
+
+
+def load_school_index():
+    """Build a fresh :class:`SchoolIndex` from the database."""
+    version = compute_checksum()
+    gazetteer = get_gazetteer()
+    rows = Schools.objects.values_list('id', 'name', 'level__name', 'gender', 'boarding', 'ward_id')
+    entries = {row[0]: _entry_for_row(gazetteer, row) for row in rows.iterator()}
+    return SchoolIndex(entries, version)
+
+
+_lock = threading.Lock()
+_state = {'index': None, 'checked_at': 0.0}
+
+
+def get_school_index():
+    """Return the worker's school index, loading or revalidating it when needed."""
+    recheck_after = getattr(settings, 'SCHOOL_INDEX_RECHECK_SECONDS', 300)
+    index = _state['index']
+    if index is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+        return index
+
+    with _lock:
+        index = _state['index']
+        if index is not None and time.monotonic() - _state['checked_at'] < recheck_after:
+            return index
+
+        if index is None or compute_checksum() != index.version:
+            index = load_school_index()
+            _state['index'] = index
+        _state['checked_at'] = time.monotonic()
+        return index
+
+
+def update_school(school):
+    """Reflect a saved school in this worker's index, if it is loaded."""
+    with _lock:
+        index = _state['index']
+        if index is None:
+            return
+        row = (school.id, school.name, school.level.name, school.gender, school.boarding, school.ward_id)
+        index = index.with_entry(_entry_for_row(get_gazetteer(), row))
+        index.version = compute_checksum()
+        _state['index'] = index
+
+
+def remove_school(school_id):
+    """Drop a deleted school from this worker's index, if it is loaded."""
+    with _lock:
+        index = _state['index']
+        if index is None:
+            return
+        index = index.without(school_id)
+        index.version = compute_checksum()
+        _state['index'] = index
+
+
+def reset_school_index():
+    with _lock:
+        _state['index'] = None
+        _state['checked_at'] = 0.0
@@ -0,0 +1,52 @@
+"""
+Signals for keeping in-process caches in the home app fresh
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .demand_matrix import reset_demand_matrix
+from .gazetteer import reset_gazetteer
+from .models import Constituencies, Counties, FastSwap, Schools, Wards, subject_key_for
+from .school_index import remove_school, reset_school_index, update_school
+
+
+@receiver(post_save, sender=Counties)
+@receiver(post_save, sender=Constituencies)
+@receiver(post_save, sender=Wards)
+@receiver(post_delete, sender=Counties)
+@receiver(post_delete, sender=Constituencies)
+@receiver(post_delete, sender=Wards)
+def reset_gazetteer_on_place_change(sender, instance, **kwargs):
+    """
+    Drop the cached gazetteer when a county, constituency or ward changes.
+    Other workers pick the change up on their next checksum revalidation.
+    The school index caches each school's county and the demand matrix is
+    indexed by county, so both are dropped as well.
+    """
+    reset_gazetteer()
+    reset_school_index()
+    reset_demand_matrix()
+
+
+@receiver(post_save, sender=Schools)
+def update_school_index_on_save(sender, instance, **kwargs):
+    update_school(instance)
+
+
+@receiver(post_delete, sender=Schools)
+def update_school_index_on_delete(sender, instance, **kwargs):
+    remove_school(instance.id)
+
+
+@receiver(m2m_changed, sender=FastSwap.subjects.through)
+def sync_fast_swap_subject_key(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep FastSwap.subject_key in step with its subjects."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        fast_swap_ids = pk_set or ()
+    else:
+        fast_swap_ids = [instance.pk]
+    for fast_swap_id in fast_swap_ids:
+        subject_ids = FastSwap.subjects.through.objects.filter(fastswap_id=fast_swap_id).values_list('subject_id', flat=True)
+        FastSwap.objects.filter(pk=fast_swap_id).update(subject_key=subject_key_for(subject_ids))
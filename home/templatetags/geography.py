@@ -0,0 +1,22 @@
+from django import template
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from home.gazetteer import BUNDLE_PATH
+
+register = template.Library()
+
+
+@register.simple_tag
+def geography_bundle_url():
+    """
+    Static URL of the geography bundle, or an empty string when it has not
+    been built yet (the dropdown script then falls back to the JSON API).
+    """
+    if not finders.find(BUNDLE_PATH):
+        return ''
+    try:
+        return staticfiles_storage.url(BUNDLE_PATH)
+    except ValueError:
+        # Built but not collected yet, so there is no manifest entry.
+        return ''
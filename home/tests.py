@@ -1,9 +1,18 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
 from users.models import MyUser, PersonalProfile
-from home.models import Level, Schools, Counties, Constituencies, Wards, SwapPreference, Subject, MySubject, Curriculum
+from home.models import Level, Schools, Counties, Constituencies, Wards, SwapPreference, Subject, MySubject, Curriculum, MatchPair, PotentialMatchCount
 from home.matching import find_matches
+from home import error_log
+from home.middleware import ErrorHandlingMiddleware
+from home.models import ErrorLog
+
+class TeacherFixtureMixin:
+    """Levels, four counties with one school each, subjects and a teacher factory."""
 
-class MatchingLogicTests(TestCase):
     def setUp(self):
         # Setup basic data
         self.curriculum = Curriculum.objects.create(name="CBC", description="Competency Based Curriculum")
@@ -50,6 +59,8 @@ class MatchingLogicTests(TestCase):
             
         return user
 
+
+class MatchingLogicTests(TeacherFixtureMixin, TestCase):
     def test_primary_match_success(self):
         """
         Teacher A (Nairobi) wants Mombasa.
@@ -215,3 +226,532 @@ class MatchingLogicTests(TestCase):
         
         # Should find NO triangles
         self.assertEqual(len(triangles), 0)
+
+
+class GazetteerTests(TestCase):
+    def setUp(self):
+        from home.gazetteer import reset_gazetteer
+        reset_gazetteer()
+        self.county = Counties.objects.create(name="Nairobi")
+        self.westlands = Constituencies.objects.create(name="Westlands", county=self.county)
+        self.dagoretti = Constituencies.objects.create(name="Dagoretti North", county=self.county)
+        self.ward = Wards.objects.create(name="Parklands", constituency=self.westlands)
+
+    def test_hierarchy_lookups(self):
+        from home.gazetteer import get_gazetteer
+        gazetteer = get_gazetteer()
+        self.assertEqual([c.name for c in gazetteer.constituencies_for(self.county.id)], ["Dagoretti North", "Westlands"])
+        self.assertEqual([w.id for w in gazetteer.wards_for(str(self.westlands.id))], [self.ward.id])
+        self.assertEqual(gazetteer.county_id_for_ward(self.ward.id), self.county.id)
+        self.assertEqual(gazetteer.wards_for('not-a-number'), ())
+
+    def test_api_etag_and_not_modified(self):
+        response = self.client.get('/api/constituencies/', {'county': self.county.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        self.assertIn('max-age', response['Cache-Control'])
+
+        cached = self.client.get('/api/constituencies/', {'county': self.county.id}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_new_place_invalidates_gazetteer(self):
+        from home.gazetteer import get_gazetteer
+        before = get_gazetteer().version
+        Constituencies.objects.create(name="Kasarani", county=self.county)
+        after = get_gazetteer()
+        self.assertNotEqual(before, after.version)
+        self.assertEqual(len(after.constituencies_for(self.county.id)), 3)
+
+    def test_bundle_command_writes_columnar_hierarchy(self):
+        import json
+        import os
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        from home.gazetteer import BUNDLE_PATH
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            call_command('build_geography_bundle', output_dir=output_dir, stdout=StringIO())
+            with open(os.path.join(output_dir, BUNDLE_PATH)) as bundle_file:
+                bundle = json.load(bundle_file)
+
+        self.assertEqual(bundle['counties']['name'], ["Nairobi"])
+        self.assertEqual(bundle['constituencies']['name'], ["Dagoretti North", "Westlands"])
+        self.assertEqual(bundle['constituencies']['parent'], [self.county.id, self.county.id])
+        self.assertEqual(bundle['wards']['id'], [self.ward.id])
+
+
+class SchoolIndexTests(TestCase):
+    def setUp(self):
+        from home.gazetteer import reset_gazetteer
+        from home.school_index import reset_school_index
+        reset_gazetteer()
+        reset_school_index()
+        self.curriculum = Curriculum.objects.create(name="CBC", description="Competency Based Curriculum")
+        self.level = Level.objects.create(name="Secondary", code="SEC", curriculum=self.curriculum)
+        self.nairobi = Counties.objects.create(name="Nairobi")
+        self.kisumu = Counties.objects.create(name="Kisumu")
+        nairobi_ward = Wards.objects.create(name="Parklands", constituency=Constituencies.objects.create(name="Westlands", county=self.nairobi))
+        kisumu_ward = Wards.objects.create(name="Milimani", constituency=Constituencies.objects.create(name="Kisumu Central", county=self.kisumu))
+        self.nairobi_school = self.create_school("St. Mary's Girls High School", nairobi_ward)
+        self.kisumu_school = self.create_school("Kisumu Girls High School", kisumu_ward)
+        self.create_school("Maseno School", kisumu_ward)
+
+    def create_school(self, name, ward):
+        return Schools.objects.create(name=name, gender="Mixed", level=self.level, boarding="Day", curriculum=self.curriculum, postal_code="00100", ward=ward)
+
+    def test_token_prefix_search_and_ranking(self):
+        from home.school_index import get_school_index
+        index = get_school_index()
+        self.assertEqual([s.id for s in index.search("mary")], [self.nairobi_school.id])
+        self.assertEqual([s.id for s in index.search("girls hi")], [self.kisumu_school.id, self.nairobi_school.id])
+        self.assertEqual([s.id for s in index.search("girls", near_county_id=self.nairobi.id)], [self.nairobi_school.id, self.kisumu_school.id])
+        self.assertEqual([s.id for s in index.search("girls", county_id=self.kisumu.id)], [self.kisumu_school.id])
+        self.assertEqual(index.search("ary"), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        from home.school_index import get_school_index
+        get_school_index()
+        self.kisumu_school.name = "Kisumu Boys High School"
+        self.kisumu_school.save()
+        self.assertEqual([s.id for s in get_school_index().search("boys")], [self.kisumu_school.id])
+        self.assertEqual([s.id for s in get_school_index().search("girls")], [self.nairobi_school.id])
+        self.nairobi_school.delete()
+        self.assertEqual(get_school_index().search("girls"), [])
+
+    def test_search_view(self):
+        user = MyUser.objects.create_user(email='search@test.com', password='password')
+        self.client.force_login(user)
+        response = self.client.get('/schools/search/', {'q': 'maseno'})
+        schools = response.json()['schools']
+        self.assertEqual([s['name'] for s in schools], ["Maseno School"])
+        self.assertEqual(schools[0]['location'], "Milimani, Kisumu Central, Kisumu")
+
+
+class ProfileCountyDenormalizationTests(TeacherFixtureMixin, TestCase):
+    def test_current_county_follows_school(self):
+        teacher = self.create_teacher('county@test.com', self.primary_level, self.school_nairobi)
+        profile = PersonalProfile.objects.get(user=teacher)
+        self.assertEqual(profile.current_county_id, self.county_nairobi.id)
+
+        profile.school = self.school_mombasa
+        profile.save()
+        self.assertEqual(PersonalProfile.objects.get(pk=profile.pk).current_county_id, self.county_mombasa.id)
+
+        # Moving the school to another ward updates every profile at that school
+        self.school_mombasa.ward = self.ward_kisumu
+        self.school_mombasa.save()
+        profile = PersonalProfile.objects.get(pk=profile.pk)
+        self.assertEqual(
+            (profile.current_county_id, profile.current_constituency_id, profile.current_ward_id),
+            (self.county_kisumu.id, self.const_kisumu.id, self.ward_kisumu.id),
+        )
+
+    def test_sync_profile_locations_check_and_repair(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        teacher = self.create_teacher('drift@test.com', self.primary_level, self.school_nairobi)
+        PersonalProfile.objects.filter(user=teacher).update(current_ward=self.ward_mombasa)
+
+        with self.assertRaises(CommandError):
+            call_command('sync_profile_locations', check=True, stdout=StringIO())
+        call_command('sync_profile_locations', stdout=StringIO())
+        call_command('sync_profile_locations', check=True, stdout=StringIO())
+        self.assertEqual(PersonalProfile.objects.get(user=teacher).current_ward_id, self.ward_nairobi.id)
+
+    def test_explain_hot_queries_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('explain_hot_queries', stdout=out)
+        self.assertIn('swaps: active listings', out.getvalue())
+
+
+class CountyStatsTests(TeacherFixtureMixin, TestCase):
+    def stats(self, county, level):
+        from home.models import CountyStats
+        row = CountyStats.objects.filter(county=county, level=level).first()
+        return (row.teachers, row.inbound, row.outbound) if row else (0, 0, 0)
+
+    def test_rollup_follows_profile_and_preference_changes(self):
+        teacher = self.create_teacher('a@test.com', self.primary_level, self.school_nairobi,
+                                      desired_county=self.county_mombasa, open_to_all_counties=[self.county_kisumu, self.county_mombasa])
+        self.create_teacher('b@test.com', self.primary_level, self.school_mombasa)
+
+        self.assertEqual(self.stats(self.county_nairobi, self.primary_level), (1, 0, 1))
+        self.assertEqual(self.stats(self.county_mombasa, self.primary_level), (1, 1, 0))
+        self.assertEqual(self.stats(self.county_kisumu, self.primary_level), (0, 1, 0))
+
+        pref = SwapPreference.objects.get(user=teacher)
+        pref.open_to_all.clear()
+        pref.desired_county = self.county_nakuru
+        pref.save()
+        self.assertEqual(self.stats(self.county_mombasa, self.primary_level), (1, 0, 0))
+        self.assertEqual(self.stats(self.county_kisumu, self.primary_level), (0, 0, 0))
+        self.assertEqual(self.stats(self.county_nakuru, self.primary_level), (0, 1, 0))
+
+        profile = PersonalProfile.objects.get(user=teacher)
+        profile.school = self.school_mombasa
+        profile.save()
+        self.assertEqual(self.stats(self.county_nairobi, self.primary_level), (0, 0, 0))
+        self.assertEqual(self.stats(self.county_mombasa, self.primary_level), (2, 0, 1))
+
+        pref.delete()
+        self.assertEqual(self.stats(self.county_mombasa, self.primary_level), (2, 0, 0))
+        self.assertEqual(self.stats(self.county_nakuru, self.primary_level), (0, 0, 0))
+
+    def test_rebuild_matches_incremental_rollup(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from home.models import CountyStats
+        self.create_teacher('a@test.com', self.primary_level, self.school_nairobi,
+                            desired_county=self.county_mombasa, open_to_all_counties=[self.county_kisumu])
+        self.create_teacher('b@test.com', self.secondary_level, self.school_kisumu_sec, desired_county=self.county_nakuru)
+        call_command('rebuild_county_stats', check=True, stdout=StringIO())
+
+        CountyStats.objects.filter(county=self.county_nairobi).update(teachers=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_county_stats', check=True, stdout=StringIO())
+        call_command('rebuild_county_stats', stdout=StringIO())
+        self.assertEqual(self.stats(self.county_nairobi, self.primary_level), (1, 0, 1))
+        self.assertEqual(self.stats(self.county_nakuru, self.secondary_level), (0, 1, 0))
+
+
+class DemandMatrixTests(TeacherFixtureMixin, TestCase):
+    def tearDown(self):
+        from home.demand_matrix import reset_demand_matrix
+        reset_demand_matrix()
+
+    def cell(self, matrix, origin, destination, level=None):
+        level = level or self.primary_level
+        rows = matrix.matrix(level.id)
+        return int(rows[matrix.index[origin.id], matrix.index[destination.id]])
+
+    def test_matrix_counts_and_incremental_updates(self):
+        from home.demand_matrix import get_demand_matrix, load_demand_matrix, reset_demand_matrix
+        reset_demand_matrix()
+        teacher = self.create_teacher('a@test.com', self.primary_level, self.school_nairobi,
+                                      desired_county=self.county_mombasa, open_to_all_counties=[self.county_mombasa, self.county_kisumu])
+        self.create_teacher('b@test.com', self.primary_level, self.school_mombasa, desired_county=self.county_nairobi)
+
+        matrix = get_demand_matrix()
+        self.assertEqual(self.cell(matrix, self.county_nairobi, self.county_mombasa), 1)
+        self.assertEqual(self.cell(matrix, self.county_nairobi, self.county_kisumu), 1)
+        self.assertEqual(self.cell(matrix, self.county_mombasa, self.county_nairobi), 1)
+        self.assertEqual(int(matrix.matrix(self.secondary_level.id).sum()), 0)
+
+        pref = SwapPreference.objects.get(user=teacher)
+        pref.open_to_all.remove(self.county_kisumu)
+        pref.desired_county = self.county_nakuru
+        pref.save()
+        self.assertEqual(self.cell(matrix, self.county_nairobi, self.county_kisumu), 0)
+        self.assertEqual(self.cell(matrix, self.county_nairobi, self.county_nakuru), 1)
+        # Incremental updates agree with a fresh load
+        self.assertTrue((matrix.matrix(self.primary_level.id) == load_demand_matrix().matrix(self.primary_level.id)).all())
+
+        corridors = matrix.corridors(self.primary_level.id, order='mutual')
+        self.assertEqual(
+            {frozenset((from_id, to_id)) for from_id, to_id, *_ in corridors},
+            {frozenset((self.county_nairobi.id, self.county_mombasa.id))},
+        )
+
+    def test_cycle_counties_and_api(self):
+        from home.demand_matrix import get_demand_matrix
+        self.create_teacher('a@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_mombasa)
+        self.create_teacher('b@test.com', self.primary_level, self.school_mombasa, desired_county=self.county_kisumu)
+        kisumu_pri = Schools.objects.create(name="Kisumu Pri", gender="Mixed", level=self.primary_level, boarding="Day",
+                                            curriculum=self.curriculum, postal_code="40100", ward=self.ward_kisumu)
+        self.create_teacher('c@test.com', self.primary_level, kisumu_pri, desired_county=self.county_nairobi)
+        self.create_teacher('d@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_nakuru)
+
+        self.assertEqual(get_demand_matrix().cycle_counties(self.primary_level.id),
+                         {self.county_nairobi.id, self.county_mombasa.id, self.county_kisumu.id})
+
+        self.assertEqual(self.client.get('/api/demand/corridors/', {'level': self.primary_level.id}).status_code, 403)
+        admin = MyUser.objects.create_user(email='admin@test.com', password='password', is_staff=True)
+        self.client.force_login(admin)
+        response = self.client.get('/api/demand/matrix/', {
+            'level': self.primary_level.id, 'origins': self.county_nairobi.id,
+            'destinations': f'{self.county_mombasa.id},{self.county_nakuru.id}',
+        })
+        self.assertEqual(response.json()['matrix'], [[1, 1]])
+        response = self.client.get('/api/demand/corridors/', {'level': self.primary_level.id, 'limit': 2})
+        self.assertEqual(len(response.json()['corridors']), 2)
+        self.assertEqual(self.client.get('/api/demand/corridors/', {'level': 'x'}).status_code, 400)
+
+
+class TriangleSnapshotTests(TeacherFixtureMixin, TestCase):
+    def create_secondary_teacher(self, email, school, desired_county, subjects):
+        teacher = self.create_teacher(email, self.secondary_level, school, desired_county=desired_county)
+        MySubject.objects.create(user=teacher).subject.set(subjects)
+        return teacher
+
+    def test_snapshot_matches_live_search(self):
+        from home.models import TriangleSwap
+        from home.triangle_snapshots import refresh_triangle_snapshot
+        from home.triangle_swap_utils import find_triangle_swaps_secondary
+        school_mombasa_sec = Schools.objects.create(name="Mombasa High", gender="Mixed", level=self.secondary_level, boarding="Boarding", curriculum=self.curriculum, postal_code="80100", ward=self.ward_mombasa)
+        teacher_a = self.create_secondary_teacher('a@test.com', self.school_kisumu_sec, self.county_nakuru, [self.math, self.chem])
+        teacher_b = self.create_secondary_teacher('b@test.com', self.school_nakuru_sec, self.county_mombasa, [self.math, self.chem])
+        teacher_c = self.create_secondary_teacher('c@test.com', school_mombasa_sec, self.county_kisumu, [self.math, self.chem])
+        # Same loop with a different combination: not part of any triangle
+        self.create_secondary_teacher('d@test.com', self.school_nakuru_sec, self.county_mombasa, [self.math, self.eng])
+        # Nairobi is on no demand cycle, so this teacher is pruned
+        self.create_secondary_teacher('e@test.com', school_mombasa_sec, self.county_nairobi, [self.math, self.chem])
+
+        snapshot = refresh_triangle_snapshot(self.secondary_level)
+        self.assertEqual(snapshot.triangle_count, 1)
+        self.assertEqual(snapshot.teacher_count, 5)
+        row = TriangleSwap.objects.get(snapshot=snapshot)
+        self.assertEqual({row.teacher_a_id, row.teacher_b_id, row.teacher_c_id}, {teacher_a.id, teacher_b.id, teacher_c.id})
+        self.assertEqual(row.subject_key, PersonalProfile.subject_key_for([self.math.id, self.chem.id]))
+
+        live = find_triangle_swaps_secondary(MyUser.objects.filter(profile__school__level=self.secondary_level))
+        self.assertEqual(len(live), 1)
+
+        # A refresh replaces the previous rows
+        SwapPreference.objects.filter(user=teacher_c).update(desired_county=self.county_nairobi)
+        self.assertEqual(refresh_triangle_snapshot(self.secondary_level).triangles.count(), 0)
+
+
+class MutualPairTests(TeacherFixtureMixin, TestCase):
+    def test_pairs_need_both_directions_and_a_common_subject(self):
+        from home.pair_matching import mask_subject_ids, mutual_pairs
+        teacher_a = self.create_teacher('a@test.com', self.secondary_level, self.school_kisumu_sec, desired_county=self.county_nakuru)
+        MySubject.objects.create(user=teacher_a).subject.set([self.math, self.chem])
+        # Wants Kisumu through open_to_all, shares Chemistry
+        teacher_b = self.create_teacher('b@test.com', self.secondary_level, self.school_nakuru_sec, open_to_all_counties=[self.county_kisumu])
+        MySubject.objects.create(user=teacher_b).subject.set([self.chem, self.eng])
+        # Right counties, no common subject
+        teacher_c = self.create_teacher('c@test.com', self.secondary_level, self.school_nakuru_sec, desired_county=self.county_kisumu)
+        MySubject.objects.create(user=teacher_c).subject.set([self.eng])
+        # Wrong direction
+        self.create_teacher('d@test.com', self.secondary_level, self.school_nakuru_sec, desired_county=self.county_mombasa)
+
+        pairs, subject_ids = mutual_pairs(self.secondary_level, by_subjects=True)
+        self.assertEqual([(a, b) for a, b, *_ in pairs], [(teacher_a.id, teacher_b.id)])
+        self.assertEqual(mask_subject_ids(pairs[0][4], subject_ids), [self.chem.id])
+
+        pairs, _ = mutual_pairs(self.secondary_level, by_subjects=False)
+        self.assertEqual({(a, b) for a, b, *_ in pairs}, {(teacher_a.id, teacher_b.id), (teacher_a.id, teacher_c.id)})
+
+
+class LevelMatchServiceTests(TeacherFixtureMixin, TestCase):
+    def test_primary_perfect_and_partial_matches(self):
+        from users.templatetags.match_helpers import get_primary_teacher_matches
+        user = self.create_teacher('me@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_mombasa)
+        perfect = self.create_teacher('p@test.com', self.primary_level, self.school_mombasa, open_to_all_counties=[self.county_nairobi])
+        partial = self.create_teacher('q@test.com', self.primary_level, self.school_mombasa, desired_county=self.county_kisumu)
+        self.create_teacher('r@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_kisumu)
+
+        user = MyUser.objects.get(pk=user.pk)
+        perfect_matches, partial_matches = get_primary_teacher_matches(user)
+        self.assertEqual([m.id for m in perfect_matches], [perfect.id])
+        self.assertEqual([m.id for m in partial_matches], [partial.id])
+
+    def test_secondary_matches_need_a_shared_subject(self):
+        from users.templatetags.match_helpers import get_secondary_teacher_matches
+        user = self.create_teacher('me@test.com', self.secondary_level, self.school_kisumu_sec, desired_county=self.county_nakuru)
+        MySubject.objects.create(user=user).subject.set([self.math, self.chem])
+        shared = self.create_teacher('s@test.com', self.secondary_level, self.school_nakuru_sec, desired_county=self.county_kisumu)
+        MySubject.objects.create(user=shared).subject.set([self.chem])
+        other = self.create_teacher('o@test.com', self.secondary_level, self.school_nakuru_sec, desired_county=self.county_kisumu)
+        MySubject.objects.create(user=other).subject.set([self.eng])
+
+        perfect_matches, partial_matches = get_secondary_teacher_matches(MyUser.objects.get(pk=user.pk))
+        self.assertEqual([m.id for m in perfect_matches], [shared.id])
+        self.assertEqual(partial_matches, [])
+
+    def test_matches_are_memoized_per_request(self):
+        from django.test import RequestFactory
+        from users.templatetags.match_helpers import memoized_matches
+        request = RequestFactory().get('/')
+        request.user = self.create_teacher('me@test.com', self.primary_level, self.school_nairobi)
+        calls = []
+
+        def compute(user):
+            calls.append(user.pk)
+            return [], []
+
+        memoized_matches(request, 'primary', compute)
+        memoized_matches(request, 'primary', compute)
+        self.assertEqual(calls, [request.user.pk])
+
+
+class MatchPairTests(TeacherFixtureMixin, TestCase):
+    def stored_pairs(self):
+        return set(MatchPair.objects.values_list('user_id', 'partner_id'))
+
+    def test_pairs_and_counters_follow_changes(self):
+        a = self.create_teacher('a@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_mombasa)
+        b = self.create_teacher('b@test.com', self.primary_level, self.school_mombasa, open_to_all_counties=[self.county_nairobi])
+        self.assertEqual(self.stored_pairs(), {(a.id, b.id), (b.id, a.id)})
+        self.assertEqual(PotentialMatchCount.objects.get(user=a).count, 1)
+
+        preference = SwapPreference.objects.get(user=a)
+        preference.desired_county = self.county_kisumu
+        preference.save()
+        self.assertEqual(self.stored_pairs(), set())
+        self.assertFalse(PotentialMatchCount.objects.exists())
+
+        preference.desired_county = self.county_mombasa
+        preference.save()
+        b.is_active = False
+        b.save()
+        self.assertEqual(self.stored_pairs(), set())
+
+    def test_secondary_pairs_need_a_shared_subject(self):
+        a = self.create_teacher('a@test.com', self.secondary_level, self.school_kisumu_sec, desired_county=self.county_nakuru)
+        b = self.create_teacher('b@test.com', self.secondary_level, self.school_nakuru_sec, desired_county=self.county_kisumu)
+        MySubject.objects.create(user=a).subject.set([self.math])
+        MySubject.objects.create(user=b).subject.set([self.eng])
+        self.assertEqual(self.stored_pairs(), set())
+
+        MySubject.objects.get(user=b).subject.add(self.math)
+        self.assertEqual(self.stored_pairs(), {(a.id, b.id), (b.id, a.id)})
+
+    def test_rebuild_matches_incremental_pairs(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        a = self.create_teacher('a@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_mombasa)
+        self.create_teacher('b@test.com', self.primary_level, self.school_mombasa, desired_county=self.county_nairobi)
+        self.create_teacher('c@test.com', self.primary_level, self.school_mombasa, open_to_all_counties=[self.county_nairobi])
+        call_command('rebuild_match_pairs', '--check', stdout=StringIO())
+
+        incremental = self.stored_pairs()
+        MatchPair.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_match_pairs', '--check', stdout=StringIO())
+        call_command('rebuild_match_pairs', stdout=StringIO())
+        self.assertEqual(self.stored_pairs(), incremental)
+        self.assertEqual(PotentialMatchCount.objects.get(user=a).count, 2)
+
+
+class ExportTests(TeacherFixtureMixin, TestCase):
+    def test_teacher_export_merges_open_to_all(self):
+        import csv
+        import json
+        from home.exports import stream_export
+        self.create_teacher('a@test.com', self.primary_level, self.school_nairobi, desired_county=self.county_mombasa)
+        self.create_teacher('b@test.com', self.primary_level, self.school_mombasa,
+                            open_to_all_counties=[self.county_nairobi, self.county_kisumu])
+        self.create_teacher('c@test.com', self.primary_level, self.school_mombasa)
+
+        rows = list(csv.DictReader(''.join(stream_export('teachers', 'csv')).splitlines()))
+        self.assertEqual([(row['email'], row['county'], row['desired_county'], row['open_to_all']) for row in rows], [
+            ('a@test.com', 'Nairobi', 'Mombasa', ''),
+            ('b@test.com', 'Mombasa', '', 'Kisumu; Nairobi'),
+            ('c@test.com', 'Mombasa', '', ''),
+        ])
+
+        lines = ''.join(stream_export('pairs', 'jsonl')).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'level': 'Primary', 'teacher_a': 'a@test.com', 'county_a': 'Nairobi',
+            'teacher_b': 'b@test.com', 'county_b': 'Mombasa',
+        }])
+
+    def test_export_command_writes_file(self):
+        import os
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        self.create_teacher('a@test.com', self.primary_level, self.school_nairobi)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'teachers.jsonl')
+            call_command('export_data', 'teachers', format='jsonl', output=path, stderr=StringIO())
+            with open(path, encoding='utf-8') as exported:
+                self.assertIn('"email": "a@test.com"', exported.read())
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    ERROR_LOG_FLUSH_SECONDS=60,
+    ERROR_LOG_FLUSH_SIZE=100,
+)
+class ErrorLogBufferTests(TestCase):
+    def setUp(self):
+        error_log.flush_errors()
+        ErrorLog.objects.all().delete()
+        self.addCleanup(error_log.flush_errors)
+
+    def request(self, path='/boom/'):
+        request = RequestFactory().get(path)
+        request.user = AnonymousUser()
+        return request
+
+    def raise_error(self, request, message='boom'):
+        try:
+            raise ValueError(message)
+        except ValueError as e:
+            return ErrorHandlingMiddleware(lambda request: None).process_exception(request, e)
+
+    def test_repeats_are_counted_on_one_row(self):
+        for n in range(3):
+            response = self.raise_error(self.request(), f'boom {n}')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(ErrorLog.objects.exists())
+
+        self.assertEqual(error_log.flush_errors(), 1)
+        row = ErrorLog.objects.get()
+        self.assertEqual((row.error_type, row.occurrences, row.exception_type), ('exception', 3, 'ValueError'))
+        self.assertIn('raise ValueError', row.traceback)
+
+        self.raise_error(self.request())
+        self.raise_error(self.request('/other/'))
+        error_log.flush_errors()
+        self.assertEqual(ErrorLog.objects.get(request_path='/boom/').occurrences, 4)
+        self.assertEqual(ErrorLog.objects.count(), 2)
+
+    def test_resolved_errors_that_come_back_get_a_new_row(self):
+        self.raise_error(self.request())
+        error_log.flush_errors()
+        ErrorLog.objects.get().mark_resolved()
+        self.raise_error(self.request())
+        error_log.flush_errors()
+        self.assertEqual(list(ErrorLog.objects.order_by('id').values_list('resolved', 'occurrences')),
+                         [(True, 1), (False, 1)])
+
+    def test_size_threshold_flushes(self):
+        with override_settings(ERROR_LOG_FLUSH_SIZE=2):
+            self.raise_error(self.request())
+            self.assertFalse(ErrorLog.objects.exists())
+            self.raise_error(self.request())
+        self.assertEqual(ErrorLog.objects.get().occurrences, 2)
+
+    def test_failed_flush_keeps_the_counts(self):
+        self.raise_error(self.request())
+        with mock.patch.object(ErrorLog.objects, 'bulk_create', side_effect=RuntimeError('db down')):
+            self.assertEqual(error_log.flush_errors(), 0)
+        self.assertIsNotNone(error_log._timer)
+
+        self.raise_error(self.request())
+        self.raise_error(self.request('/other/'))
+        self.assertEqual(error_log.flush_errors(), 2)
+        self.assertEqual(ErrorLog.objects.get(request_path='/boom/').occurrences, 2)
+        self.assertEqual(ErrorLog.objects.get(request_path='/other/').occurrences, 1)
+
+    def test_buffer_is_capped(self):
+        with override_settings(ERROR_LOG_MAX_BUFFERED=1):
+            self.raise_error(self.request())
+            self.raise_error(self.request('/other/'))
+            self.raise_error(self.request())
+        error_log.flush_errors()
+        self.assertEqual(list(ErrorLog.objects.values_list('request_path', 'occurrences')), [('/boom/', 2)])
+
+    def test_sampling_weights_kept_errors(self):
+        with override_settings(ERROR_LOG_SAMPLE_RATES={'not_found': 0.25}), \
+                mock.patch('home.error_log.random.random', side_effect=[0.1, 0.9, 0.9, 0.9]):
+            for _ in range(4):
+                error_log.record_error(self.request('/missing/'), 'not_found', 404)
+        error_log.flush_errors()
+        self.assertEqual(ErrorLog.objects.get().occurrences, 4)
+
+    def test_not_found_is_not_turned_into_a_server_error(self):
+        request = self.request()
+        self.assertIsNone(ErrorHandlingMiddleware(lambda request: None).process_exception(request, Http404()))
+        self.assertEqual(self.client.get('/no-such-page/').status_code, 404)
+        error_log.flush_errors()
+        self.assertEqual(ErrorLog.objects.get().error_type, 'not_found')
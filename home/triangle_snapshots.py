@@ -0,0 +1,140 @@
+"""
+Precomputed triangle swap listings.
+
+The staff triangle pages read TriangleSwap rows from the level's
+TriangleSnapshot instead of searching on every request.
+``refresh_triangle_snapshot`` rebuilds a level:
+
+1. load the candidates as plain ids (current county, wanted counties, subject
+   key): three queries, whatever the pool size
+2. drop teachers outside the counties that lie on a three-county cycle of the
+   level's demand matrix (per subject signature for secondary), since no
+   triangle can pass through them
+3. run ``find_triangles`` and swap the snapshot rows in one transaction
+
+Refreshes run from the ``refresh_triangle_swaps`` command (cron), or in a
+background thread when staff press refresh (``TRIANGLE_REFRESH_IN_PROCESS``,
+on by default).
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .demand_matrix import DemandMatrix, destination_ids
+from .gazetteer import get_gazetteer
+from .models import TriangleSnapshot, TriangleSwap
+from .triangle_swap_utils import find_triangles
+
+logger = logging.getLogger(__name__)
+
+
+def level_uses_subjects(level):
+    """Secondary/high school triangles also need the same subject combination."""
+    name = level.name.lower()
+    return 'secondary' in name or 'high' in name
+
+
+def triangle_candidates(level, by_subjects):
+    """``{user_id: (current_county_id, wanted_county_ids, group)}`` for a level."""
+    from users.models import PersonalProfile
+
+    profiles = PersonalProfile.objects.filter(
+        user__is_active=True,
+        user__role='Teacher',
+        school__level=level,
+        current_county__isnull=False,
+        user__swappreference__isnull=False,
+    ).values_list('user_id', 'current_county_id', 'subject_key')
+    rows = list(profiles)
+    wanted = destination_ids([user_id for user_id, _, _ in rows])
+    return {
+        user_id: (county_id, wanted.get(user_id, set()), subject_key if by_subjects else '')
+        for user_id, county_id, subject_key in rows
+        if wanted.get(user_id)
+    }
+
+
+def prune_to_cycles(level, nodes):
+    """Keep only teachers whose county lies on a demand cycle of their group."""
+    matrix = DemandMatrix([county.id for county in get_gazetteer().counties()], {}, version='')
+    for user_id, (county_id, wanted, group) in nodes.items():
+        contribution = matrix.contribution_for(level.id, group, county_id, wanted)
+        if contribution is not None:
+            matrix._contributions[user_id] = contribution
+
+    cycle_counties = {}
+    for group in {group for _, _, group in nodes.values()}:
+        cycle_counties[group] = matrix.cycle_counties(level.id, group)
+    return {
+        user_id: node for user_id, node in nodes.items()
+        if node[0] in cycle_counties[node[2]]
+    }
+
+
+def refresh_triangle_snapshot(level):
+    """Recompute the triangle listing for a level. Returns the snapshot."""
+    started = time.monotonic()
+    nodes = triangle_candidates(level, level_uses_subjects(level))
+    teacher_count = len(nodes)
+    nodes = prune_to_cycles(level, nodes)
+
+    rows = [
+        TriangleSwap(
+            teacher_a_id=a, teacher_b_id=b, teacher_c_id=c,
+            county_a_id=nodes[a][0], county_b_id=nodes[b][0], county_c_id=nodes[c][0],
+            subject_key=nodes[a][2],
+        )
+        for a, b, c in find_triangles(nodes)
+    ]
+
+    with transaction.atomic():
+        snapshot, _ = TriangleSnapshot.objects.select_for_update().get_or_create(level=level)
+        snapshot.triangles.all().delete()
+        for row in rows:
+            row.snapshot = snapshot
+        TriangleSwap.objects.bulk_create(rows, batch_size=1000)
+        snapshot.computed_at = timezone.now()
+        snapshot.teacher_count = teacher_count
+        snapshot.triangle_count = len(rows)
+        snapshot.duration_ms = int((time.monotonic() - started) * 1000)
+        snapshot.save()
+    return snapshot
+
+
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _refresh_in_background(level):
+    with _running_lock:
+        if level.id in _running:
+            return
+        _running.add(level.id)
+    try:
+        refresh_triangle_snapshot(level)
+    except Exception:
+        logger.exception('Triangle snapshot refresh failed for level %s', level.id)
+    finally:
+        with _running_lock:
+            _running.discard(level.id)
+        close_old_connections()
+
+
+def request_triangle_refresh(level):
+    """
+    Record that staff want fresh triangles for a level and, unless disabled,
+    start the refresh in a background thread once the request commits.
+    """
+    snapshot, _ = TriangleSnapshot.objects.get_or_create(level=level)
+    snapshot.requested_at = timezone.now()
+    snapshot.save(update_fields=['requested_at'])
+
+    if getattr(settings, 'TRIANGLE_REFRESH_IN_PROCESS', True):
+        transaction.on_commit(
+            lambda: threading.Thread(target=_refresh_in_background, args=(level,), daemon=True).start()
+        )
+    return snapshot
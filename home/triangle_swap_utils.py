@@ -14,17 +14,18 @@ from home.models import Level, MySubject
 
 
 def get_current_county(user):
-    """Get the current county where a teacher is teaching."""
+    """
+    Get the current county where a teacher is teaching, from the denormalized
+    ``PersonalProfile.current_county`` (select_related
+    ``profile__current_county`` to avoid a query per teacher).
+    """
     if not hasattr(user, 'profile') or not user.profile:
         return None
     
-    if not user.profile.school or not user.profile.school.ward:
+    if not user.profile.school_id or not user.profile.current_county_id:
         return None
     
-    try:
-        return user.profile.school.ward.constituency.county
-    except:
-        return None
+    return user.profile.current_county
 
 
 def wants_county(user, target_county):
@@ -67,6 +68,44 @@ def have_same_subjects(user1, user2):
 
 
 
+def find_triangles(nodes):
+    """
+    Triangle search on plain ids, without touching the database.
+
+    ``nodes`` maps ``user_id -> (current_county_id, wanted_county_ids, group)``.
+    Only teachers in the same group form a triangle (a constant for primary,
+    the subject combination key for secondary). Wanting one's own county is
+    not a move and is ignored.
+
+    Returns ``[(a_id, b_id, c_id), ...]`` where A wants B's county, B wants
+    C's county and C wants A's county; each set of three teachers appears once.
+    """
+    teachers_by_county = {}
+    for user_id in sorted(nodes):
+        county_id, _, group = nodes[user_id]
+        teachers_by_county.setdefault((group, county_id), []).append(user_id)
+
+    triangles = []
+    seen = set()
+    for a in sorted(nodes):
+        county_a, wanted_a, group = nodes[a]
+        for county_b in sorted(wanted_a):
+            if county_b == county_a:
+                continue
+            for b in teachers_by_county.get((group, county_b), ()):
+                for county_c in sorted(nodes[b][1]):
+                    if county_c in (county_a, county_b):
+                        continue
+                    for c in teachers_by_county.get((group, county_c), ()):
+                        if county_a not in nodes[c][1]:
+                            continue
+                        key = tuple(sorted((a, b, c)))
+                        if key not in seen:
+                            seen.add(key)
+                            triangles.append((a, b, c))
+    return triangles
+
+
 def find_triangle_swaps_primary(teachers_queryset):
     """
     Find triangle swaps for PRIMARY level teachers.
@@ -2,7 +2,7 @@ from django.urls import path
 from django.contrib.auth.decorators import login_required
 
 from . import views, views_schools
-from .api_views import ConstituencyAPIView, WardAPIView
+from .api_views import ConstituencyAPIView, DemandCorridorsAPIView, DemandMatrixAPIView, WardAPIView
 from .error_views import error_page
 
 app_name = 'home'
@@ -33,6 +33,8 @@ urlpatterns = [
     # API endpoints
     path("api/constituencies/", ConstituencyAPIView.as_view(), name="api_constituencies"),
     path("api/wards/", WardAPIView.as_view(), name="api_wards"),
+    path("api/demand/matrix/", DemandMatrixAPIView.as_view(), name="api_demand_matrix"),
+    path("api/demand/corridors/", DemandCorridorsAPIView.as_view(), name="api_demand_corridors"),
     
     # Swap preferences
     
@@ -16,6 +16,9 @@ from .models import (Bookmark, Constituencies, Counties, FastSwap, Level, MySubj
                      Schools, Subject, SwapPreference, SwapRequests, Swaps,
                      User, Wards)
 from .google_forms_handler import process_google_form_submission
+from .gazetteer import get_gazetteer
+from .api_views import geography_response, places_as_dicts
+from payments.entitlements import entitlement_for
 
 logger = logging.getLogger(__name__)
 
@@ -73,7 +76,7 @@ def create_school(request):
         return redirect('home:home')
 
     # Get all counties for the template
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get selected values from POST/GET data for form repopulation
     selected_county = request.POST.get('county')
@@ -105,18 +108,18 @@ def create_school(request):
         form = SchoolForm()
     
     # Get constituencies and wards based on selected values for form repopulation
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if selected_county:
         try:
             county_id = int(selected_county)
-            constituencies = Constituencies.objects.filter(county_id=county_id).order_by('name')
+            constituencies = get_gazetteer().constituencies_for(county_id)
             
             if selected_constituency:
                 try:
                     constituency_id = int(selected_constituency)
-                    wards = Wards.objects.filter(constituency_id=constituency_id).order_by('name')
+                    wards = get_gazetteer().wards_for(constituency_id)
                 except (ValueError, TypeError):
                     pass
         except (ValueError, TypeError):
@@ -142,8 +145,7 @@ def create_school(request):
 def get_wards(request):
     """API endpoint to get wards for a given constituency."""
     constituency_id = request.GET.get('constituency_id')
-    wards = Wards.objects.filter(constituency_id=constituency_id).order_by('name')
-    ward_list = [{'id': ward.id, 'name': ward.name} for ward in wards]
+    ward_list = places_as_dicts(get_gazetteer().wards_for(constituency_id))
     return JsonResponse({'wards': ward_list})
 
 
@@ -355,25 +357,25 @@ def all_swaps(request):
         user_subjects[mysubject.user_id].extend(list(mysubject.subject.all()))
     
     # Get all counties for the filter dropdown
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get selected county and its constituencies if a county is selected
     selected_county_obj = None
     # Initialize as empty querysets instead of empty lists
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if selected_county and selected_county.isdigit():
-        selected_county_obj = Counties.objects.filter(id=selected_county).first()
+        selected_county_obj = get_gazetteer().county(selected_county)
         if selected_county_obj:
-            constituencies = Constituencies.objects.filter(county=selected_county_obj).order_by('name')
+            constituencies = get_gazetteer().constituencies_for(selected_county_obj.id)
     
     # Get selected constituency and its wards if a constituency is selected
     selected_constituency_obj = None
     if selected_constituency and selected_constituency.isdigit():
-        selected_constituency_obj = Constituencies.objects.filter(id=selected_constituency).first()
+        selected_constituency_obj = get_gazetteer().constituency(selected_constituency)
         if selected_constituency_obj:
-            wards = Wards.objects.filter(constituency=selected_constituency_obj).order_by('name')
+            wards = get_gazetteer().wards_for(selected_constituency_obj.id)
     
     context = {
         'swaps': swaps,
@@ -588,21 +590,21 @@ def primary_swaps(request):
         user_subjects[mysubject.user_id].extend(list(mysubject.subject.all()))
     
     # Get all counties for the filter dropdown
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get constituencies and wards based on selection
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if selected_county and selected_county.isdigit():
-        selected_county_obj = Counties.objects.filter(id=selected_county).first()
+        selected_county_obj = get_gazetteer().county(selected_county)
         if selected_county_obj:
-            constituencies = Constituencies.objects.filter(county=selected_county_obj).order_by('name')
+            constituencies = get_gazetteer().constituencies_for(selected_county_obj.id)
     
     if selected_constituency and selected_constituency.isdigit():
-        selected_constituency_obj = Constituencies.objects.filter(id=selected_constituency).first()
+        selected_constituency_obj = get_gazetteer().constituency(selected_constituency)
         if selected_constituency_obj:
-            wards = Wards.objects.filter(constituency=selected_constituency_obj).order_by('name')
+            wards = get_gazetteer().wards_for(selected_constituency_obj.id)
     
     # Prepare swaps data with matching scores
     swaps_data = []
@@ -834,21 +836,21 @@ def secondary_swaps(request):
         user_subject_ids[mysubject.user_id].update(s.id for s in subjects_list)
     
     # Get all counties for the filter dropdown
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get constituencies and wards based on selection
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if selected_county and selected_county.isdigit():
-        selected_county_obj = Counties.objects.filter(id=selected_county).first()
+        selected_county_obj = get_gazetteer().county(selected_county)
         if selected_county_obj:
-            constituencies = Constituencies.objects.filter(county=selected_county_obj).order_by('name')
+            constituencies = get_gazetteer().constituencies_for(selected_county_obj.id)
     
     if selected_constituency and selected_constituency.isdigit():
-        selected_constituency_obj = Constituencies.objects.filter(id=selected_constituency).first()
+        selected_constituency_obj = get_gazetteer().constituency(selected_constituency)
         if selected_constituency_obj:
-            wards = Wards.objects.filter(constituency=selected_constituency_obj).order_by('name')
+            wards = get_gazetteer().wards_for(selected_constituency_obj.id)
     
     # Prepare swaps data with matching scores
     swaps_data = []
@@ -1009,9 +1011,7 @@ def swap_detail(request, swap_id):
     is_owner = (user.is_authenticated and user == swap.user)
     
     # Check if the current user has an active subscription
-    has_active_subscription = False
-    if user.is_authenticated and hasattr(user, 'my_subscription'):
-        has_active_subscription = user.my_subscription.is_active  # Remove parentheses as it's a property
+    has_active_subscription = entitlement_for(request).is_active
     
     # Get the user's profile information if available
     user_profile = None
@@ -1057,12 +1057,10 @@ def fast_swap_detail(request, fastswap_id):
     user = request.user
     
     # Check if the current user has an active subscription
-    has_active_subscription = False
+    has_active_subscription = entitlement_for(request).is_active
     is_admin = False
     if user.is_authenticated:
         is_admin = user.is_superuser or user.is_staff
-        if hasattr(user, 'my_subscription'):
-            has_active_subscription = user.my_subscription.is_active
     
     # Mask contact info for non-subscribers
     show_contact = is_admin or has_active_subscription
@@ -1304,7 +1302,7 @@ def edit_school(request, school_id):
         form = SchoolForm(instance=school)
     
     # Get all counties for the template
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Set the selected values for the form
     selected_county = school.ward.constituency.county_id if school.ward else None
@@ -1312,13 +1310,13 @@ def edit_school(request, school_id):
     selected_ward = school.ward_id if school.ward else None
     
     # Get constituencies and wards based on selected values
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if selected_county:
-        constituencies = Constituencies.objects.filter(county_id=selected_county).order_by('name')
+        constituencies = get_gazetteer().constituencies_for(selected_county)
         if selected_constituency:
-            wards = Wards.objects.filter(constituency_id=selected_constituency).order_by('name')
+            wards = get_gazetteer().wards_for(selected_constituency)
     
     return render(request, 'home/school_form.html', {
         'form': form,
@@ -1361,13 +1359,9 @@ def get_constituencies(request):
     if not county_id:
         return JsonResponse({'error': 'County ID is required'}, status=400)
     
-    try:
-        constituencies = list(Constituencies.objects.filter(
-            county_id=county_id
-        ).order_by('name').values('id', 'name'))
-        return JsonResponse({'constituencies': constituencies})
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+    gazetteer = get_gazetteer()
+    constituencies = places_as_dicts(gazetteer.constituencies_for(county_id))
+    return geography_response(request, gazetteer, f'county-{county_id}', {'constituencies': constituencies})
 
 
 def get_wards(request):
@@ -1376,13 +1370,9 @@ def get_wards(request):
     if not constituency_id:
         return JsonResponse({'error': 'Constituency ID is required'}, status=400)
     
-    try:
-        wards = list(Wards.objects.filter(
-            constituency_id=constituency_id
-        ).order_by('name').values('id', 'name'))
-        return JsonResponse({'wards': wards})
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+    gazetteer = get_gazetteer()
+    wards = places_as_dicts(gazetteer.wards_for(constituency_id))
+    return geography_response(request, gazetteer, f'constituency-{constituency_id}', {'wards': wards})
 
 
 @login_required
@@ -1450,19 +1440,19 @@ def fast_swap_list(request):
         fast_swaps = fast_swaps.filter(current_ward_id=ward_id)
     
     # Get all counties for the filter dropdown
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get all levels for the filter dropdown
     levels = Level.objects.all().order_by('name')
     
     # Get constituencies and wards if filters are applied
-    constituencies = Constituencies.objects.none()
-    wards = Wards.objects.none()
+    constituencies = ()
+    wards = ()
     
     if county_id:
-        constituencies = Constituencies.objects.filter(county_id=county_id).order_by('name')
+        constituencies = get_gazetteer().constituencies_for(county_id)
     if constituency_id:
-        wards = Wards.objects.filter(constituency_id=constituency_id).order_by('name')
+        wards = get_gazetteer().wards_for(constituency_id)
     
     # Get bookmarked FastSwap IDs for the current user (use list for template compatibility)
     bookmarked_ids = []
@@ -1511,7 +1501,7 @@ def swap_preferences(request):
         form = SwapPreferenceForm(instance=preference)
         
     # Get all counties for the template
-    counties = Counties.objects.all().order_by('name')
+    counties = get_gazetteer().counties()
     
     # Get selected values for form repopulation
     selected_county = preference.desired_county.id if preference.desired_county else None
@@ -1520,13 +1510,8 @@ def swap_preferences(request):
     selected_counties = list(preference.open_to_all.values_list('id', flat=True)) if preference.pk else []
     
     # Get constituencies and wards based on selected values
-    constituencies = Constituencies.objects.none()
-    if preference.desired_county:
-        constituencies = preference.desired_county.constituencies_set.order_by('name')
-    
-    wards = Wards.objects.none()
-    if preference.desired_constituency:
-        wards = preference.desired_constituency.wards_set.order_by('name')
+    constituencies = get_gazetteer().constituencies_for(preference.desired_county_id)
+    wards = get_gazetteer().wards_for(preference.desired_constituency_id)
     
     return render(request, 'home/swap_preferences.html', {
         'form': form,
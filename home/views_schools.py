@@ -1,48 +1,52 @@
 import logging
 from django.http import JsonResponse
-from django.db.models import Q
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from .gazetteer import get_gazetteer
 from .models import Schools
+from .school_index import get_school_index
 
 logger = logging.getLogger(__name__)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class SchoolSearchView(View):
+    """
+    Typeahead search over school names, served from the in-process school
+    index. Accepts ``q`` and an optional ``county`` id filter; schools in the
+    searching teacher's own county rank first among equal matches.
+    """
+
     def get(self, request):
         try:
             query = request.GET.get('q', '').strip()
-            logger.info(f"School search query: {query}")
+            logger.debug(f"School search query: {query}")
             
             if not query or len(query) < 2:
                 return JsonResponse({'schools': [], 'status': 'success'})
-                
-            # Search by school name only
-            schools = Schools.objects.select_related('ward__constituency__county').filter(name__icontains=query).order_by('name')[:10] 
-                                 
-                                  # Limit to 10 results, ordered by name
-            
-            # Debug: Log the raw query and results
-            logger.info(f"Raw SQL: {str(schools.query)}")
-            logger.info(f"Found {schools.count()} schools matching: {query}")
+
+            county_id = request.GET.get('county')
+            county_id = int(county_id) if county_id and county_id.isdigit() else None
+
+            index = get_school_index()
+            gazetteer = get_gazetteer()
+            matches = index.search(query, county_id=county_id, near_county_id=self.home_county_id(request, index))
             
             results = []
-            for school in schools:
-                try:
-                    results.append({
-                        'id': school.id,
-                        'name': school.name,
-                        'type': school.get_level_display() if hasattr(school, 'get_level_display') else 'N/A',
-                        'gender': school.get_gender_display(),
-                        'boarding': school.get_boarding_display(),
-                        'location': f"{school.ward}, {school.ward.constituency}, {school.ward.constituency.county}",
-                    })
-                except Exception as e:
-                    logger.error(f"Error processing school {school.id}: {str(e)}")
-                    continue
+            for school in matches:
+                ward = gazetteer.ward(school.ward_id)
+                constituency = gazetteer.constituency(ward.parent_id) if ward else None
+                county = gazetteer.county(school.county_id)
+                results.append({
+                    'id': school.id,
+                    'name': school.name,
+                    'type': school.level or 'N/A',
+                    'gender': school.gender,
+                    'boarding': school.boarding,
+                    'location': ", ".join(place.name for place in (ward, constituency, county) if place),
+                })
             
-            logger.info(f"Found {len(results)} schools for query: {query}")
+            logger.debug(f"Found {len(results)} schools for query: {query}")
             return JsonResponse({
                 'schools': results,
                 'status': 'success',
@@ -56,6 +60,13 @@ class SchoolSearchView(View):
                 'status': 'error'
             }, status=500)
 
+    @staticmethod
+    def home_county_id(request, index):
+        """County of the requesting teacher's current school, if known."""
+        profile = getattr(request.user, 'profile', None) if request.user.is_authenticated else None
+        entry = index.get(profile.school_id) if profile and profile.school_id else None
+        return entry.county_id if entry else None
+
 class AttachSchoolView(View):
     def post(self, request):
         if not request.user.is_authenticated:
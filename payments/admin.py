@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import MpesaTransaction, MySubscription
+from .models import MpesaCallback, MpesaTransaction, MySubscription, ReconciliationRun
 # Register your models here.
 admin.site.register(MpesaTransaction)
-admin.site.register(MySubscription)
\ No newline at end of file
+admin.site.register(MySubscription)
+admin.site.register(MpesaCallback)
+admin.site.register(ReconciliationRun)
\ No newline at end of file
@@ -1,10 +1,44 @@
+import re
+from datetime import datetime, time, timedelta
+
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import render
 from django.db.models import Sum, Count, Q
 from django.utils import timezone
-from .models import MpesaTransaction
+from django.utils.dateparse import parse_date
+from .models import MpesaTransaction, PaymentDailyTotal
 from django.core.paginator import Paginator
 
+ACCOUNT_REFERENCE_RE = re.compile(r'^TSC(\d+)$', re.IGNORECASE)
+
+
+def search_payments(queryset, term):
+    """
+    Exact, indexed matches for the dashboard search box: M-Pesa receipt,
+    checkout or merchant request ID, phone number (any format, compared
+    normalized) or a ``TSC<user id>`` account reference.
+    """
+    term = term.strip()
+    if not term:
+        return queryset
+    lookup = (
+        Q(mpesa_receipt_number=term.upper()) |
+        Q(checkout_request_id=term) |
+        Q(merchant_request_id=term)
+    )
+    phone = MpesaTransaction.normalize_phone(term)
+    if phone.isdigit() and len(phone) == 12:
+        lookup |= Q(phone_normalized=phone)
+    reference = ACCOUNT_REFERENCE_RE.match(term)
+    if reference:
+        lookup |= Q(user_id=int(reference.group(1)))
+    return queryset.filter(lookup)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def view_payments(request):
@@ -13,41 +47,45 @@ def view_payments(request):
     date_from = request.GET.get('date_from')
     date_to = request.GET.get('date_to')
     search = request.GET.get('search', '')
-    
+    day_from = parse_date(date_from) if date_from else None
+    day_to = parse_date(date_to) if date_to else None
+
     # Start with base queryset
-    payments = MpesaTransaction.objects.all().order_by('-created_at')
-    
-    # Apply filters
+    payments = MpesaTransaction.objects.select_related('user').order_by('-created_at')
+    totals = PaymentDailyTotal.objects.all()
+
+    # Apply filters (date bounds as created_at ranges so the index is used)
     if status_filter:
         payments = payments.filter(status=status_filter)
-        
-    if date_from:
-        payments = payments.filter(created_at__date__gte=date_from)
-        
-    if date_to:
-        payments = payments.filter(created_at__date__lte=date_to)
-        
-    if search:
-        payments = payments.filter(
-            Q(phone_number__icontains=search) |
-            Q(account_reference__icontains=search) |
-            Q(mpesa_receipt_number__icontains=search) |
-            Q(merchant_request_id__icontains=search) |
-            Q(checkout_request_id__icontains=search)
-        )
-    
-    # Get summary stats
-    total_payments = payments.count()
-    total_amount = payments.aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    # Status counts
-    status_counts = payments.values('status').annotate(count=Count('id'))
-    
+        totals = totals.filter(status=status_filter)
+
+    if day_from:
+        payments = payments.filter(created_at__gte=_day_start(day_from))
+        totals = totals.filter(date__gte=day_from)
+
+    if day_to:
+        payments = payments.filter(created_at__lt=_day_start(day_to + timedelta(days=1)))
+        totals = totals.filter(date__lte=day_to)
+
+    if search.strip():
+        # A search matches a handful of rows: total those directly
+        payments = search_payments(payments, search)
+        total_payments = payments.count()
+        total_amount = payments.aggregate(Sum('amount'))['amount__sum'] or 0
+        status_counts = payments.values('status').annotate(count=Count('id')).order_by('status')
+    else:
+        # Get summary stats from the daily rollup
+        summary = totals.aggregate(count=Sum('count'), amount=Sum('amount'))
+        total_payments = summary['count'] or 0
+        total_amount = summary['amount'] or 0
+        status_counts = totals.values('status').annotate(count=Sum('count')).filter(count__gt=0).order_by('status')
+
     # Pagination
     paginator = Paginator(payments, 25)  # Show 25 payments per page
+    paginator.count = total_payments
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
-    
+
     context = {
         'page_obj': page_obj,
         'total_payments': total_payments,
@@ -58,5 +96,5 @@ def view_payments(request):
         'date_to': date_to,
         'search': search,
     }
-    
+
     return render(request, 'payments/admin_payments.html', context)
@@ -0,0 +1,69 @@
+"""
+Finding the transaction for an STK callback whose CheckoutRequestID matches
+no row (the push's response was lost, or it never reached the database).
+
+``find_callback_transaction`` tries, in order:
+
+1. ``MerchantRequestID``: the merchant_request_id index
+2. ``AccountReference`` as ``TSC<user id>_<transaction id>``: the primary key
+3. ``AccountReference`` as ``TSC<user id>``: the user's newest pending push,
+   on the (user, status, -created_at) index
+4. any other ``AccountReference``: the (account_reference, status,
+   -created_at) index
+5. the payer's ``PhoneNumber`` and ``Amount`` from the callback metadata:
+   the (phone_normalized, status, -created_at) index
+
+Every step is a single indexed query returning at most one row, and the
+pending matches only look back ``MPESA_CALLBACK_MATCH_HOURS``, so a
+fallback costs a few index seeks however many transactions there are. The
+row is locked (select_for_update); call it inside the callback's database
+transaction.
+"""
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MpesaTransaction
+
+USER_REFERENCE_RE = re.compile(r'^TSC(\d+)$', re.IGNORECASE)
+TRANSACTION_REFERENCE_RE = re.compile(r'^TSC\d*_(\d+)$', re.IGNORECASE)
+
+
+def callback_items(result):
+    """The callback's ``CallbackMetadata`` items as a ``{name: value}`` dict."""
+    items = (result.get('CallbackMetadata') or {}).get('Item') or []
+    return {item['Name']: item.get('Value') for item in items if item.get('Name')}
+
+
+def _newest_pending(**lookup):
+    since = timezone.now() - timedelta(hours=settings.MPESA_CALLBACK_MATCH_HOURS)
+    return MpesaTransaction.objects.select_for_update().filter(
+        status='pending', created_at__gte=since, **lookup
+    ).order_by('-created_at').first()
+
+
+def find_callback_transaction(result):
+    """The transaction a callback belongs to, or None."""
+    merchant_request_id = result.get('MerchantRequestID')
+    if merchant_request_id:
+        transaction = _newest_pending(merchant_request_id=merchant_request_id)
+        if transaction:
+            return transaction
+
+    account_reference = (result.get('AccountReference') or result.get('account_reference') or '').strip()
+    if account_reference:
+        match = TRANSACTION_REFERENCE_RE.match(account_reference)
+        if match:
+            return MpesaTransaction.objects.select_for_update().filter(id=int(match.group(1))).first()
+        match = USER_REFERENCE_RE.match(account_reference)
+        if match:
+            return _newest_pending(user_id=int(match.group(1)))
+        return _newest_pending(account_reference=account_reference)
+
+    items = callback_items(result)
+    phone = MpesaTransaction.normalize_phone(str(items.get('PhoneNumber') or ''))
+    if phone and items.get('Amount') is not None:
+        return _newest_pending(phone_normalized=phone, amount=items['Amount'])
+    return None
@@ -0,0 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
+from .entitlements import entitlement_for
+
+
+def entitlement(request):
+    """The current user's subscription entitlement, loaded only if a template uses it."""
+    return {'entitlement': SimpleLazyObject(lambda: entitlement_for(request))}
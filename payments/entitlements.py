@@ -0,0 +1,90 @@
+"""
+Cached subscription entitlements.
+
+Gating checks (contact reveal on swap pages, the dashboard subscription
+card) read an ``Entitlement`` instead of ``user.my_subscription``:
+
+- ``entitlement_for(request)`` loads it at most once per request
+- with a shared cache (``ENTITLEMENT_CACHE_SECONDS``, set when REDIS_URL
+  is) the plan and expiry date are cached per user (``ENTITLEMENT_KEY``),
+  so later requests skip the subscription query entirely. A per-process
+  cache is not used: the web worker or reconciliation job that changes a
+  subscription could not clear the other processes' entries
+- the active flag and days remaining are worked out from the expiry date
+  on access, so an expiry needs no invalidation
+- saving or deleting a MySubscription (and the reconciliation job's bulk
+  update) drops the cached entry, see ``invalidate_entitlements``
+
+The ``payments.context_processors.entitlement`` context processor exposes
+the request's entitlement to templates as ``entitlement``.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MySubscription
+
+ENTITLEMENT_KEY = 'entitlement:{}'
+
+
+class Entitlement(namedtuple('Entitlement', ['plan', 'expiry_date'])):
+    """A user's subscription plan and expiry (both None without one)."""
+
+    __slots__ = ()
+
+    @property
+    def has_subscription(self):
+        return self.expiry_date is not None
+
+    @property
+    def is_active(self):
+        return self.expiry_date is not None and self.expiry_date > timezone.now()
+
+    @property
+    def days_remaining(self):
+        if not self.is_active:
+            return 0
+        return (self.expiry_date - timezone.now()).days
+
+
+NO_ENTITLEMENT = Entitlement(None, None)
+
+
+def entitlement_key(user_id):
+    return ENTITLEMENT_KEY.format(user_id)
+
+
+def get_entitlement(user):
+    """The user's entitlement, from the shared cache when there is one."""
+    if not user.is_authenticated:
+        return NO_ENTITLEMENT
+    timeout = settings.ENTITLEMENT_CACHE_SECONDS
+    key = entitlement_key(user.pk)
+    if timeout > 0:
+        cached = cache.get(key)
+        if cached is not None:
+            return Entitlement(*cached)
+    row = MySubscription.objects.filter(user_id=user.pk).values_list('sub_type', 'expiry_date').first()
+    entitlement = Entitlement(*row) if row else NO_ENTITLEMENT
+    if timeout > 0:
+        cache.set(key, tuple(entitlement), timeout=timeout)
+    return entitlement
+
+
+def entitlement_for(request):
+    """The current user's entitlement, loaded at most once per request."""
+    if not hasattr(request, '_entitlement'):
+        request._entitlement = get_entitlement(request.user)
+    return request._entitlement
+
+
+def invalidate_entitlements(user_ids):
+    """Drop the cached entitlements now and again once the change commits."""
+    keys = [entitlement_key(user_id) for user_id in user_ids]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,244 @@
+"""
+A local stand-in for Safaricom's Daraja API, for offline development and
+load testing of the payment flow.
+
+``FakeDaraja`` serves the endpoints payments.mpesa_utils calls (point
+``MPESA_API_BASE_URL`` at ``FakeDaraja.url``):
+
+- ``GET /oauth/v1/generate``: a bearer token
+- ``POST /mpesa/stkpush/v1/processrequest``: accepts the push (or refuses
+  it, ``failure_rate``), decides its outcome (completed, or cancelled with
+  ``cancel_rate``) and schedules the callback to ``CallBackURL`` after a
+  random ``callback_delay``. ``duplicate_rate`` sends the callback twice at
+  once. ``drop_rate`` never sends it, which leaves the transaction for
+  reconciliation.
+- ``POST /mpesa/stkpushquery/v1/query``: the outcome once the callback is
+  due, "being processed" before that
+
+Callbacks are POSTed to the push's ``CallBackURL``. A ``callback_sender``
+(``sender(url, body) -> status code``) can deliver them some other way,
+e.g. through the Django test client. Callbacks answered with a 5xx are
+retried up to ``callback_retries`` times. ``stats`` counts what happened.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+
+TOKEN = 'fake-daraja-token'
+STILL_PROCESSING = {
+    'requestId': '', 'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed',
+}
+
+
+def post_callback(url, body):
+    """Deliver a callback over HTTP; returns the response status code."""
+    request = urllib.request.Request(
+        url, data=body.encode(), headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+class FakeDaraja:
+    def __init__(self, host='127.0.0.1', port=0, callback_delay=(0.05, 0.5), duplicate_rate=0.0,
+                 failure_rate=0.0, cancel_rate=0.0, drop_rate=0.0, callback_retries=3,
+                 callback_sender=None, seed=None):
+        self.callback_delay = callback_delay
+        self.duplicate_rate = duplicate_rate
+        self.failure_rate = failure_rate
+        self.cancel_rate = cancel_rate
+        self.drop_rate = drop_rate
+        self.callback_retries = callback_retries
+        self.callback_sender = callback_sender or post_callback
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.outcomes = {}  # checkout_request_id -> (due_at, result)
+        self.lock = threading.Lock()
+        self.in_flight = 0  # callbacks scheduled or being delivered
+        self.settled = threading.Condition(self.lock)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def wait_idle(self, timeout):
+        """Wait until every scheduled callback has been delivered."""
+        with self.settled:
+            return self.settled.wait_for(lambda: self.in_flight == 0, timeout)
+
+    # STK push and callbacks
+
+    def stk_push(self, payload):
+        with self.lock:
+            refused = self.random.random() < self.failure_rate
+            cancelled = self.random.random() < self.cancel_rate
+            duplicated = self.random.random() < self.duplicate_rate
+            dropped = self.random.random() < self.drop_rate
+            delay = self.random.uniform(*self.callback_delay)
+        if refused:
+            self.count('pushes_refused')
+            return 500, {'requestId': uuid.uuid4().hex, 'errorCode': '500.003.02',
+                         'errorMessage': 'System is busy. Please try again in few minutes.'}
+
+        merchant_request_id = f'fake-{uuid.uuid4().hex[:12]}'
+        checkout_request_id = f'ws_CO_{uuid.uuid4().hex}'
+        if cancelled:
+            result = {'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user'}
+        else:
+            result = {
+                'ResultCode': 0,
+                'ResultDesc': 'The service request is processed successfully.',
+                'CallbackMetadata': {'Item': [
+                    {'Name': 'Amount', 'Value': payload.get('Amount')},
+                    {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                    {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                    {'Name': 'PhoneNumber', 'Value': int(payload.get('PhoneNumber') or 0)},
+                ]},
+            }
+        body = json.dumps({'Body': {'stkCallback': {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            **result,
+        }}})
+        with self.lock:
+            self.outcomes[checkout_request_id] = (time.monotonic() + delay, result)
+        self.count('pushes')
+
+        if dropped:
+            self.count('callbacks_dropped')
+        else:
+            copies = 2 if duplicated else 1
+            if duplicated:
+                self.count('duplicates_sent')
+            with self.lock:
+                self.in_flight += 1
+            timer = threading.Timer(delay, self.send_callback, args=(payload.get('CallBackURL'), body, copies))
+            timer.daemon = True
+            timer.start()
+        return 200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def send_callback(self, url, body, copies=1):
+        """Deliver ``copies`` of a callback at the same time."""
+        threads = [threading.Thread(target=self._deliver, args=(url, body), daemon=True) for _ in range(copies)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self.settled:
+            self.in_flight -= 1
+            self.settled.notify_all()
+
+    def _deliver(self, url, body):
+        for attempt in range(self.callback_retries + 1):
+            try:
+                status = self.callback_sender(url, body)
+            except Exception:
+                status = 599
+            self.count('callbacks_sent')
+            if status < 500:
+                self.count(f'callback_status_{status}')
+                return
+            self.count('callback_errors')
+            time.sleep(0.05 * 2 ** attempt)
+        self.count('callbacks_abandoned')
+
+    def stk_query(self, payload):
+        with self.lock:
+            outcome = self.outcomes.get(payload.get('CheckoutRequestID'))
+        self.count('queries')
+        if outcome is None:
+            return 404, {'errorCode': '404.001.04', 'errorMessage': 'Invalid CheckoutRequestID'}
+        due_at, result = outcome
+        if time.monotonic() < due_at:
+            return 500, STILL_PROCESSING
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'CheckoutRequestID': payload.get('CheckoutRequestID'),
+            'ResultCode': str(result['ResultCode']),
+            'ResultDesc': result['ResultDesc'],
+        }
+
+    def _handler(self):
+        daraja = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def authorized(self):
+                if self.headers.get('Authorization') == f'Bearer {TOKEN}':
+                    return True
+                self.reply(404, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+                return False
+
+            def do_GET(self):
+                if self.path.startswith('/oauth/v1/generate'):
+                    daraja.count('tokens')
+                    self.reply(200, {'access_token': TOKEN, 'expires_in': '3599'})
+                else:
+                    self.reply(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    self.reply(400, {'errorMessage': 'Invalid JSON'})
+                    return
+                if self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+                    if self.authorized():
+                        self.reply(*daraja.stk_push(payload))
+                elif self.path.startswith('/mpesa/stkpushquery/v1/query'):
+                    if self.authorized():
+                        self.reply(*daraja.stk_query(payload))
+                else:
+                    self.reply(404, {'errorMessage': 'Not found'})
+
+        return Handler
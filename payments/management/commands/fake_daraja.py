@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from payments.fake_daraja import FakeDaraja
+
+
+class Command(BaseCommand):
+    help = 'Runs a local Daraja (M-Pesa API) stand-in; point MPESA_API_BASE_URL at it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--min-delay', type=float, default=0.5, help='Shortest callback delay in seconds')
+        parser.add_argument('--max-delay', type=float, default=3.0, help='Longest callback delay in seconds')
+        parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Share of callbacks sent twice at once')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of STK pushes refused')
+        parser.add_argument('--cancel-rate', type=float, default=0.0, help='Share of payments the customer cancels')
+        parser.add_argument('--drop-rate', type=float, default=0.0, help='Share of callbacks never sent')
+
+    def handle(self, *args, **options):
+        daraja = FakeDaraja(
+            host=options['host'],
+            port=options['port'],
+            callback_delay=(options['min_delay'], options['max_delay']),
+            duplicate_rate=options['duplicate_rate'],
+            failure_rate=options['failure_rate'],
+            cancel_rate=options['cancel_rate'],
+            drop_rate=options['drop_rate'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Fake Daraja listening on {daraja.url} (Ctrl+C to stop)'))
+        self.stdout.write(f'  export MPESA_API_BASE_URL={daraja.url}')
+        try:
+            daraja.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daraja.server.server_close()
+            self.stdout.write(', '.join(f'{key}={value}' for key, value in sorted(daraja.stats.items())))
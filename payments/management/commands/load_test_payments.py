@@ -0,0 +1,206 @@
+"""
+Drives many concurrent payments through the real payment views against an
+in-process fake Daraja server (payments.fake_daraja).
+
+Each simulated payer logs in, POSTs to ``initiate_payment`` and long-polls
+``wait_transaction_status`` until M-Pesa's answer lands. The fake server
+delivers callbacks (some duplicated) to ``mpesa_callback`` through the
+Django test client, so the whole stack runs (URL routing, middleware,
+views, database) without a web server or Safaricom.
+
+Reported: throughput, initiate and end-to-end latency percentiles, final
+statuses, whether duplicate callbacks were applied once (subscriptions
+extended exactly once, one ledger row per push) and database contention
+(callbacks refused with a 5xx and retried, lock errors).
+
+The payers are throwaway users created for the run and deleted afterwards
+(with their transactions) unless ``--keep`` is given.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from payments.fake_daraja import FakeDaraja
+from payments.models import MpesaCallback, MpesaTransaction, MySubscription
+from payments.mpesa_utils import invalidate_access_token
+from users.models import MyUser
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = 'Load-tests the M-Pesa payment flow against an in-process fake Daraja server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=1000, help='Payments to make (one payer each)')
+        parser.add_argument('--concurrency', type=int, default=32, help='Payers active at once')
+        parser.add_argument('--min-delay', type=float, default=0.2, help='Shortest callback delay in seconds')
+        parser.add_argument('--max-delay', type=float, default=1.0, help='Longest callback delay in seconds')
+        parser.add_argument('--duplicate-rate', type=float, default=0.2, help='Share of callbacks sent twice at once')
+        parser.add_argument('--cancel-rate', type=float, default=0.1, help='Share of payments the customer cancels')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of STK pushes refused')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Seconds a payer waits for the outcome')
+        parser.add_argument('--keep', action='store_true', help='Keep the payers and their transactions')
+        parser.add_argument('--force', action='store_true', help='Run even when DEBUG is off')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError('This creates and deletes users and payments; use --force to run it with DEBUG off')
+        if options['payments'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--payments and --concurrency must be at least 1')
+
+        self.lock = threading.Lock()
+        self.callback_messages = Counter()
+        run_id = uuid.uuid4().hex[:8]
+        payers = self.create_payers(run_id, options['payments'])
+        daraja = FakeDaraja(
+            callback_delay=(options['min_delay'], options['max_delay']),
+            duplicate_rate=options['duplicate_rate'],
+            cancel_rate=options['cancel_rate'],
+            failure_rate=options['failure_rate'],
+            callback_sender=self.send_callback,
+        )
+        base = daraja.url
+        try:
+            with daraja, override_settings(
+                MPESA_AUTH_URL=f'{base}/oauth/v1/generate?grant_type=client_credentials',
+                MPESA_STK_PUSH_URL=f'{base}/mpesa/stkpush/v1/processrequest',
+                MPESA_QUERY_URL=f'{base}/mpesa/stkpushquery/v1/query',
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ):
+                invalidate_access_token()
+                self.stdout.write(f'Running {len(payers)} payment(s), {options["concurrency"]} at a time...')
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                    results = list(pool.map(lambda user: self.pay(user, options['timeout']), payers))
+                elapsed = time.perf_counter() - started
+                daraja.wait_idle(timeout=options['max_delay'] + 30)
+                invalidate_access_token()
+            self.report(payers, results, elapsed, daraja)
+        finally:
+            if not options['keep']:
+                self.delete_payers(payers)
+
+    def create_payers(self, run_id, count):
+        users = [
+            MyUser(email=f'loadtest-{run_id}-{n}@example.invalid', first_name='Load', last_name=f'Test {n}')
+            for n in range(count)
+        ]
+        for user in users:
+            user.set_unusable_password()
+        MyUser.objects.bulk_create(users, batch_size=500)
+        return list(MyUser.objects.filter(email__startswith=f'loadtest-{run_id}-').order_by('id'))
+
+    def delete_payers(self, payers):
+        user_ids = [user.id for user in payers]
+        transactions = MpesaTransaction.objects.filter(user_id__in=user_ids)
+        MpesaCallback.objects.filter(transaction__in=transactions).delete()
+        transactions.delete()
+        MyUser.objects.filter(id__in=user_ids).delete()
+
+    def send_callback(self, url, body):
+        """Deliver a fake Daraja callback to mpesa_callback in-process."""
+        try:
+            response = Client().post(
+                reverse('payments:mpesa_callback'), data=body, content_type='application/json', secure=True
+            )
+            try:
+                message = response.json().get('message', '')
+            except ValueError:
+                message = ''
+            with self.lock:
+                self.callback_messages[(response.status_code, message)] += 1
+            return response.status_code
+        finally:
+            connection.close()
+
+    def pay(self, user, timeout):
+        client = Client()
+        try:
+            client.force_login(user)
+            started = time.perf_counter()
+            response = client.post(
+                reverse('payments:initiate_payment'),
+                data=json.dumps({'phone_number': '0712345678', 'plan': 'standard'}),
+                content_type='application/json',
+                secure=True,
+            )
+            initiated = time.perf_counter() - started
+            if response.status_code not in (200, 202):
+                return {'status': f'initiate {response.status_code}', 'initiate': initiated}
+
+            data = response.json()
+            status_url, status = data['status_url'], 'pending'
+            deadline = started + timeout
+            while status == 'pending' and time.perf_counter() < deadline:
+                response = client.get(status_url, {'status': status}, secure=True)
+                if response.status_code != 200:
+                    return {'status': f'status {response.status_code}', 'initiate': initiated}
+                status = response.json()['status']
+            return {'status': status, 'initiate': initiated, 'total': time.perf_counter() - started}
+        except Exception as e:
+            return {'status': f'error: {type(e).__name__}: {e}'[:120]}
+        finally:
+            connection.close()
+
+    def report(self, payers, results, elapsed, daraja):
+        statuses = Counter(result['status'] for result in results)
+        initiate = [result['initiate'] for result in results if 'initiate' in result]
+        total = [result['total'] for result in results if 'total' in result]
+
+        def ms(seconds):
+            return f'{seconds * 1000:.0f} ms'
+
+        self.stdout.write('')
+        self.stdout.write(f'Payments:      {len(results)} in {elapsed:.1f} s ({len(results) / elapsed:.1f}/s)')
+        self.stdout.write(f'Initiate:      p50 {ms(percentile(initiate, 50))}, p95 {ms(percentile(initiate, 95))}, '
+                          f'p99 {ms(percentile(initiate, 99))}')
+        self.stdout.write(f'End to end:    p50 {ms(percentile(total, 50))}, p95 {ms(percentile(total, 95))}, '
+                          f'p99 {ms(percentile(total, 99))}')
+        self.stdout.write('Final status:  ' + ', '.join(f'{status}={n}' for status, n in statuses.most_common()))
+        self.stdout.write('Fake Daraja:   ' + ', '.join(f'{key}={n}' for key, n in sorted(daraja.stats.items())))
+
+        # Duplicate callbacks must have been applied once
+        user_ids = [user.id for user in payers]
+        transactions = MpesaTransaction.objects.filter(user_id__in=user_ids)
+        settled = transactions.exclude(status='pending')
+        ledger = MpesaCallback.objects.filter(transaction__in=transactions).count()
+        paid_users = set(transactions.filter(status='completed').values_list('user_id', flat=True))
+        limit = timezone.now() + timedelta(days=MySubscription.PERIOD_DAYS, hours=1)
+        over_extended = MySubscription.objects.filter(user_id__in=user_ids, expiry_date__gt=limit).count()
+        missing = len(paid_users - set(
+            MySubscription.objects.filter(user_id__in=paid_users).values_list('user_id', flat=True)
+        ))
+        already = sum(n for (code, message), n in self.callback_messages.items() if message == 'Callback already processed')
+        self.stdout.write(f'Callbacks:     {settled.count()} settled, {ledger} ledger row(s), '
+                          f'{already} duplicate(s) skipped')
+        self.stdout.write(f'Subscriptions: {len(paid_users)} paid, {over_extended} extended more than once, '
+                          f'{missing} missing')
+
+        # Contention: callbacks the database refused (then retried)
+        refused = Counter(
+            message for (code, message), n in self.callback_messages.items() if code >= 500 for _ in range(n)
+        )
+        locks = sum(n for message, n in refused.items() if 'lock' in message.lower() or 'deadlock' in message.lower())
+        self.stdout.write(f'Contention:    {sum(refused.values())} callback(s) refused with 5xx '
+                          f'({locks} lock error(s)), {daraja.stats["callbacks_abandoned"]} abandoned')
+
+        if over_extended or missing:
+            raise CommandError('Duplicate callbacks were not handled correctly')
+        self.stdout.write(self.style.SUCCESS('Duplicate callbacks were applied exactly once'))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.models import MpesaTransaction, PaymentDailyTotal
+from payments.rollups import compute_daily_totals, rebuild_daily_totals
+
+
+class Command(BaseCommand):
+    help = ('Checks and rebuilds the daily payment totals shown on the payments dashboard, '
+            'and the normalized phone numbers its search uses')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare the stored totals and phones with a fresh computation; exit with an error if they differ',
+        )
+
+    def handle(self, *args, **options):
+        stale_phones = {}
+        for pk, phone_number, phone_normalized in MpesaTransaction.objects.values_list(
+            'pk', 'phone_number', 'phone_normalized'
+        ).iterator(chunk_size=2000):
+            expected = MpesaTransaction.normalize_phone(phone_number)
+            if expected != phone_normalized:
+                stale_phones[pk] = expected
+
+        if options['check']:
+            expected = compute_daily_totals()
+            stored = {
+                (day, status, plan): (count, amount)
+                for day, status, plan, count, amount in PaymentDailyTotal.objects.filter(count__gt=0).values_list(
+                    'date', 'status', 'plan', 'count', 'amount'
+                )
+            }
+            stale = {key for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)}
+            if stale or stale_phones:
+                for key in sorted(stale)[:20]:
+                    self.stdout.write(f'  {key[0]} {key[1]} {key[2]}: stored={stored.get(key)} expected={expected.get(key)}')
+                raise CommandError(f'{len(stale)} daily total(s) and {len(stale_phones)} phone number(s) are out of date')
+            self.stdout.write(self.style.SUCCESS('Payment totals are consistent'))
+            return
+
+        for pk, phone_normalized in stale_phones.items():
+            MpesaTransaction.objects.filter(pk=pk).update(phone_normalized=phone_normalized)
+        written = rebuild_daily_totals()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt payment totals: {written} row(s); updated {len(stale_phones)} phone number(s)'
+        ))
@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.reconciliation import reconcile_pending
+
+
+class Command(BaseCommand):
+    help = 'Queries M-Pesa for pending STK pushes whose callback never arrived and settles them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=5,
+            help='Only check transactions pending for at least this many minutes (default 5)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Transactions queried and written per batch (default 100)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Concurrent STK queries (default 4)',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be at least 1')
+
+        run = reconcile_pending(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            older_than=timedelta(minutes=options['older_than']),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {run.checked} pending transaction(s) in {run.duration_ms} ms: '
+            f'{run.completed} completed, {run.cancelled} cancelled, {run.failed} failed, '
+            f'{run.still_pending} still pending, {run.errors} error(s)'
+        ))
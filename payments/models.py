@@ -20,12 +20,16 @@ class MpesaTransaction(models.Model):
         related_name='mpesa_transactions'
     )
     phone_number = models.CharField(max_length=15)
+    # ``phone_number`` in 2547XXXXXXXX form so the payments search and the
+    # callback fallback (payments.callback_matching) are indexed equalities.
+    # Set by save().
+    phone_normalized = models.CharField(max_length=20, blank=True, default='', editable=False)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     account_reference = models.CharField(max_length=50)
     transaction_desc = models.CharField(max_length=100, default='Payment')
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
     checkout_request_id = models.CharField(max_length=100, blank=True, null=True, unique=True, db_index=True)
-    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True, unique=True)
     transaction_date = models.DateTimeField(blank=True, null=True)
     status = models.CharField(
         max_length=20,
@@ -40,6 +44,20 @@ class MpesaTransaction(models.Model):
     def __str__(self):
         return f"{self.phone_number} - {self.amount} - {self.status}"
 
+    def save(self, *args, **kwargs):
+        # Receipt numbers are unique; store "no receipt" as NULL, never ''
+        if not self.mpesa_receipt_number:
+            self.mpesa_receipt_number = None
+        self.phone_normalized = self.normalize_phone(self.phone_number)
+        if kwargs.get('update_fields') is not None and 'phone_number' in kwargs['update_fields']:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'phone_normalized'}
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def normalize_phone(phone):
+        from chat.whatsapp_integration import normalize_phone_number
+        return normalize_phone_number(phone)
+
     def is_successful(self):
         return self.status == 'completed' and self.mpesa_receipt_number is not None
 
@@ -47,6 +65,37 @@ class MpesaTransaction(models.Model):
         ordering = ['-created_at']
         verbose_name = _('M-Pesa Transaction')
         verbose_name_plural = _('M-Pesa Transactions')
+        indexes = [
+            models.Index(fields=['user', 'status', '-created_at']),
+            # Callback fallback lookups, see payments.callback_matching
+            models.Index(fields=['account_reference', 'status', '-created_at']),
+            models.Index(fields=['phone_normalized', 'status', '-created_at']),
+        ]
+
+
+class MpesaCallback(models.Model):
+    """
+    Idempotency ledger for STK callbacks: one row per CheckoutRequestID
+    applied by mpesa_callback, written in the same database transaction as
+    the payment update, so a duplicate delivery is recognised and skipped.
+    """
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    transaction = models.ForeignKey(
+        MpesaTransaction,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='callbacks'
+    )
+    result_code = models.CharField(max_length=10, blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.checkout_request_id} - {self.result_code}"
+
+    class Meta:
+        ordering = ['-received_at']
+        verbose_name = _('M-Pesa Callback')
+        verbose_name_plural = _('M-Pesa Callbacks')
 
 
 class MySubscription(models.Model):
@@ -57,6 +106,8 @@ class MySubscription(models.Model):
         ('Standard', 'Standard'),
         ('Premium', 'Premium'),
     )
+    # Days added by each completed payment
+    PERIOD_DAYS = 180
     
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
@@ -117,6 +168,19 @@ class MySubscription(models.Model):
         self.expiry_date = timezone.now()
         self.save()
 
+    @staticmethod
+    def type_for_amount(amount):
+        """Subscription type paid for by a completed transaction's amount"""
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            return 'Standard'  # Default to Standard on error
+        if amount >= 200.00:
+            return 'Premium'
+        if amount >= 100.00:
+            return 'Standard'
+        return 'Custom'
+
     @classmethod
     def create_from_payment(cls, user, payment, sub_type=None):
         """
@@ -130,7 +194,7 @@ class MySubscription(models.Model):
         """
         now = timezone.now()
         # Set subscription to 6 months (180 days)
-        expiry_date = now + timezone.timedelta(days=180)
+        expiry_date = now + timezone.timedelta(days=cls.PERIOD_DAYS)
         
         # Debug: Log incoming parameters
         print(f"CREATE_FROM_PAYMENT - User: {user.id}, Sub Type: {sub_type}, Payment Amount: {payment.amount if payment else 'None'}")
@@ -156,8 +220,9 @@ class MySubscription(models.Model):
         # Debug: Print before get_or_create
         print(f"CREATE_FROM_PAYMENT - Creating/updating subscription for user {user.id} with type: {sub_type}")
         
-        # Get or create subscription
-        subscription, created = cls.objects.get_or_create(
+        # Get or create subscription, locking it so concurrent payments for
+        # the same user extend it one after the other
+        subscription, created = cls.objects.select_for_update().get_or_create(
             user=user,
             defaults={
                 'expiry_date': expiry_date,
@@ -169,6 +234,51 @@ class MySubscription(models.Model):
         
         # If subscription exists, extend it by 6 months
         if not created:
-            subscription.extend_subscription(days=180, sub_type=sub_type)
+            subscription.extend_subscription(days=cls.PERIOD_DAYS, sub_type=sub_type)
         
         return subscription
+
+
+class ReconciliationRun(models.Model):
+    """
+    Metrics of one ``reconcile_payments`` run: how many pending transactions
+    were queried and what M-Pesa said about them.
+    """
+    started_at = models.DateTimeField(default=timezone.now)
+    duration_ms = models.PositiveIntegerField(default=0)
+    checked = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    cancelled = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    still_pending = models.PositiveIntegerField(default=0, help_text='No outcome yet at M-Pesa')
+    errors = models.PositiveIntegerField(default=0, help_text='Queries that could not be made or read')
+
+    class Meta:
+        ordering = ['-started_at']
+        verbose_name = _('Reconciliation Run')
+        verbose_name_plural = _('Reconciliation Runs')
+
+    def __str__(self):
+        return f"Reconciliation {self.started_at:%Y-%m-%d %H:%M} ({self.checked} checked)"
+
+
+class PaymentDailyTotal(models.Model):
+    """
+    Transactions per day (by creation date), status and plan, kept up to
+    date on every status or amount change (see payments.rollups) so the
+    payments dashboard sums a few rows instead of the transaction history.
+    """
+    date = models.DateField()
+    status = models.CharField(max_length=20, choices=MpesaTransaction.TRANSACTION_STATUS_CHOICES)
+    plan = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('date', 'status', 'plan')
+        ordering = ['-date', 'status', 'plan']
+        verbose_name = _('Payment Daily Total')
+        verbose_name_plural = _('Payment Daily Totals')
+
+    def __str__(self):
+        return f"{self.date} {self.status} {self.plan}: {self.count}"
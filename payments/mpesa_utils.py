@@ -1,21 +1,42 @@
 import base64
 import json
+import threading
+import time
 import requests
 import datetime
 from datetime import datetime
 from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db import transaction as db_transaction
 from requests.auth import HTTPBasicAuth
 from .models import MpesaTransaction
 
-def get_access_token():
-    """Generate access token for M-Pesa API"""
+# OAuth tokens are shared by every worker through the Django cache:
+#
+# - a token is reused until MPESA_TOKEN_REFRESH_AHEAD_SECONDS before it expires
+# - inside that window one caller (holding a cache lock) refreshes it, in a
+#   background thread unless MPESA_TOKEN_REFRESH_IN_BACKGROUND is False, while
+#   everyone else keeps using the still-valid token
+# - with no valid token at all, the lock holder fetches one and the others
+#   wait up to MPESA_TOKEN_WAIT_SECONDS for it instead of stampeding the
+#   auth endpoint
+TOKEN_CACHE_KEY = 'mpesa:access_token'
+TOKEN_LOCK_KEY = 'mpesa:access_token:lock'
+TOKEN_LOCK_SECONDS = 35  # a little longer than the auth request timeout
+
+
+def fetch_access_token():
+    """
+    Request a new token from the M-Pesa auth endpoint. Returns
+    ``(token, expires_in_seconds)`` or ``(None, 0)``.
+    """
     consumer_key = settings.MPESA_CONSUMER_KEY
     consumer_secret = settings.MPESA_CONSUMER_SECRET
     api_url = settings.MPESA_AUTH_URL
     
     try:
         print(f"Getting access token from: {api_url}")
-        print(f"Using consumer key: {consumer_key[:5]}...{consumer_key[-5:] if consumer_key else ''}")
         
         response = requests.get(
             api_url,
@@ -23,29 +44,134 @@ def get_access_token():
             timeout=30
         )
         
-        # Log the response status and content for debugging
         print(f"Auth response status: {response.status_code}")
-        print(f"Auth response content: {response.text}")
         
         response.raise_for_status()
         
-        access_token = response.json().get('access_token')
+        data = response.json()
+        access_token = data.get('access_token')
         if not access_token:
             print("Error: No access token in response")
-            return None
+            return None, 0
             
         print("Successfully retrieved access token")
-        return access_token
+        return access_token, int(data.get('expires_in') or 3599)
         
     except requests.exceptions.RequestException as e:
         print(f"Request error getting access token: {str(e)}")
         if hasattr(e, 'response') and e.response is not None:
             print(f"Response status: {e.response.status_code}")
-            print(f"Response content: {e.response.text}")
     except Exception as e:
         print(f"Unexpected error getting access token: {str(e)}")
         
-    return None
+    return None, 0
+
+
+def _refresh_access_token():
+    """Fetch a token and store it in the cache. Call while holding the lock."""
+    try:
+        token, expires_in = fetch_access_token()
+        if token:
+            cache.set(
+                TOKEN_CACHE_KEY,
+                {'token': token, 'expires_at': time.time() + expires_in},
+                timeout=expires_in,
+            )
+        return token
+    finally:
+        cache.delete(TOKEN_LOCK_KEY)
+
+
+def get_access_token():
+    """Return a valid M-Pesa access token, fetching one only when needed."""
+    refresh_ahead = getattr(settings, 'MPESA_TOKEN_REFRESH_AHEAD_SECONDS', 300)
+    cached = cache.get(TOKEN_CACHE_KEY)
+    now = time.time()
+
+    if cached and cached['expires_at'] - now > refresh_ahead:
+        return cached['token']
+
+    if cached and cached['expires_at'] - now > 0:
+        # Still valid: refresh ahead of expiry if nobody else is doing it
+        if cache.add(TOKEN_LOCK_KEY, 1, timeout=TOKEN_LOCK_SECONDS):
+            if getattr(settings, 'MPESA_TOKEN_REFRESH_IN_BACKGROUND', True):
+                threading.Thread(target=_refresh_access_token, daemon=True).start()
+            else:
+                return _refresh_access_token() or cached['token']
+        return cached['token']
+
+    if cache.add(TOKEN_LOCK_KEY, 1, timeout=TOKEN_LOCK_SECONDS):
+        return _refresh_access_token()
+
+    # Another worker is fetching a token: wait for it rather than piling on
+    deadline = now + getattr(settings, 'MPESA_TOKEN_WAIT_SECONDS', 10)
+    while time.time() < deadline:
+        time.sleep(0.1)
+        cached = cache.get(TOKEN_CACHE_KEY)
+        if cached and cached['expires_at'] > time.time():
+            return cached['token']
+    token, _ = fetch_access_token()
+    return token
+
+
+def invalidate_access_token():
+    """Forget the cached token (e.g. after M-Pesa rejects it)."""
+    cache.delete(TOKEN_CACHE_KEY)
+
+
+def token_rejected(response):
+    """True when an API response says the access token is invalid or expired."""
+    if response.status_code == 401:
+        return True
+    try:
+        return response.json().get('errorCode') == '404.001.03'
+    except ValueError:
+        return False
+
+
+def authorized_post(url, payload, session=None):
+    """
+    POST ``payload`` to an M-Pesa API with the cached access token (through
+    ``session`` when given), replacing a rejected token once. Returns the
+    response, or None when no token can be obtained.
+    """
+    post = (session or requests).post
+    access_token = get_access_token()
+    if not access_token:
+        return None
+    response = post(
+        url,
+        headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+        json=payload,
+        timeout=30
+    )
+    if token_rejected(response):
+        # The cached token was revoked or expired early: fetch a new one once
+        invalidate_access_token()
+        access_token = get_access_token()
+        if not access_token:
+            return None
+        response = post(
+            url,
+            headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+            json=payload,
+            timeout=30
+        )
+    return response
+
+
+def callback_outcome(result_code, result_desc):
+    """
+    ``(status, result_description)`` for a failed STK result (any code but
+    '0'), as reported by a callback or an STK query.
+    """
+    result_desc = (result_desc or '').lower()
+    if result_code == '1032' or 'request cancelled by user' in result_desc:
+        return 'cancelled', 'Payment was cancelled by the user'
+    if 'insufficient funds' in result_desc:
+        return 'failed', 'Insufficient funds in M-Pesa account'
+    return 'failed', result_desc[:255]  # Truncate if too long
+
 
 def generate_timestamp():
     """Generate timestamp in the format: YYYYMMDDHHMMSS"""
@@ -56,8 +182,11 @@ def generate_password(shortcode, passkey, timestamp):
     data = f"{shortcode}{passkey}{timestamp}"
     return base64.b64encode(data.encode()).decode()
 
-def stk_push(phone_number, amount, account_reference, description, user=None):
-    """Initiate STK push to customer's phone"""
+def stk_push(phone_number, amount, account_reference, description, user=None, transaction=None):
+    """
+    Initiate STK push to customer's phone. The request ids are recorded on
+    ``transaction`` when given, otherwise on a new pending MpesaTransaction.
+    """
     # Use the provided description or default to a generic one
     if not description:
         description = 'TSC Service Fee'
@@ -90,13 +219,6 @@ def stk_push(phone_number, amount, account_reference, description, user=None):
     print(f"- Reference: {account_reference}")
     print(f"- Description: {description}")
     
-    # Get access token
-    access_token = get_access_token()
-    if not access_token:
-        error_msg = "Failed to get access token from M-Pesa API"
-        print(error_msg)
-        return {"error": error_msg}
-        
     timestamp = generate_timestamp()
     password = generate_password(business_shortcode, passkey, timestamp)
     
@@ -129,30 +251,33 @@ def stk_push(phone_number, amount, account_reference, description, user=None):
         "TransactionDesc": f'TSC {description[:20]}',  # Truncate if too long
     }
     
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
     try:
-        response = requests.post(
+        response = authorized_post(
             getattr(settings, 'MPESA_STK_PUSH_URL', 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'),
-            headers=headers,
-            json=payload
+            payload
         )
+        if response is None:
+            error_msg = "Failed to get access token from M-Pesa API"
+            print(error_msg)
+            return {"error": error_msg}
         response_data = response.json()
         
         # Save transaction to database
-        transaction = MpesaTransaction.objects.create(
-            user=user,
-            phone_number=phone_number,
-            amount=amount,
-            account_reference=account_reference,
-            transaction_desc=description,
-            merchant_request_id=response_data.get('MerchantRequestID'),
-            checkout_request_id=response_data.get('CheckoutRequestID'),
-            status='pending'
-        )
+        if transaction is None:
+            transaction = MpesaTransaction.objects.create(
+                user=user,
+                phone_number=phone_number,
+                amount=amount,
+                account_reference=account_reference,
+                transaction_desc=description,
+                merchant_request_id=response_data.get('MerchantRequestID'),
+                checkout_request_id=response_data.get('CheckoutRequestID'),
+                status='pending'
+            )
+        else:
+            transaction.merchant_request_id = response_data.get('MerchantRequestID')
+            transaction.checkout_request_id = response_data.get('CheckoutRequestID')
+            transaction.save(update_fields=['merchant_request_id', 'checkout_request_id', 'updated_at'])
         
         return {
             "success": True,
@@ -163,3 +288,81 @@ def stk_push(phone_number, amount, account_reference, description, user=None):
         }
     except Exception as e:
         return {"error": str(e)}
+
+
+def stk_query(checkout_request_id, session=None):
+    """
+    Ask M-Pesa for the result of an STK push. Returns the response data
+    (``ResultCode``/``ResultDesc`` once the push has an outcome) or
+    ``{"error": ...}``.
+    """
+    business_shortcode = settings.MPESA_PAYBILL
+    timestamp = generate_timestamp()
+    payload = {
+        "BusinessShortCode": business_shortcode,
+        "Password": generate_password(business_shortcode, settings.MPESA_PASSKEY, timestamp),
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    try:
+        response = authorized_post(settings.MPESA_QUERY_URL, payload, session=session)
+        if response is None:
+            return {"error": "Failed to get access token from M-Pesa API"}
+        return response.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def push_for_transaction(transaction, description):
+    """
+    Send the STK push for a saved pending transaction and publish the
+    outcome. A push M-Pesa refuses marks the transaction failed. Returns the
+    ``stk_push`` result.
+    """
+    from .status_events import publish_status
+
+    response = stk_push(
+        phone_number=transaction.phone_number,
+        amount=transaction.amount,
+        account_reference=transaction.account_reference,
+        description=description,
+        user=transaction.user,
+        transaction=transaction,
+    )
+    if 'error' not in response and not response.get('checkout_request_id'):
+        data = response.get('response') or {}
+        response = {'error': data.get('errorMessage') or data.get('ResponseDescription') or 'STK push was not accepted'}
+    if 'error' in response:
+        transaction.status = 'failed'
+        transaction.result_code = 'ERROR'
+        transaction.result_description = response['error']
+        transaction.save(update_fields=['status', 'result_code', 'result_description', 'updated_at'])
+    publish_status(transaction)
+    return response
+
+
+def _push_in_background(transaction_id, description):
+    try:
+        transaction = MpesaTransaction.objects.select_related('user').get(id=transaction_id)
+        push_for_transaction(transaction, description)
+    except Exception as e:
+        print(f"Background STK push failed for transaction {transaction_id}: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def start_stk_push(transaction, description):
+    """
+    Send the STK push for ``transaction`` without holding up the request:
+    in a background thread once the request commits, unless
+    MPESA_STK_IN_BACKGROUND is False, in which case it runs inline and the
+    ``stk_push`` result is returned.
+    """
+    if getattr(settings, 'MPESA_STK_IN_BACKGROUND', True):
+        db_transaction.on_commit(
+            lambda: threading.Thread(
+                target=_push_in_background, args=(transaction.id, description), daemon=True
+            ).start()
+        )
+        return None
+    return push_for_transaction(transaction, description)
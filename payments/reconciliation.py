@@ -0,0 +1,172 @@
+"""
+Reconciliation of STK pushes whose callback never arrived.
+
+``reconcile_pending`` walks the pending transactions older than a grace
+period in id order, ``batch_size`` at a time. For each batch:
+
+1. the STK query for every transaction runs through a bounded thread pool
+   sharing one HTTP session and the cached access token
+2. the answers are applied in one database transaction: the rows are
+   locked, anything a callback settled in the meantime (a MpesaCallback
+   ledger row, or no longer pending) is skipped, then the statuses go out in
+   one bulk_update (plus the dashboard rollup, see payments.rollups), the
+   ledger rows in one bulk_create and the paid subscriptions in one
+   bulk_create plus one bulk_update
+
+Each run's counts and duration are stored as a ReconciliationRun. The
+``reconcile_payments`` command runs it (cron); point ``MPESA_API_BASE_URL``
+at a local Daraja stand-in to exercise it without Safaricom.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .entitlements import invalidate_entitlements
+from .models import MpesaCallback, MpesaTransaction, MySubscription, ReconciliationRun
+from .mpesa_utils import callback_outcome, get_access_token, stk_query
+from .rollups import track_changes
+from .status_events import publish_status
+
+# STK query error while the customer has not answered the prompt yet
+STILL_PROCESSING = '500.001.1001'
+
+
+def query_outcome(data):
+    """
+    ``(status, result_code, result_description)`` for an STK query answer.
+    ``status`` is None while M-Pesa has no outcome yet and 'error' when the
+    query itself failed.
+    """
+    if 'error' in data:
+        return 'error', None, data['error']
+    if data.get('ResultCode') is None:
+        if data.get('errorCode') == STILL_PROCESSING:
+            return None, None, None
+        return 'error', None, data.get('errorMessage') or 'Unexpected STK query response'
+    result_code = str(data['ResultCode'])
+    if result_code == '0':
+        return 'completed', '0', 'Payment completed successfully'
+    status, description = callback_outcome(result_code, data.get('ResultDesc'))
+    return status, result_code, description
+
+
+def extend_subscriptions(transactions, now):
+    """Add a subscription period per completed transaction, in bulk."""
+    period = timedelta(days=MySubscription.PERIOD_DAYS)
+    subscriptions = {
+        subscription.user_id: subscription
+        for subscription in MySubscription.objects.select_for_update().filter(
+            user_id__in={transaction.user_id for transaction in transactions}
+        )
+    }
+    created = {}
+    for transaction in sorted(transactions, key=lambda transaction: transaction.id):
+        sub_type = MySubscription.type_for_amount(transaction.amount)
+        subscription = subscriptions.get(transaction.user_id)
+        if subscription is None:
+            subscription = MySubscription(
+                user_id=transaction.user_id, start_date=now, expiry_date=now + period, sub_type=sub_type
+            )
+            subscriptions[transaction.user_id] = created[transaction.user_id] = subscription
+        else:
+            subscription.expiry_date = max(subscription.expiry_date, now) + period
+            subscription.sub_type = sub_type
+            subscription.updated_at = now
+    MySubscription.objects.bulk_create(created.values())
+    MySubscription.objects.bulk_update(
+        [subscription for user_id, subscription in subscriptions.items() if user_id not in created],
+        ['expiry_date', 'sub_type', 'updated_at'],
+    )
+    invalidate_entitlements(subscriptions)
+
+
+def apply_outcomes(answers):
+    """
+    Write ``{transaction_id: (status, result_code, result_description)}`` to
+    the transactions still pending. Returns the transactions changed.
+    """
+    if not answers:
+        return []
+    with db_transaction.atomic():
+        transactions = list(
+            MpesaTransaction.objects.select_for_update().filter(id__in=answers, status='pending')
+        )
+        settled = set(MpesaCallback.objects.filter(
+            checkout_request_id__in=[transaction.checkout_request_id for transaction in transactions]
+        ).values_list('checkout_request_id', flat=True))
+
+        now = timezone.now()
+        changed = []
+        for transaction in transactions:
+            if transaction.checkout_request_id in settled:
+                continue
+            transaction.status, transaction.result_code, transaction.result_description = answers[transaction.id]
+            transaction.updated_at = now
+            changed.append(transaction)
+
+        MpesaTransaction.objects.bulk_update(changed, ['status', 'result_code', 'result_description', 'updated_at'])
+        track_changes(changed)
+        MpesaCallback.objects.bulk_create([
+            MpesaCallback(
+                checkout_request_id=transaction.checkout_request_id,
+                transaction=transaction,
+                result_code=transaction.result_code,
+            )
+            for transaction in changed
+        ])
+        extend_subscriptions(
+            [transaction for transaction in changed if transaction.status == 'completed' and transaction.user_id],
+            now,
+        )
+        db_transaction.on_commit(lambda: [publish_status(transaction) for transaction in changed])
+    return changed
+
+
+def reconcile_pending(batch_size=100, workers=4, older_than=timedelta(minutes=5), session=None):
+    """Query and settle every pending transaction older than ``older_than``."""
+    started = time.monotonic()
+    run = ReconciliationRun(started_at=timezone.now())
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    pending = MpesaTransaction.objects.filter(
+        status='pending',
+        checkout_request_id__isnull=False,
+        created_at__lte=run.started_at - older_than,
+    ).order_by('id')
+
+    # Fetch (or reuse) the token once before the workers share it
+    get_access_token()
+
+    def query(row):
+        return query_outcome(stk_query(row[1], session=session))
+
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(pending.filter(id__gt=last_id).values_list('id', 'checkout_request_id')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            answers = {}
+            for (transaction_id, _), (status, result_code, description) in zip(batch, pool.map(query, batch)):
+                run.checked += 1
+                if status is None:
+                    run.still_pending += 1
+                elif status == 'error':
+                    run.errors += 1
+                else:
+                    answers[transaction_id] = (status, result_code, description)
+            for transaction in apply_outcomes(answers):
+                setattr(run, transaction.status, getattr(run, transaction.status) + 1)
+
+    run.duration_ms = int((time.monotonic() - started) * 1000)
+    run.save()
+    return run
@@ -0,0 +1,99 @@
+"""
+Maintenance of the PaymentDailyTotal rollup behind the payments dashboard.
+
+Every MpesaTransaction remembers the bucket it was loaded in (creation date,
+status, plan) and its amount. When a save moves it, ``track_changes``
+subtracts it from the old bucket and adds it to the new one with ``F()``
+updates. ``post_save``/``post_delete`` signals cover ordinary saves and
+deletes. Bulk writers such as the reconciliation job call ``track_changes``
+themselves. The ``rebuild_payment_totals`` command recomputes the table.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import MySubscription, PaymentDailyTotal
+
+TRACKED_FIELDS = ('created_at', 'status', 'amount')
+
+
+def snapshot(transaction):
+    """``((date, status, plan), amount)`` for a saved transaction, else None."""
+    if transaction.pk is None or any(field in transaction.get_deferred_fields() for field in TRACKED_FIELDS):
+        return None
+    if transaction.created_at is None:
+        return None
+    key = (
+        timezone.localdate(transaction.created_at),
+        transaction.status,
+        MySubscription.type_for_amount(transaction.amount),
+    )
+    return key, Decimal(transaction.amount)
+
+
+def apply_deltas(deltas):
+    """Add ``{(date, status, plan): [count, amount]}`` to the rollup rows."""
+    for (day, status, plan), (count, amount) in deltas.items():
+        if not count and not amount:
+            continue
+        rows = PaymentDailyTotal.objects.filter(date=day, status=status, plan=plan)
+        if rows.update(count=F('count') + count, amount=F('amount') + amount):
+            continue
+        try:
+            with db_transaction.atomic():
+                PaymentDailyTotal.objects.create(date=day, status=status, plan=plan, count=count, amount=amount)
+        except IntegrityError:
+            # Another writer created the row first
+            rows.update(count=F('count') + count, amount=F('amount') + amount)
+
+
+def track_changes(transactions, deleted=False):
+    """Move the given (just saved or deleted) transactions between buckets."""
+    deltas = defaultdict(lambda: [0, Decimal(0)])
+    for transaction in transactions:
+        old = getattr(transaction, '_rollup', None)
+        new = None if deleted else snapshot(transaction)
+        if old == new:
+            continue
+        if old is not None:
+            deltas[old[0]][0] -= 1
+            deltas[old[0]][1] -= old[1]
+        if new is not None:
+            deltas[new[0]][0] += 1
+            deltas[new[0]][1] += new[1]
+        transaction._rollup = new
+    apply_deltas(deltas)
+
+
+def compute_daily_totals():
+    """The rollup from scratch, as ``{(date, status, plan): (count, amount)}``."""
+    from .models import MpesaTransaction
+
+    totals = defaultdict(lambda: [0, Decimal(0)])
+    rows = (
+        MpesaTransaction.objects.annotate(day=TruncDate('created_at'))
+        .values('day', 'status', 'amount')
+        .annotate(n=Count('id'), total=Sum('amount'))
+        .order_by()
+    )
+    for row in rows:
+        key = (row['day'], row['status'], MySubscription.type_for_amount(row['amount']))
+        totals[key][0] += row['n']
+        totals[key][1] += row['total']
+    return {key: (count, amount) for key, (count, amount) in totals.items()}
+
+
+def rebuild_daily_totals():
+    """Replace the rollup. Returns the number of rows written."""
+    totals = compute_daily_totals()
+    with db_transaction.atomic():
+        PaymentDailyTotal.objects.all().delete()
+        PaymentDailyTotal.objects.bulk_create([
+            PaymentDailyTotal(date=day, status=status, plan=plan, count=count, amount=amount)
+            for (day, status, plan), (count, amount) in totals.items()
+        ], batch_size=1000)
+    return len(totals)
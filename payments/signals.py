@@ -0,0 +1,33 @@
+"""
+Signals keeping the payments dashboard rollup (PaymentDailyTotal) in step
+with MpesaTransaction saves and deletes, and dropping cached entitlements
+when a subscription changes
+"""
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .entitlements import invalidate_entitlements
+from .models import MpesaTransaction, MySubscription
+from .rollups import snapshot, track_changes
+
+
+@receiver(post_init, sender=MpesaTransaction)
+def remember_rollup_bucket(sender, instance, **kwargs):
+    """Remember the bucket a transaction was loaded in."""
+    instance._rollup = snapshot(instance)
+
+
+@receiver(post_save, sender=MpesaTransaction)
+def update_daily_totals(sender, instance, **kwargs):
+    track_changes([instance])
+
+
+@receiver(post_delete, sender=MpesaTransaction)
+def remove_from_daily_totals(sender, instance, **kwargs):
+    track_changes([instance], deleted=True)
+
+
+@receiver(post_save, sender=MySubscription)
+@receiver(post_delete, sender=MySubscription)
+def drop_cached_entitlement(sender, instance, **kwargs):
+    invalidate_entitlements([instance.user_id])
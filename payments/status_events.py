@@ -0,0 +1,126 @@
+"""
+Transaction status pub-sub for the payment page.
+
+Instead of the browser polling ``check_transaction_status`` (a database read
+per poll), the page long-polls ``wait_transaction_status`` with the status it
+last saw and the request returns as soon as the status changes. A wait holds
+a sync worker, so it is kept short (``MPESA_STATUS_WAIT_SECONDS``) and the
+page pauses between waits:
+
+- ``publish_status`` writes the transaction's status payload to the cache
+  and wakes any waiters in this process; it is called when the background
+  STK push finishes and when ``mpesa_callback`` records the result
+- waiters read the cached payload, sleeping on a process-local condition
+  between reads, so a callback handled by the same worker answers them
+  immediately and one handled by another worker (shared cache, see
+  ``REDIS_URL``) within ``STATUS_POLL_INTERVAL``
+- the database is read only when nothing is cached yet (cached payloads
+  expire after ``STATUS_TTL``). With a per-process cache it is also read
+  once at the end of a wait that saw no change, so a callback handled by
+  another worker cannot leave a page waiting forever; a shared cache
+  (``MPESA_STATUS_TRUST_CACHE``) sees every publish, so its payload is
+  returned as is
+- ``keep_waiting`` tells the page to stop once a pending transaction is
+  older than ``MPESA_CALLBACK_MATCH_HOURS``: a callback can no longer be
+  matched to it and reconciliation settles it instead
+
+``check_transaction_status`` always reads the database (and refreshes the
+cached payload): the cache is only the long-poll's fast path.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import MpesaTransaction
+
+STATUS_KEY = 'mpesa:transaction:{}:status'
+STATUS_TTL = 60
+# Seconds between cache reads while waiting for another worker's publish
+STATUS_POLL_INTERVAL = 0.25
+
+_changed = threading.Condition()
+_generation = 0
+
+
+def status_key(transaction_id):
+    return STATUS_KEY.format(transaction_id)
+
+
+def status_payload(transaction):
+    """The JSON shape returned by the status endpoints (plus ``user_id``)."""
+    return {
+        'transaction_id': transaction.id,
+        'user_id': transaction.user_id,
+        'status': transaction.status,
+        'mpesa_receipt_number': transaction.mpesa_receipt_number,
+        'amount': str(transaction.amount),
+        'phone_number': transaction.phone_number,
+        'created_at': transaction.created_at.isoformat(),
+        'updated_at': transaction.updated_at.isoformat(),
+        'result_code': transaction.result_code,
+        'result_description': transaction.result_description,
+        'is_successful': transaction.is_successful(),
+    }
+
+
+def publish_status(transaction):
+    """Store the transaction's current status and wake local waiters."""
+    global _generation
+    payload = status_payload(transaction)
+    cache.set(status_key(transaction.id), payload, timeout=STATUS_TTL)
+    with _changed:
+        _generation += 1
+        _changed.notify_all()
+    return payload
+
+
+def load_status(transaction_id):
+    """Read the status from the database and cache it; None if unknown."""
+    transaction = MpesaTransaction.objects.filter(id=transaction_id).first()
+    if transaction is None:
+        return None
+    return publish_status(transaction)
+
+
+def current_status(transaction_id):
+    """The cached status payload, loading it from the database on a miss."""
+    return cache.get(status_key(transaction_id)) or load_status(transaction_id)
+
+
+def wait_for_status(transaction_id, seen_status, timeout=None):
+    """
+    Return the status payload once its status differs from ``seen_status``,
+    or the current payload after ``timeout`` seconds
+    (``MPESA_STATUS_WAIT_SECONDS`` by default). None if the transaction
+    does not exist.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'MPESA_STATUS_WAIT_SECONDS', 2)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        generation = _generation
+        payload = current_status(transaction_id)
+        if payload is None or payload['status'] != seen_status:
+            return payload
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if getattr(settings, 'MPESA_STATUS_TRUST_CACHE', False):
+                return payload
+            # Nothing arrived through this process's cache: confirm against the database
+            return load_status(transaction_id)
+        with _changed:
+            if _generation == generation:
+                _changed.wait(min(remaining, STATUS_POLL_INTERVAL))
+
+
+def keep_waiting(payload):
+    """Whether the page should keep waiting for this payload's transaction."""
+    if payload['status'] != 'pending':
+        return False
+    since = timezone.now() - timedelta(hours=settings.MPESA_CALLBACK_MATCH_HOURS)
+    return datetime.fromisoformat(payload['created_at']) >= since
@@ -1,3 +1,583 @@
-from django.test import TestCase
+import json
+from io import StringIO
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.urls import reverse
+
+from users.models import MyUser
+
+from . import callback_matching, entitlements, mpesa_utils, reconciliation, rollups, status_events
+from .fake_daraja import FakeDaraja
+from .models import MpesaCallback, MpesaTransaction, MySubscription, PaymentDailyTotal, ReconciliationRun
+
+
+def auth_response(token, expires_in=3599):
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'access_token': token, 'expires_in': str(expires_in)}
+    return response
+
+
+@override_settings(MPESA_TOKEN_REFRESH_IN_BACKGROUND=False, MPESA_TOKEN_WAIT_SECONDS=0)
+class AccessTokenCacheTests(TestCase):
+    def setUp(self):
+        cache.delete(mpesa_utils.TOKEN_CACHE_KEY)
+        cache.delete(mpesa_utils.TOKEN_LOCK_KEY)
+
+    @mock.patch('payments.mpesa_utils.requests.get')
+    def test_token_is_fetched_once_and_reused(self, get):
+        get.return_value = auth_response('first')
+        self.assertEqual(mpesa_utils.get_access_token(), 'first')
+        self.assertEqual(mpesa_utils.get_access_token(), 'first')
+        self.assertEqual(get.call_count, 1)
+
+    @mock.patch('payments.mpesa_utils.requests.get')
+    def test_token_is_refreshed_ahead_of_expiry(self, get):
+        cache.set(mpesa_utils.TOKEN_CACHE_KEY, {'token': 'old', 'expires_at': time.time() + 60})
+        get.return_value = auth_response('new')
+        self.assertEqual(mpesa_utils.get_access_token(), 'new')
+        self.assertEqual(cache.get(mpesa_utils.TOKEN_CACHE_KEY)['token'], 'new')
+        self.assertIsNone(cache.get(mpesa_utils.TOKEN_LOCK_KEY))
+
+    @mock.patch('payments.mpesa_utils.requests.get')
+    def test_valid_token_is_served_while_another_worker_refreshes(self, get):
+        cache.set(mpesa_utils.TOKEN_CACHE_KEY, {'token': 'old', 'expires_at': time.time() + 60})
+        cache.add(mpesa_utils.TOKEN_LOCK_KEY, 1)
+        self.assertEqual(mpesa_utils.get_access_token(), 'old')
+        get.assert_not_called()
+
+    @mock.patch('payments.mpesa_utils.requests.post')
+    @mock.patch('payments.mpesa_utils.requests.get')
+    def test_rejected_token_is_replaced_once(self, get, post):
+        cache.set(mpesa_utils.TOKEN_CACHE_KEY, {'token': 'revoked', 'expires_at': time.time() + 3000})
+        get.return_value = auth_response('fresh')
+        rejected = mock.Mock(status_code=404)
+        rejected.json.return_value = {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}
+        accepted = mock.Mock(status_code=200)
+        accepted.json.return_value = {'MerchantRequestID': 'm-1', 'CheckoutRequestID': 'c-1', 'ResponseCode': '0'}
+        post.side_effect = [rejected, accepted]
+
+        result = mpesa_utils.stk_push('0712345678', 1, 'TSC1', 'Subscription')
+        self.assertTrue(result['success'])
+        self.assertEqual(post.call_args.kwargs['headers']['Authorization'], 'Bearer fresh')
+        self.assertEqual(get.call_count, 1)
+
+
+def stk_accepted(checkout_request_id='c-1'):
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {
+        'MerchantRequestID': 'm-1', 'CheckoutRequestID': checkout_request_id, 'ResponseCode': '0',
+    }
+    return response
+
+
+@override_settings(MPESA_TOKEN_REFRESH_IN_BACKGROUND=False, MPESA_STATUS_WAIT_SECONDS=0)
+class PaymentStatusTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set(mpesa_utils.TOKEN_CACHE_KEY, {'token': 'valid', 'expires_at': time.time() + 3000})
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        self.client.login(email='payer@test.com', password='password')
+
+    def initiate(self):
+        return self.client.post(
+            reverse('payments:initiate_payment'),
+            data=json.dumps({'phone_number': '0712345678', 'plan': 'standard'}),
+            content_type='application/json',
+        )
+
+    def callback(self, checkout_request_id, result_code, desc):
+        return self.client.post(
+            reverse('payments:mpesa_callback'),
+            data=json.dumps({'Body': {'stkCallback': {
+                'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code, 'ResultDesc': desc,
+            }}}),
+            content_type='application/json',
+        )
+
+    @mock.patch('payments.mpesa_utils.requests.post')
+    def test_initiate_returns_before_the_stk_push(self, post):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.initiate()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(callbacks), 1)
+        post.assert_not_called()
+
+        transaction = MpesaTransaction.objects.get(id=response.json()['transaction_id'])
+        self.assertEqual(transaction.status, 'pending')
+        self.assertEqual(response.json()['status_url'],
+                         reverse('payments:wait_transaction_status', args=[transaction.id]))
+
+    @override_settings(MPESA_STK_IN_BACKGROUND=False)
+    @mock.patch('payments.mpesa_utils.requests.post')
+    def test_push_updates_the_initiated_transaction(self, post):
+        post.return_value = stk_accepted('c-42')
+        response = self.initiate()
+        self.assertEqual(response.status_code, 200)
+        transaction = MpesaTransaction.objects.get()
+        self.assertEqual(str(transaction.id), response.json()['transaction_id'])
+        self.assertEqual(transaction.checkout_request_id, 'c-42')
+
+    @override_settings(MPESA_STK_IN_BACKGROUND=False)
+    @mock.patch('payments.mpesa_utils.requests.post')
+    def test_refused_push_is_published_as_failed(self, post):
+        refused = mock.Mock(status_code=400)
+        refused.json.return_value = {'errorCode': '400.002.02', 'errorMessage': 'Invalid PhoneNumber'}
+        post.return_value = refused
+        response = self.initiate()
+        self.assertEqual(response.status_code, 400)
+        transaction = MpesaTransaction.objects.get()
+        self.assertEqual(transaction.status, 'failed')
+        self.assertEqual(cache.get(status_events.status_key(transaction.id))['status'], 'failed')
+
+    @override_settings(MPESA_STK_IN_BACKGROUND=False)
+    @mock.patch('payments.mpesa_utils.requests.post')
+    def test_callback_is_served_from_the_cache(self, post):
+        post.return_value = stk_accepted('c-7')
+        transaction_id = self.initiate().json()['transaction_id']
+        url = reverse('payments:wait_transaction_status', args=[transaction_id])
+        self.assertEqual(self.client.get(url, {'status': 'pending'}).json()['status'], 'pending')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.callback('c-7', 1032, 'Request cancelled by user')
+        with self.assertNumQueries(0):
+            payload = status_events.wait_for_status(int(transaction_id), 'pending', timeout=1)
+        self.assertEqual(payload['status'], 'cancelled')
+        self.assertEqual(self.client.get(url, {'status': 'pending'}).json()['status'], 'cancelled')
+
+    def test_check_status_reads_the_database(self):
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+        )
+        status_events.publish_status(transaction)
+        # Settled by another process: this process's cache still says pending
+        MpesaTransaction.objects.filter(id=transaction.id).update(status='completed')
+        response = self.client.get(reverse('payments:check_transaction_status', args=[transaction.id]))
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertEqual(cache.get(status_events.status_key(transaction.id))['status'], 'completed')
+
+    def test_waiter_wakes_on_publish(self):
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+        )
+        status_events.publish_status(transaction)
+        transaction.status = 'completed'
+        timer = threading.Timer(0.05, status_events.publish_status, args=(transaction,))
+        timer.start()
+        started = time.monotonic()
+        payload = status_events.wait_for_status(transaction.id, 'pending', timeout=5)
+        timer.join()
+        self.assertEqual(payload['status'], 'completed')
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_shared_cache_is_trusted_at_the_end_of_a_wait(self):
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+        )
+        status_events.publish_status(transaction)
+        with override_settings(MPESA_STATUS_TRUST_CACHE=True), self.assertNumQueries(0):
+            payload = status_events.wait_for_status(transaction.id, 'pending', timeout=0)
+        self.assertEqual(payload['status'], 'pending')
+        with self.assertNumQueries(1):
+            status_events.wait_for_status(transaction.id, 'pending', timeout=0)
+
+    def test_page_stops_waiting_after_the_callback_window(self):
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+        )
+        url = reverse('payments:wait_transaction_status', args=[transaction.id])
+        with override_settings(MPESA_STATUS_WAIT_SECONDS=0):
+            self.assertTrue(self.client.get(url, {'status': 'pending'}).json()['keep_waiting'])
+            MpesaTransaction.objects.filter(id=transaction.id).update(
+                created_at=timezone.now() - timezone.timedelta(hours=settings.MPESA_CALLBACK_MATCH_HOURS, minutes=1)
+            )
+            cache.delete(status_events.status_key(transaction.id))
+            self.assertFalse(self.client.get(url, {'status': 'pending'}).json()['keep_waiting'])
+
+    def test_other_users_cannot_see_the_status(self):
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+        )
+        MyUser.objects.create_user(email='other@test.com', password='password')
+        self.client.login(email='other@test.com', password='password')
+        response = self.client.get(reverse('payments:wait_transaction_status', args=[transaction.id]))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('payments:check_transaction_status', args=[transaction.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+
+def success_callback(checkout_request_id, receipt='RCP123'):
+    return json.dumps({'Body': {'stkCallback': {
+        'CheckoutRequestID': checkout_request_id, 'ResultCode': 0, 'ResultDesc': 'Success',
+        'CallbackMetadata': {'Item': [
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]},
+    }}})
+
+
+class CallbackIdempotencyTests(TestCase):
+    def setUp(self):
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        self.transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+            checkout_request_id='c-1',
+        )
+
+    def deliver(self, body):
+        return self.client.post(reverse('payments:mpesa_callback'), data=body, content_type='application/json')
+
+    def test_duplicate_callback_extends_the_subscription_once(self):
+        self.assertEqual(self.deliver(success_callback('c-1')).status_code, 200)
+        expiry = MySubscription.objects.get(user=self.user).expiry_date
+        response = self.deliver(success_callback('c-1'))
+        self.assertEqual(response.json()['message'], 'Callback already processed')
+        self.assertEqual(MySubscription.objects.get(user=self.user).expiry_date, expiry)
+        self.assertEqual(MpesaCallback.objects.get().transaction, self.transaction)
+
+    def test_reused_receipt_number_is_not_applied_twice(self):
+        self.deliver(success_callback('c-1', receipt='RCP9'))
+        MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+            checkout_request_id='c-2',
+        )
+        expiry = MySubscription.objects.get(user=self.user).expiry_date
+        response = self.deliver(success_callback('c-2', receipt='RCP9'))
+        self.assertEqual(response.json()['message'], 'Callback already processed')
+        self.assertEqual(MySubscription.objects.get(user=self.user).expiry_date, expiry)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='c-2').status, 'pending')
+
+
+class CallbackFallbackTests(TestCase):
+    def setUp(self):
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        self.transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='0712345678', amount=100, account_reference=f'TSC{self.user.id}',
+            merchant_request_id='m-1',
+        )
+
+    def match(self, **result):
+        return callback_matching.find_callback_transaction(result)
+
+    def test_fallback_paths(self):
+        self.assertEqual(self.match(MerchantRequestID='m-1'), self.transaction)
+        self.assertEqual(self.match(AccountReference=f'TSC{self.user.id}'), self.transaction)
+        self.assertEqual(self.match(AccountReference=f'TSC{self.user.id}_{self.transaction.id}'), self.transaction)
+        self.assertEqual(self.match(CallbackMetadata={'Item': [
+            {'Name': 'Amount', 'Value': 100}, {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}), self.transaction)
+        self.assertIsNone(self.match(CallbackMetadata={'Item': [
+            {'Name': 'Amount', 'Value': 200}, {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}))
+        self.assertIsNone(self.match(AccountReference='TSCnot-a-number'))
+
+    def test_only_recent_pending_transactions_match(self):
+        MpesaTransaction.objects.filter(id=self.transaction.id).update(
+            created_at=timezone.now() - timezone.timedelta(hours=25)
+        )
+        self.assertIsNone(self.match(AccountReference=f'TSC{self.user.id}'))
+        self.assertIsNone(self.match(MerchantRequestID='m-1'))
+
+    def test_callback_with_unknown_checkout_id_settles_the_match(self):
+        body = json.loads(success_callback('c-new'))
+        body['Body']['stkCallback']['MerchantRequestID'] = 'm-1'
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('payments:mpesa_callback'), data=json.dumps(body), content_type='application/json'
+            )
+        self.assertEqual(response.json()['message'], 'Callback processed successfully')
+        self.transaction.refresh_from_db()
+        self.assertEqual((self.transaction.checkout_request_id, self.transaction.status), ('c-new', 'completed'))
+
+    def test_lookups_use_the_indexes(self):
+        since = timezone.now() - timezone.timedelta(hours=24)
+        for lookup in ({'user_id': 1}, {'account_reference': 'X1'}, {'phone_normalized': '254712345678'}):
+            plan = MpesaTransaction.objects.filter(
+                status='pending', created_at__gte=since, **lookup
+            ).order_by('-created_at')[:1].explain()
+            self.assertIn('USING INDEX', plan, lookup)
+
+
+class ConcurrentCallbackTests(TransactionTestCase):
+    """Duplicate deliveries racing each other from separate threads."""
+
+    def test_concurrent_duplicates_apply_once(self):
+        user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        MpesaTransaction.objects.create(
+            user=user, phone_number='254712345678', amount=100, account_reference='TSC1',
+            checkout_request_id='c-1',
+        )
+        body = success_callback('c-1')
+        barrier = threading.Barrier(4)
+        statuses = []
+
+        def deliver():
+            try:
+                barrier.wait()
+                response = self.client_class().post(
+                    reverse('payments:mpesa_callback'), data=body, content_type='application/json'
+                )
+                statuses.append((response.status_code, response.json()['message']))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=deliver) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        subscription = MySubscription.objects.get(user=user)
+        days = (subscription.expiry_date - timezone.now()).days
+        self.assertIn(days, (179, 180))
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'completed')
+        # The other deliveries are skipped, or (SQLite's shared test database
+        # reports lock errors instead of waiting) refused so M-Pesa retries
+        messages = [message for _, message in statuses]
+        self.assertEqual(messages.count('Callback processed successfully'), 1)
+        for status, message in statuses:
+            if message != 'Callback processed successfully':
+                self.assertTrue(message == 'Callback already processed' or status == 500, message)
+
+
+class FakeQuerySession:
+    """Answers STK queries from a ``{checkout_request_id: data}`` table."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queried = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        self.queried.append(json['CheckoutRequestID'])
+        data = self.answers[json['CheckoutRequestID']]
+        response = mock.Mock(status_code=200 if 'ResultCode' in data else 500)
+        response.json.return_value = data
+        return response
+
+
+@override_settings(MPESA_TOKEN_REFRESH_IN_BACKGROUND=False)
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        cache.set(mpesa_utils.TOKEN_CACHE_KEY, {'token': 'valid', 'expires_at': time.time() + 3000})
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        old = timezone.now() - timezone.timedelta(hours=1)
+        for checkout_request_id in ('paid', 'cancelled', 'waiting', 'settled', 'fresh'):
+            MpesaTransaction.objects.create(
+                user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1',
+                checkout_request_id=checkout_request_id,
+            )
+        MpesaTransaction.objects.exclude(checkout_request_id='fresh').update(created_at=old)
+        rollups.rebuild_daily_totals()  # update() bypasses the rollup signals
+        # A callback already settled this one while it was still pending here
+        MpesaCallback.objects.create(checkout_request_id='settled', result_code='0')
+        self.session = FakeQuerySession({
+            'paid': {'ResultCode': '0', 'ResultDesc': 'The service request is processed successfully.'},
+            'cancelled': {'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'},
+            'waiting': {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'},
+            'settled': {'ResultCode': '0', 'ResultDesc': 'Success'},
+        })
+
+    def status(self, checkout_request_id):
+        return MpesaTransaction.objects.get(checkout_request_id=checkout_request_id).status
+
+    def test_pending_transactions_are_settled_in_batches(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            run = reconciliation.reconcile_pending(batch_size=2, workers=2, session=self.session)
+
+        self.assertEqual(sorted(self.session.queried), ['cancelled', 'paid', 'settled', 'waiting'])
+        self.assertEqual(self.status('paid'), 'completed')
+        self.assertEqual(self.status('cancelled'), 'cancelled')
+        self.assertEqual(self.status('waiting'), 'pending')
+        self.assertEqual(self.status('settled'), 'pending')
+        self.assertEqual(self.status('fresh'), 'pending')
+        self.assertEqual((run.checked, run.completed, run.cancelled, run.still_pending), (4, 1, 1, 1))
+        self.assertEqual(ReconciliationRun.objects.get(), run)
+
+        subscription = MySubscription.objects.get(user=self.user)
+        self.assertEqual(subscription.sub_type, 'Standard')
+        self.assertEqual((subscription.expiry_date - timezone.now()).days, MySubscription.PERIOD_DAYS - 1)
+        paid = MpesaTransaction.objects.get(checkout_request_id='paid')
+        self.assertEqual(MpesaCallback.objects.get(checkout_request_id='paid').transaction, paid)
+        self.assertEqual(cache.get(status_events.status_key(paid.id))['status'], 'completed')
+
+    def test_rollup_stays_consistent(self):
+        reconciliation.reconcile_pending(session=self.session)
+        self.assertEqual(PaymentDailyTotal.objects.get(status='completed').count, 1)
+        call_command('rebuild_payment_totals', '--check', stdout=StringIO())
+
+    def test_settled_transactions_are_not_queried_again(self):
+        reconciliation.reconcile_pending(session=self.session)
+        self.session.queried = []
+        run = reconciliation.reconcile_pending(session=self.session)
+        self.assertEqual(sorted(self.session.queried), ['settled', 'waiting'])
+        self.assertEqual(run.completed, 0)
+
+    def test_command_reports_the_run(self):
+        out = StringIO()
+        with mock.patch('payments.reconciliation.requests.Session', return_value=self.session):
+            call_command('reconcile_payments', '--workers', '2', stdout=out)
+        self.assertIn('Checked 4 pending transaction(s)', out.getvalue())
+        self.assertIn('1 completed, 1 cancelled', out.getvalue())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class PaymentDashboardTests(TestCase):
+    def setUp(self):
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+        MyUser.objects.create_superuser(email='admin@test.com', password='password')
+        self.client.login(email='admin@test.com', password='password')
+
+    def create(self, checkout_request_id, amount=100, status='pending', receipt=None):
+        return MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=amount, account_reference='TSC1',
+            checkout_request_id=checkout_request_id, status=status, mpesa_receipt_number=receipt,
+        )
+
+    def totals(self):
+        return {
+            (status, plan): (count, int(amount))
+            for status, plan, count, amount in PaymentDailyTotal.objects.filter(count__gt=0).values_list(
+                'status', 'plan', 'count', 'amount'
+            )
+        }
+
+    def test_rollup_follows_status_and_amount_changes(self):
+        first = self.create('c-1')
+        second = self.create('c-2', amount=200)
+        self.assertEqual(self.totals(), {('pending', 'Standard'): (1, 100), ('pending', 'Premium'): (1, 200)})
+
+        first.status = 'completed'
+        first.save()
+        second = MpesaTransaction.objects.get(pk=second.pk)
+        second.amount = 100
+        second.save()
+        self.assertEqual(self.totals(), {('completed', 'Standard'): (1, 100), ('pending', 'Standard'): (1, 100)})
+
+        second.delete()
+        self.assertEqual(self.totals(), {('completed', 'Standard'): (1, 100)})
+        call_command('rebuild_payment_totals', '--check', stdout=StringIO())
+
+    def test_rebuild_repairs_the_rollup(self):
+        self.create('c-1')
+        PaymentDailyTotal.objects.update(count=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_payment_totals', '--check', stdout=StringIO())
+        call_command('rebuild_payment_totals', stdout=StringIO())
+        self.assertEqual(self.totals(), {('pending', 'Standard'): (1, 100)})
+
+    def test_dashboard_totals_come_from_the_rollup(self):
+        self.create('c-1', status='completed', receipt='RCP1')
+        self.create('c-2', amount=200, status='completed', receipt='RCP2')
+        self.create('c-3', status='failed')
+        response = self.client.get(reverse('payments:admin_payments'), {'status': 'completed'})
+        self.assertEqual(response.context['total_payments'], 2)
+        self.assertEqual(response.context['total_amount'], 300)
+        self.assertEqual(list(response.context['status_counts']), [{'status': 'completed', 'count': 2}])
+        self.assertEqual(len(response.context['page_obj']), 2)
+
+    def test_search_is_exact(self):
+        paid = self.create('ws_CO_1', status='completed', receipt='RCP1ABC')
+        self.create('ws_CO_2')
+        url = reverse('payments:admin_payments')
+        self.assertEqual(list(self.client.get(url, {'search': 'rcp1abc'}).context['page_obj']), [paid])
+        self.assertEqual(list(self.client.get(url, {'search': 'ws_CO_1'}).context['page_obj']), [paid])
+        self.assertEqual(self.client.get(url, {'search': '0712345678'}).context['total_payments'], 2)
+        self.assertEqual(self.client.get(url, {'search': f'TSC{self.user.id}'}).context['total_payments'], 2)
+        self.assertEqual(self.client.get(url, {'search': 'RCP1'}).context['total_payments'], 0)
+
+
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = MyUser.objects.create_user(email='payer@test.com', password='password')
+
+    @override_settings(ENTITLEMENT_CACHE_SECONDS=3600)
+    def test_entitlement_is_cached_until_the_subscription_changes(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(entitlements.get_entitlement(self.user).has_subscription)
+        with self.assertNumQueries(0):
+            self.assertFalse(entitlements.get_entitlement(self.user).is_active)
+
+        subscription = MySubscription.objects.create(
+            user=self.user, sub_type='Premium', expiry_date=timezone.now() + timezone.timedelta(days=10, hours=1)
+        )
+        entitlement = entitlements.get_entitlement(self.user)
+        self.assertEqual((entitlement.plan, entitlement.is_active, entitlement.days_remaining), ('Premium', True, 10))
+
+        subscription.cancel_subscription()
+        with self.assertNumQueries(1):
+            self.assertFalse(entitlements.get_entitlement(self.user).is_active)
+
+    def test_entitlement_is_loaded_once_per_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertNumQueries(1):
+            first = entitlements.entitlement_for(request)
+            cache.clear()
+            self.assertIs(entitlements.entitlement_for(request), first)
+
+    def test_change_made_by_another_process_is_seen(self):
+        # Without a shared cache nothing outlives the request, so a change
+        # no signal in this process saw (another worker, the cron job) shows
+        self.assertFalse(entitlements.get_entitlement(self.user).is_active)
+        MySubscription.objects.bulk_create([MySubscription(
+            user=self.user, sub_type='Premium', expiry_date=timezone.now() + timezone.timedelta(days=10),
+        )])
+        self.assertTrue(entitlements.get_entitlement(self.user).is_active)
+
+    @override_settings(ENTITLEMENT_CACHE_SECONDS=3600)
+    def test_bulk_extension_drops_the_cached_entitlement(self):
+        self.assertFalse(entitlements.get_entitlement(self.user).is_active)
+        transaction = MpesaTransaction.objects.create(
+            user=self.user, phone_number='254712345678', amount=100, account_reference='TSC1', status='completed',
+        )
+        reconciliation.extend_subscriptions([transaction], timezone.now())
+        self.assertEqual(entitlements.get_entitlement(self.user).plan, 'Standard')
+
+
+@override_settings(MPESA_TOKEN_REFRESH_IN_BACKGROUND=False)
+class FakeDarajaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.delivered = []
+        self.daraja = FakeDaraja(
+            callback_delay=(0, 0), duplicate_rate=1.0, callback_sender=self.capture, seed=1
+        ).start()
+        self.addCleanup(self.daraja.stop)
+        base = self.daraja.url
+        settings_override = override_settings(
+            MPESA_AUTH_URL=f'{base}/oauth/v1/generate?grant_type=client_credentials',
+            MPESA_STK_PUSH_URL=f'{base}/mpesa/stkpush/v1/processrequest',
+            MPESA_QUERY_URL=f'{base}/mpesa/stkpushquery/v1/query',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def capture(self, url, body):
+        self.delivered.append(json.loads(body))
+        return 200
+
+    def test_push_callbacks_and_query(self):
+        result = mpesa_utils.stk_push('0712345678', 100, 'TSC1', 'Subscription')
+        self.assertTrue(result['success'])
+        self.assertTrue(self.daraja.wait_idle(timeout=5))
+
+        self.assertEqual(len(self.delivered), 2)  # sent twice
+        callback = self.delivered[0]['Body']['stkCallback']
+        self.assertEqual(callback['CheckoutRequestID'], result['checkout_request_id'])
+        self.assertEqual(callback['ResultCode'], 0)
+
+        answer = mpesa_utils.stk_query(result['checkout_request_id'])
+        self.assertEqual(reconciliation.query_outcome(answer)[0], 'completed')
+        self.assertEqual(self.daraja.stats['tokens'], 1)
@@ -21,4 +21,5 @@ urlpatterns = [
     path('initiate-payment/', csrf_exempt(views.initiate_payment), name='initiate_payment'),
     path('mpesa-callback/', csrf_exempt(views.mpesa_callback), name='mpesa_callback'),
     path('transaction/<int:transaction_id>/', views.check_transaction_status, name='check_transaction_status'),
+    path('transaction/<int:transaction_id>/wait/', views.wait_transaction_status, name='wait_transaction_status'),
 ]
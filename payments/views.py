@@ -7,10 +7,15 @@ from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction as db_transaction
 from django.views import View
+from django.urls import reverse
 from django.utils import timezone
-from .models import MpesaTransaction
-from .mpesa_utils import stk_push
+from .callback_matching import callback_items, find_callback_transaction
+from .models import MpesaCallback, MpesaTransaction
+from .mpesa_utils import callback_outcome, start_stk_push
+from .status_events import current_status, keep_waiting, load_status, publish_status, wait_for_status
 
 class PaymentView(View):
     """View to display the payment page"""
@@ -142,59 +147,26 @@ def initiate_payment(request):
             # Store subscription type in transaction description
             transaction_desc = f"{sub_type} Subscription - {description}"
             
-            # Initiate STK push
-            response = stk_push(
-                phone_number=phone_number,
-                amount=amount,
-                account_reference=account_reference,
-                description=transaction_desc,
-                user=request.user
-            )
-            
-            # Save the response to the transaction
-            if 'error' in response:
-                transaction.status = 'failed'
-                transaction.result_code = 'ERROR'
-                transaction.result_description = response.get('error', 'Unknown error')
-                transaction.save()
-                return JsonResponse(
-                    {'error': response['error']}, 
-                    status=400
-                )
-            
-            # Update transaction with response details
-            merchant_request_id = response.get('merchant_request_id')
-            checkout_request_id = response.get('checkout_request_id')
-            
-            # Check if a transaction with this checkout_request_id already exists
-            if checkout_request_id:
-                try:
-                    # Try to get an existing transaction with this checkout_request_id
-                    existing_with_checkout = MpesaTransaction.objects.get(
-                        checkout_request_id=checkout_request_id
+            # Send the STK push in the background; the page follows the
+            # transaction through wait_transaction_status
+            response = start_stk_push(transaction, transaction_desc)
+            if response is not None:
+                if 'error' in response:
+                    return JsonResponse(
+                        {'error': response['error']}, 
+                        status=400
                     )
-                    # If we get here, a transaction with this ID exists
-                    if existing_with_checkout.id != transaction.id:
-                        # If it's a different transaction, delete the new one and use the existing
-                        transaction.delete()
-                        transaction = existing_with_checkout
-                        print(f"Using existing transaction {transaction.id} with checkout_request_id {checkout_request_id}")
-                except MpesaTransaction.DoesNotExist:
-                    # No existing transaction with this ID, update the current one
-                    transaction.merchant_request_id = merchant_request_id
-                    transaction.checkout_request_id = checkout_request_id
-                    transaction.save()
+                checkout_request_id = response.get('checkout_request_id')
             else:
-                # If no checkout_request_id, just save the merchant_request_id
-                transaction.merchant_request_id = merchant_request_id
-                transaction.save()
+                checkout_request_id = None
             
             return JsonResponse({
                 'status': 'success',
                 'message': 'Payment initiated successfully',
                 'transaction_id': str(transaction.id),
-                'checkout_request_id': checkout_request_id
-            })
+                'checkout_request_id': checkout_request_id,
+                'status_url': reverse('payments:wait_transaction_status', args=[transaction.id]),
+            }, status=202 if response is None else 200)
             
         except json.JSONDecodeError:
             return JsonResponse(
@@ -212,6 +184,165 @@ def initiate_payment(request):
         {'error': 'Only POST requests are allowed'}, 
         status=405
     )
+
+
+@db_transaction.atomic
+def _apply_callback(request, result, result_code, result_desc, checkout_request_id):
+    """
+    Apply an STK callback to its transaction and the user's subscription in
+    one database transaction, holding a lock on the transaction row.
+    """
+    # Find the transaction by checkout_request_id first (primary method)
+    transaction = None
+    try:
+        if checkout_request_id:
+            print(f"Looking up transaction with checkout_request_id: {checkout_request_id}")
+            transaction = MpesaTransaction.objects.select_for_update().get(
+                checkout_request_id=checkout_request_id
+            )
+            print(f"Found transaction by checkout_request_id: {transaction.id}")
+    except MpesaTransaction.DoesNotExist:
+        print(f"No transaction found with checkout_request_id: {checkout_request_id}")
+    
+    # If not found by checkout_request_id, fall back to the bounded, indexed
+    # matches in callback_matching
+    if not transaction:
+        transaction = find_callback_transaction(result)
+        if transaction:
+            print(f"Found transaction {transaction.id} by fallback match")
+            # Update the checkout_request_id for future reference
+            transaction.checkout_request_id = checkout_request_id
+            transaction.save(update_fields=['checkout_request_id', 'updated_at'])
+    
+    if not transaction:
+        print(f"Error: Could not find transaction with checkout_request_id {checkout_request_id}")
+        return JsonResponse(
+            {'status': 'error', 'message': 'Transaction not found'}, 
+            status=404
+        )
+    
+    print(f"Processing transaction ID: {transaction.id}")
+    print(f"Current transaction user: {transaction.user} (ID: {transaction.user.id if transaction.user else 'None'})")
+    print(f"Current status: {transaction.status}")
+    
+    # Each CheckoutRequestID is applied once: a duplicate delivery either
+    # finds the ledger row here (the row lock makes it wait for the first)
+    # or fails the unique insert below
+    if MpesaCallback.objects.filter(checkout_request_id=checkout_request_id).exists():
+        print(f"Callback for {checkout_request_id} was already processed")
+        return JsonResponse({
+            'status': 'success', 
+            'message': 'Callback already processed',
+            'transaction_id': str(transaction.id)
+        })
+    MpesaCallback.objects.create(
+        checkout_request_id=checkout_request_id,
+        transaction=transaction,
+        result_code=result_code
+    )
+    
+    # If transaction is already completed, don't process again
+    if transaction.status == 'completed':
+        print(f"Transaction {transaction.id} is already marked as completed")
+        return JsonResponse({
+            'status': 'success', 
+            'message': 'Callback already processed',
+            'transaction_id': str(transaction.id)
+        })
+        
+    # Update transaction status based on result code
+    if result_code == '0':
+        # Success
+        # Extract payment details from callback
+        payment_data = callback_items(result)
+        
+        # Update transaction with payment details
+        transaction.mpesa_receipt_number = payment_data.get('MpesaReceiptNumber')
+        
+        # Update phone number if available in callback
+        if 'PhoneNumber' in payment_data:
+            transaction.phone_number = str(payment_data['PhoneNumber'])
+        
+        # Ensure the user is set if it's not already
+        if transaction.user is None and hasattr(request, 'user') and request.user.is_authenticated:
+            transaction.user = request.user
+        
+        # Update transaction date if available
+        if 'TransactionDate' in payment_data:
+            try:
+                transaction_date = str(payment_data['TransactionDate'])
+                transaction.transaction_date = datetime.strptime(
+                    transaction_date, '%Y%m%d%H%M%S'
+                )
+            except (ValueError, TypeError) as e:
+                print(f"Error parsing transaction date: {e}")
+        
+        # Update transaction details
+        transaction.status = 'completed'
+        transaction.result_code = '0'
+        transaction.result_description = 'Payment completed successfully'
+        
+        # Update user's subscription using our new MySubscription model
+        if transaction.user:
+            try:
+                from .models import MySubscription
+                
+                # Debug: Print raw amount and type
+                print(f"DEBUG - Transaction amount: {transaction.amount} (type: {type(transaction.amount)})")
+                
+                # Convert amount to float for consistent comparison
+                sub_type = MySubscription.type_for_amount(transaction.amount)
+                print(f"DEBUG - Determined subscription type: {sub_type} (amount: {transaction.amount})")
+                
+                # Create or update subscription (in a savepoint, so a
+                # failure here still records the payment)
+                with db_transaction.atomic():
+                    subscription = MySubscription.create_from_payment(
+                        user=transaction.user,
+                        payment=transaction,
+                        sub_type=sub_type
+                    )
+                
+                print(f"Updated subscription for user {transaction.user.id}.")
+                print(f"Type: {subscription.get_sub_type_display()}, "
+                      f"Expiry: {subscription.expiry_date}, "
+                      f"Active: {subscription.is_active}")
+                
+            except Exception as e:
+                print(f"Error in subscription update: {str(e)}")
+                # Log the error but don't fail the transaction
+                import traceback
+                print(traceback.format_exc())
+        
+        # Save the transaction with the updated status
+        transaction.save()
+        print(f"Transaction {transaction.id} marked as completed")
+        
+    else:
+        # Handle different failure cases
+        transaction.status, transaction.result_description = callback_outcome(result_code, result_desc)
+        if result_code == '1032':
+            # Ensure the user is set if it's not already
+            if transaction.user is None and hasattr(request, 'user') and request.user.is_authenticated:
+                transaction.user = request.user
+        
+        transaction.result_code = result_code
+        transaction.save()
+        print(f"Transaction {transaction.id} marked as {transaction.status}: {transaction.result_description}")
+    
+    # Wake the payment page waiting on this transaction once this commits
+    db_transaction.on_commit(lambda: publish_status(transaction))
+        
+    # Here you can trigger any post-payment actions
+    # e.g., send email, update subscription, etc.
+    
+    return JsonResponse({
+        'status': 'success', 
+        'message': 'Callback processed successfully',
+        'transaction_id': str(transaction.id) if 'transaction' in locals() else None
+    })
+
+
 @csrf_exempt
 
 
@@ -247,197 +378,16 @@ def mpesa_callback(request):
                 status=400
             )
         
-        # Find the transaction by checkout_request_id first (primary method)
-        transaction = None
         try:
-            if checkout_request_id:
-                print(f"Looking up transaction with checkout_request_id: {checkout_request_id}")
-                transaction = MpesaTransaction.objects.get(
-                    checkout_request_id=checkout_request_id
-                )
-                print(f"Found transaction by checkout_request_id: {transaction.id}")
-        except MpesaTransaction.DoesNotExist:
-            print(f"No transaction found with checkout_request_id: {checkout_request_id}")
-        
-        # If not found by checkout_request_id, try to find by account_reference (fallback method)
-        if not transaction and 'account_reference' in result:
-            account_reference = result['account_reference']
-            print(f"Trying to find transaction by account_reference: {account_reference}")
-            
-            # Handle both old and new reference formats
-            if account_reference.startswith('TSC'):
-                try:
-                    # Format: TSC{user_id}
-                    user_id = int(account_reference[3:])  # Extract user ID after 'TSC' prefix
-                    print(f"Looking for pending transactions for user ID: {user_id}")
-                    
-                    # Find the most recent pending transaction for this user
-                    transaction = MpesaTransaction.objects.filter(
-                        user_id=user_id,
-                        status='pending'
-                    ).order_by('-created_at').first()
-                    
-                    if transaction:
-                        print(f"Found pending transaction {transaction.id} for user {user_id}")
-                        # Update the checkout_request_id for future reference
-                        transaction.checkout_request_id = checkout_request_id
-                        transaction.save(update_fields=['checkout_request_id', 'updated_at'])
-                        
-                except (ValueError, IndexError) as e:
-                    print(f"Error parsing account_reference '{account_reference}': {e}")
-            
-            # Keep backward compatibility with old format (TSC{user_id}_{transaction_id})
-            elif '_' in account_reference:
-                try:
-                    transaction_id = int(account_reference.split('_')[-1])
-                    transaction = MpesaTransaction.objects.get(id=transaction_id)
-                    print(f"Found transaction by ID from account_reference: {transaction.id}")
-                    
-                    # Update the checkout_request_id for future reference
-                    transaction.checkout_request_id = checkout_request_id
-                    transaction.save(update_fields=['checkout_request_id', 'updated_at'])
-                except (ValueError, MpesaTransaction.DoesNotExist) as e:
-                    print(f"Could not find transaction by account_reference: {e}")
-        
-        if not transaction:
-            print(f"Error: Could not find transaction with checkout_request_id {checkout_request_id}")
-            return JsonResponse(
-                {'status': 'error', 'message': 'Transaction not found'}, 
-                status=404
-            )
-        
-        print(f"Processing transaction ID: {transaction.id}")
-        print(f"Current transaction user: {transaction.user} (ID: {transaction.user.id if transaction.user else 'None'})")
-        print(f"Current status: {transaction.status}")
-        
-        # If transaction is already completed, don't process again
-        if transaction.status == 'completed':
-            print(f"Transaction {transaction.id} is already marked as completed")
+            return _apply_callback(request, result, result_code, result_desc, checkout_request_id)
+        except IntegrityError:
+            # A concurrent duplicate delivery got the ledger row (or the
+            # receipt number) first
+            print(f"Duplicate callback for {checkout_request_id} ignored")
             return JsonResponse({
                 'status': 'success', 
-                'message': 'Callback already processed',
-                'transaction_id': str(transaction.id)
+                'message': 'Callback already processed'
             })
-            
-        # Update transaction status based on result code
-        if result_code == '0':
-            # Success
-            callback_metadata = result.get('CallbackMetadata', {})
-            items = callback_metadata.get('Item', [])
-            
-            # Extract payment details from callback
-            payment_data = {}
-            for item in items:
-                name = item.get('Name')
-                if name:
-                    payment_data[name] = item.get('Value')
-            
-            # Update transaction with payment details
-            transaction.mpesa_receipt_number = payment_data.get('MpesaReceiptNumber')
-            
-            # Update phone number if available in callback
-            if 'PhoneNumber' in payment_data:
-                transaction.phone_number = str(payment_data['PhoneNumber'])
-            
-            # Ensure the user is set if it's not already
-            if transaction.user is None and hasattr(request, 'user') and request.user.is_authenticated:
-                transaction.user = request.user
-            
-            # Update transaction date if available
-            if 'TransactionDate' in payment_data:
-                try:
-                    transaction_date = str(payment_data['TransactionDate'])
-                    transaction.transaction_date = datetime.strptime(
-                        transaction_date, '%Y%m%d%H%M%S'
-                    )
-                except (ValueError, TypeError) as e:
-                    print(f"Error parsing transaction date: {e}")
-            
-            # Update transaction details
-            transaction.status = 'completed'
-            transaction.result_code = '0'
-            transaction.result_description = 'Payment completed successfully'
-            
-            # Update user's subscription using our new MySubscription model
-            if transaction.user:
-                try:
-                    from .models import MySubscription
-                    
-                    # Debug: Print raw amount and type
-                    print(f"DEBUG - Transaction amount: {transaction.amount} (type: {type(transaction.amount)})")
-                    
-                    # Convert amount to float for consistent comparison
-                    try:
-                        amount = float(transaction.amount)
-                        print(f"DEBUG - Converted amount to float: {amount}")
-                        
-                        # Determine subscription type based on amount
-                        if amount >= 200.00:
-                            sub_type = 'Premium'
-                        elif amount >= 100.00:
-                            sub_type = 'Standard'
-                        else:
-                            sub_type = 'Custom'
-                            
-                        print(f"DEBUG - Determined subscription type: {sub_type} (amount: {amount})")
-                    except (TypeError, ValueError) as e:
-                        print(f"ERROR - Failed to process amount {transaction.amount}: {str(e)}")
-                        sub_type = 'Standard'  # Default to Standard on error
-                    
-                    # Create or update subscription
-                    subscription = MySubscription.create_from_payment(
-                        user=transaction.user,
-                        payment=transaction,
-                        sub_type=sub_type
-                    )
-                    
-                    print(f"Updated subscription for user {transaction.user.id}.")
-                    print(f"Type: {subscription.get_sub_type_display()}, "
-                          f"Expiry: {subscription.expiry_date}, "
-                          f"Active: {subscription.is_active}")
-                    
-                except Exception as e:
-                    print(f"Error in subscription update: {str(e)}")
-                    # Log the error but don't fail the transaction
-                    import traceback
-                    print(traceback.format_exc())
-            
-            # Save the transaction with the updated status
-            transaction.save()
-            print(f"Transaction {transaction.id} marked as completed")
-            
-        else:
-            # Handle different failure cases
-            if result_code == '1032':
-                # Request cancelled by user
-                transaction.status = 'cancelled'
-                transaction.result_description = 'Payment was cancelled by the user'
-                
-                # Ensure the user is set if it's not already
-                if transaction.user is None and hasattr(request, 'user') and request.user.is_authenticated:
-                    transaction.user = request.user
-            elif 'request cancelled by user' in result_desc:
-                transaction.status = 'cancelled'
-                transaction.result_description = 'Payment was cancelled by the user'
-            elif 'insufficient funds' in result_desc:
-                transaction.status = 'failed'
-                transaction.result_description = 'Insufficient funds in M-Pesa account'
-            else:
-                transaction.status = 'failed'
-                transaction.result_description = result_desc[:255]  # Truncate if too long
-            
-            transaction.result_code = result_code
-            transaction.save()
-            print(f"Transaction {transaction.id} marked as {transaction.status}: {transaction.result_description}")
-            
-        # Here you can trigger any post-payment actions
-        # e.g., send email, update subscription, etc.
-        
-        return JsonResponse({
-            'status': 'success', 
-            'message': 'Callback processed successfully',
-            'transaction_id': str(transaction.id) if 'transaction' in locals() else None
-        })
         
     except json.JSONDecodeError:
         return JsonResponse(
@@ -449,26 +399,38 @@ def mpesa_callback(request):
             {'status': 'error', 'message': str(e)}, 
             status=500
         )
-def check_transaction_status(request, transaction_id):
-    """Check the status of a transaction"""
-    transaction = get_object_or_404(MpesaTransaction, id=transaction_id)
+def _status_response(request, payload):
+    if payload is None:
+        return JsonResponse({'error': 'Transaction not found'}, status=404)
     
     # For security, ensure the user can only see their own transactions
-    if request.user != transaction.user and not request.user.is_staff:
+    payload = dict(payload)
+    owner_id = payload.pop('user_id')
+    if not (request.user.is_staff or (request.user.is_authenticated and request.user.id == owner_id)):
         return JsonResponse(
             {'error': 'Not authorized to view this transaction'}, 
             status=403
         )
-    
-    return JsonResponse({
-        'transaction_id': transaction.id,
-        'status': transaction.status,
-        'mpesa_receipt_number': transaction.mpesa_receipt_number,
-        'amount': str(transaction.amount),
-        'phone_number': transaction.phone_number,
-        'created_at': transaction.created_at.isoformat(),
-        'updated_at': transaction.updated_at.isoformat(),
-        'result_code': transaction.result_code,
-        'result_description': transaction.result_description,
-        'is_successful': transaction.is_successful()
-    })
+    return JsonResponse(payload)
+
+
+def check_transaction_status(request, transaction_id):
+    """Check the status of a transaction (read from the database)"""
+    return _status_response(request, load_status(transaction_id))
+
+
+@require_http_methods(["GET"])
+def wait_transaction_status(request, transaction_id):
+    """
+    Long-poll for a status change: returns as soon as the transaction's
+    status differs from ``?status=`` (or after MPESA_STATUS_WAIT_SECONDS).
+    ``keep_waiting`` is false once there is nothing more to wait for.
+    """
+    payload = current_status(transaction_id)
+    response = _status_response(request, payload)
+    if response.status_code != 200:
+        return response
+    payload = wait_for_status(transaction_id, request.GET.get('status', payload['status']))
+    if payload is not None:
+        payload = dict(payload, keep_waiting=keep_waiting(payload))
+    return _status_response(request, payload)
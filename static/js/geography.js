@@ -0,0 +1,82 @@
+/*
+ * Client-side county -> constituency -> ward lookups.
+ *
+ * Include with:
+ *   <script src="{% static 'js/geography.js' %}" data-bundle-url="{% geography_bundle_url %}"></script>
+ *
+ * When a bundle URL is given the whole hierarchy is fetched once (WhiteNoise
+ * serves it fingerprinted, compressed and immutable) and every later lookup is
+ * answered locally. Without a bundle the lookups fall back to the JSON API.
+ * Both methods resolve to arrays of {id, name} ordered by name.
+ */
+(function (window, document) {
+    'use strict';
+
+    const script = document.currentScript;
+    const bundleUrl = script ? script.dataset.bundleUrl : '';
+    let bundlePromise = null;
+
+    function groupByParent(level) {
+        const groups = new Map();
+        for (let i = 0; i < level.id.length; i++) {
+            const parent = String(level.parent[i]);
+            if (!groups.has(parent)) {
+                groups.set(parent, []);
+            }
+            groups.get(parent).push({ id: level.id[i], name: level.name[i] });
+        }
+        return groups;
+    }
+
+    function loadBundle() {
+        if (!bundlePromise) {
+            bundlePromise = fetch(bundleUrl)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Geography bundle unavailable');
+                    }
+                    return response.json();
+                })
+                .then(bundle => ({
+                    constituencies: groupByParent(bundle.constituencies),
+                    wards: groupByParent(bundle.wards),
+                }));
+        }
+        return bundlePromise;
+    }
+
+    function fromApi(url) {
+        return fetch(url).then(response => {
+            if (!response.ok) {
+                throw new Error('Network response was not ok');
+            }
+            return response.json();
+        });
+    }
+
+    function lookup(key, parentId, apiUrl) {
+        if (!parentId) {
+            return Promise.resolve([]);
+        }
+        if (!bundleUrl) {
+            return fromApi(apiUrl);
+        }
+        return loadBundle()
+            .then(index => index[key].get(String(parentId)) || [])
+            .catch(() => fromApi(apiUrl));
+    }
+
+    window.Geography = {
+        constituencies(countyId) {
+            return lookup('constituencies', countyId, `/api/constituencies/?county=${encodeURIComponent(countyId)}`);
+        },
+        wards(constituencyId) {
+            return lookup('wards', constituencyId, `/api/wards/?constituency=${encodeURIComponent(constituencyId)}`);
+        },
+    };
+
+    // Warm the cache so the first change event is answered locally.
+    if (bundleUrl) {
+        loadBundle().catch(() => {});
+    }
+})(window, document);
@@ -1,169 +1,40 @@
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
-from django.db.models import Q, Count
 from django.utils.translation import gettext_lazy as _
 from django.utils.html import format_html
 from django.urls import reverse
-from home.models import Schools, SwapPreference, Counties, Constituencies, Wards, Level, Subject, MySubject
-from .models import MyUser, PersonalProfile
+from django.utils import timezone
+from home.models import PotentialMatchCount, SwapPreference
+from .models import AdminNotification, MyUser, PersonalProfile, QueuedEmail
 
 
 class PotentialSwapMatchFilter(SimpleListFilter):
+    """
+    Users who are a mutual swap match of the selected user, read from the
+    MatchPair table. The user is picked through the admin autocomplete
+    instead of a fixed list of choices.
+    """
     title = _('Potential Swap Matches')
     parameter_name = 'potential_swap_match'
-    
+    template = 'admin/users/potential_swap_match_filter.html'
+
     def lookups(self, request, model_admin):
-        # Get all users who have a school assigned
-        users_with_schools = MyUser.objects.filter(
-            profile__isnull=False,
-            profile__school__isnull=False
-        ).distinct()
-        
-        return [(str(user.id), f"{user.email} - {user.get_full_name() or 'No name'}") 
-               for user in users_with_schools[:50]]  # Limit to 50 for performance
-    
+        # Only the selected user is listed; others are found with the search box.
+        if not self.value() or not self.value().isdigit():
+            return []
+        user = MyUser.objects.filter(id=self.value()).only('email').first()
+        return [(self.value(), user.email if user else self.value())]
+
     def queryset(self, request, queryset):
         if not self.value():
             return queryset
-            
-        try:
-            selected_user = MyUser.objects.get(id=self.value())
-        except MyUser.DoesNotExist:
+        if not self.value().isdigit():
             return queryset.none()
-            
-        # Get selected user's school location
-        try:
-            user_school = selected_user.profile.school
-            user_county = user_school.ward.constituency.county
-            user_constituency = user_school.ward.constituency
-            user_ward = user_school.ward
-        except AttributeError:
-            # User doesn't have complete school/location data
-            return queryset.none()
-            
-        # Get selected user's swap preferences
-        try:
-            user_prefs = SwapPreference.objects.get(user=selected_user)
-            
-            # Create Q objects for location matching
-            location_q = Q()
-            
-            # Check if user is open to all counties
-            if user_prefs.open_to_all.exists():
-                # User is open to all counties in their open_to_all list
-                location_q |= Q(profile__school__ward__constituency__county__in=user_prefs.open_to_all.all())
-            
-            # Check specific location preferences
-            if user_prefs.desired_county:
-                location_q |= Q(profile__school__ward__constituency__county=user_prefs.desired_county)
-                
-                if user_prefs.desired_constituency:
-                    location_q |= Q(profile__school__ward__constituency=user_prefs.desired_constituency)
-                    
-                    if user_prefs.desired_ward:
-                        location_q |= Q(profile__school__ward=user_prefs.desired_ward)
-            
-            # Start with base query for location matches
-            matches = queryset.filter(
-                # User's current location matches selected user's preferences
-                location_q,
-                # And their preferences match selected user's current location
-                Q(swappreference__open_to_all=user_county) |
-                Q(swappreference__desired_county=user_county) |
-                Q(swappreference__desired_constituency=user_constituency) |
-                Q(swappreference__desired_ward=user_ward),
-                # Exclude the selected user
-                ~Q(id=selected_user.id),
-                # Only include users with a profile and school
-                profile__isnull=False,
-                profile__school__isnull=False
-            )
-            
-            # For secondary/high school, filter by matching subjects
-            if hasattr(user_school, 'level') and ('secondary' in user_school.level.name.lower() or 'high' in user_school.level.name.lower()):
-                # Get selected user's subjects
-                user_subjects = set(MySubject.objects.filter(
-                    user=selected_user
-                ).values_list('subject__id', flat=True))
-                
-                if user_subjects:
-                    # Filter matches to only include users who teach at least one of the same subjects
-                    matches = matches.filter(
-                        id__in=MySubject.objects.filter(
-                            subject__id__in=user_subjects
-                        ).values('user')
-                    )
-            
-            return matches.distinct()
-            
-        except SwapPreference.DoesNotExist:
-            return queryset.none()
-
-def get_potential_matches_count(self, obj):
-    """
-    Calculate and return the number of potential swap matches for a user
-    """
-    try:
-        # Check if user has a profile and school
-        if not hasattr(obj, 'profile') or not obj.profile.school:
-            return "No school assigned"
-            
-        # Get user's school and location
-        user_school = obj.profile.school
-        user_county = user_school.ward.constituency.county
-        
-        # Get user's level
-        if not hasattr(user_school, 'level'):
-            return "No level set"
-            
-        is_secondary = 'secondary' in user_school.level.name.lower() or 'high' in user_school.level.name.lower()
-        
-        # Base query for potential matches
-        potential_matches = MyUser.objects.filter(
-            ~Q(id=obj.id),  # Don't match with self
-            profile__isnull=False,
-            profile__school__isnull=False,
-            swappreference__isnull=False
-        )
-        
-        # Filter by swap preferences (county match or open to all)
-        potential_matches = potential_matches.filter(
-            Q(swappreference__desired_county=user_county) |
-            Q(swappreference__open_to_all=user_county)
-        )
-        
-        # For secondary/high school, check subject matches
-        if is_secondary:
-            # Get user's subjects
-            user_subjects = set(MySubject.objects.filter(
-                user=obj
-            ).values_list('subject__id', flat=True))
-            
-            if user_subjects:
-                # Only include users who teach at least one of the same subjects
-                potential_matches = potential_matches.filter(
-                    id__in=MySubject.objects.filter(
-                        subject__in=user_subjects
-                    ).values('user')
-                ).distinct()
-        
-        count = potential_matches.count()
-        if count > 0:
-            url = (
-                reverse('admin:users_myuser_changelist') + 
-                f'?potential_swap_match={obj.id}'
-            )
-            return format_html('<a href="{}">{} potential {}</a>', 
-                             url, count, 'match' if count == 1 else 'matches')
-        return "No matches"
-        
-    except Exception as e:
-        return f"Error: {str(e)}"
+        return queryset.filter(matched_by__user_id=self.value())
 
-def get_potential_matches_count_wrapper(obj):
-    return get_potential_matches_count(None, obj)
+    def autocomplete_url(self):
+        return reverse('admin:autocomplete') + '?app_label=home&model_name=matchpair&field_name=user'
 
-get_potential_matches_count_wrapper.short_description = 'Potential Matches'
 
 def get_school_location_wrapper(obj):
     if hasattr(obj, 'profile') and hasattr(obj.profile, 'school') and obj.profile.school:
@@ -263,13 +134,16 @@ class MyUserAdmin(admin.ModelAdmin):
     get_school_location.short_description = 'School Location'
     
     def get_potential_matches_count(self, obj):
-        # This is a simplified version - you might want to implement the full logic here
         try:
-            return obj.potential_matches_count
-        except AttributeError:
-            return 0
+            count = obj.potential_match_count.count
+        except PotentialMatchCount.DoesNotExist:
+            count = 0
+        if not count:
+            return "No matches"
+        url = reverse('admin:users_myuser_changelist') + f'?potential_swap_match={obj.id}'
+        return format_html('<a href="{}">{} potential {}</a>', url, count, 'match' if count == 1 else 'matches')
     get_potential_matches_count.short_description = 'Potential Matches'
-    list_filter = ('role', 'is_active', 'is_staff', 'date_joined')
+    list_filter = ('role', 'is_active', 'is_staff', 'date_joined', PotentialSwapMatchFilter)
     search_fields = ('email', 'first_name', 'last_name')
     ordering = ('-date_joined',)
     
@@ -277,10 +151,13 @@ class MyUserAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.prefetch_related(
+        return qs.select_related(
+            'profile__level',
             'profile__school__level',
+            'profile__school__ward__constituency__county',
+            'potential_match_count',
+        ).prefetch_related(
             'swappreference__open_to_all',
-            'mysubject_set__subject'  # Using the default related_name for reverse relation
         )
     
     def get_phone_number(self, obj):
@@ -306,4 +183,23 @@ class PersonalProfileAdmin(admin.ModelAdmin):
     
     readonly_fields = ('created_at',)
     
-   
\ No newline at end of file
+   
+
+@admin.register(QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'status', 'attempts', 'send_after', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('to', 'subject')
+    readonly_fields = ('created_at', 'sent_at')
+    actions = ['retry_now']
+
+    @admin.action(description='Retry selected emails now')
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status='sent').update(status='pending', send_after=timezone.now())
+        self.message_user(request, f'{updated} email(s) queued for the next send.')
+
+
+@admin.register(AdminNotification)
+class AdminNotificationAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'kind', 'created_at', 'digested_at')
+    list_filter = ('kind',)
@@ -0,0 +1,165 @@
+"""
+Outbox for outgoing email, so signup, profile edits and the Google Forms
+import never wait on an SMTP round trip.
+
+- ``queue_email`` stores a QueuedEmail in the caller's database
+  transaction: it is sent only if that commits
+- ``notify_admin`` records an AdminNotification instead of mailing the
+  admin; ``queue_admin_digest`` turns everything waiting into one email to
+  ADMIN_EMAIL once the oldest event is ``ADMIN_DIGEST_MINUTES`` old
+- ``send_queued_emails`` claims due emails ``MAIL_QUEUE_BATCH_SIZE`` at a
+  time (pushing their ``send_after`` out as a lease, with skip_locked so
+  concurrent workers take different rows), sends each batch over one SMTP
+  connection and retries failures with exponential backoff, giving up after
+  ``MAIL_QUEUE_MAX_ATTEMPTS``
+
+The ``send_queued_emails`` command runs the digest, the sending and the
+cleanup of old sent rows (from cron, or continuously with ``--loop``).
+"""
+import logging
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import AdminNotification, QueuedEmail
+
+logger = logging.getLogger(__name__)
+
+# How long a worker holds the emails it claimed before another may retry them
+SEND_LEASE = timedelta(minutes=10)
+# Delay before the first retry; doubled after every further failure
+RETRY_DELAY = timedelta(minutes=1)
+
+SendResult = namedtuple('SendResult', ['sent', 'retrying', 'failed'])
+
+
+def admin_email():
+    return getattr(settings, 'ADMIN_EMAIL', 'kevingitundu@gmail.com')
+
+
+def queue_email(subject, body, to, html_body='', from_email=None):
+    """Queue an email to one recipient for the worker."""
+    return QueuedEmail.objects.create(
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL or '',
+        to=to,
+    )
+
+
+def notify_admin(kind, subject, body, key=''):
+    """
+    Record an event for the next admin digest. A waiting event of the same
+    ``kind`` and ``key`` is replaced, so repeated saves mail once.
+    """
+    if key:
+        AdminNotification.objects.filter(kind=kind, key=key, digested_at__isnull=True).delete()
+    return AdminNotification.objects.create(kind=kind, key=key, subject=subject, body=body)
+
+
+def queue_admin_digest(force=False):
+    """
+    Queue one email with every waiting admin notification, once the oldest
+    has waited ``ADMIN_DIGEST_MINUTES`` (at once with ``force``). Returns the
+    QueuedEmail, or None when there was nothing to send yet.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        waiting = list(
+            AdminNotification.objects.select_for_update().filter(digested_at__isnull=True).order_by('created_at', 'id')
+        )
+        if not waiting:
+            return None
+        if not force and waiting[0].created_at > now - timedelta(minutes=settings.ADMIN_DIGEST_MINUTES):
+            return None
+
+        counts = Counter(notification.kind for notification in waiting)
+        summary = '\n'.join(f'- {kind}: {count}' for kind, count in counts.most_common())
+        events = '\n\n---\n\n'.join(f'{notification.subject}\n\n{notification.body}' for notification in waiting)
+        body = (
+            f'TSC Swap activity since {waiting[0].created_at:%B %d, %Y at %I:%M %p}\n\n'
+            f'{summary}\n\n---\n\n{events}'
+        )
+        email = queue_email(f'TSC Swap digest: {len(waiting)} event(s)', body, admin_email())
+        AdminNotification.objects.filter(id__in=[notification.id for notification in waiting]).update(
+            digested_at=now
+        )
+    return email
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(
+        email.subject, email.body, email.from_email or None, [email.to], connection=connection
+    )
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def claim_batch(batch_size):
+    """Lease up to ``batch_size`` due emails to this worker."""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            QueuedEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', send_after__lte=now)
+            .order_by('send_after', 'id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        QueuedEmail.objects.filter(id__in=ids).update(send_after=now + SEND_LEASE)
+    return list(QueuedEmail.objects.filter(id__in=ids).order_by('id'))
+
+
+def send_queued_emails(batch_size=None, max_attempts=None, connection=None):
+    """Send every due email, one SMTP connection for the whole run."""
+    batch_size = batch_size or settings.MAIL_QUEUE_BATCH_SIZE
+    max_attempts = max_attempts or settings.MAIL_QUEUE_MAX_ATTEMPTS
+    connection = connection or get_connection(fail_silently=False)
+    sent = retrying = failed = 0
+    try:
+        while True:
+            batch = claim_batch(batch_size)
+            if not batch:
+                break
+            delivered = []
+            for email in batch:
+                try:
+                    # Opens the connection unless it is already open
+                    connection.open()
+                    connection.send_messages([build_message(email, connection)])
+                except Exception as e:
+                    email.attempts += 1
+                    email.last_error = str(e)[:1000]
+                    if email.attempts >= max_attempts:
+                        email.status = 'failed'
+                        failed += 1
+                    else:
+                        email.send_after = timezone.now() + RETRY_DELAY * 2 ** (email.attempts - 1)
+                        retrying += 1
+                    email.save(update_fields=['attempts', 'last_error', 'status', 'send_after'])
+                    logger.warning('Failed to send queued email %s to %s (attempt %s): %s',
+                                   email.id, email.to, email.attempts, e)
+                    # Start the next message on a fresh connection
+                    connection.close()
+                else:
+                    delivered.append(email.id)
+            QueuedEmail.objects.filter(id__in=delivered).update(
+                status='sent', sent_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+            )
+            sent += len(delivered)
+    finally:
+        connection.close()
+    return SendResult(sent, retrying, failed)
+
+
+def purge_sent(older_than=None):
+    """Delete sent emails (they may hold credentials) after ``MAIL_QUEUE_KEEP_DAYS``."""
+    older_than = older_than or timedelta(days=settings.MAIL_QUEUE_KEEP_DAYS)
+    deleted, _ = QueuedEmail.objects.filter(status='sent', sent_at__lt=timezone.now() - older_than).delete()
+    return deleted
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.mail_queue import purge_sent, queue_admin_digest, send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Sends the queued emails (and the admin digest when it is due) in batches over one SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Emails claimed per batch (default MAIL_QUEUE_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            help='Attempts before an email is marked failed (default MAIL_QUEUE_MAX_ATTEMPTS)',
+        )
+        parser.add_argument(
+            '--digest-now',
+            action='store_true',
+            help='Send the waiting admin notifications now instead of when the digest is due',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running, checking the queue every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=30,
+            help='Seconds between passes with --loop (default 30)',
+        )
+
+    def handle(self, *args, **options):
+        for name in ('batch_size', 'max_attempts'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be at least 1')
+
+        force_digest = options['digest_now']
+        while True:
+            if queue_admin_digest(force=force_digest):
+                self.stdout.write('Queued the admin digest')
+            force_digest = False
+            result = send_queued_emails(batch_size=options['batch_size'], max_attempts=options['max_attempts'])
+            purged = purge_sent()
+            if result.sent or result.retrying or result.failed or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Sent {result.sent} email(s), {result.retrying} to retry, {result.failed} failed, '
+                    f'{purged} old sent email(s) removed'
+                ))
+            if not options['loop']:
+                break
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                break
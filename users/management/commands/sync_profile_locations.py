@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import OuterRef, Q, Subquery
+
+from home.models import Schools
+from users.models import PersonalProfile
+
+
+class Command(BaseCommand):
+    help = (
+        'Checks and repairs the denormalized county/constituency/ward on PersonalProfile '
+        'against each profile\'s school'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report inconsistent profiles; exit with an error if any are found',
+        )
+
+    def handle(self, *args, **options):
+        school = Schools.objects.filter(pk=OuterRef('school_id'))
+        expected = {
+            'current_county_id': Subquery(school.values('ward__constituency__county_id')[:1]),
+            'current_constituency_id': Subquery(school.values('ward__constituency_id')[:1]),
+            'current_ward_id': Subquery(school.values('ward_id')[:1]),
+        }
+
+        out_of_date = Q()
+        for field, value in expected.items():
+            out_of_date |= Q(**{f'{field}__isnull': True}) | ~Q(**{field: value})
+
+        stale = PersonalProfile.objects.filter(Q(school__isnull=False) & out_of_date) | PersonalProfile.objects.filter(
+            Q(school__isnull=True) & (
+                Q(current_county__isnull=False)
+                | Q(current_constituency__isnull=False)
+                | Q(current_ward__isnull=False)
+            )
+        )
+        # Materialize the ids first: MySQL can't update a table it selects from.
+        stale_ids = list(stale.values_list('pk', flat=True))
+
+        if options['check']:
+            if stale_ids:
+                for profile in PersonalProfile.objects.filter(pk__in=stale_ids[:20]).select_related('user'):
+                    self.stdout.write(f'  {profile.user.email}: school={profile.school_id} '
+                                      f'county={profile.current_county_id} '
+                                      f'constituency={profile.current_constituency_id} '
+                                      f'ward={profile.current_ward_id}')
+                raise CommandError(f'{len(stale_ids)} profile(s) have an out-of-date location')
+            self.stdout.write(self.style.SUCCESS('All profile locations are consistent'))
+            return
+
+        updated = 0
+        for start in range(0, len(stale_ids), 1000):
+            updated += PersonalProfile.objects.filter(pk__in=stale_ids[start:start + 1000]).update(**expected)
+
+        self.stdout.write(self.style.SUCCESS(f'Updated location on {updated} profile(s)'))
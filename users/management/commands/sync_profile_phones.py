@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import PersonalProfile
+
+
+class Command(BaseCommand):
+    help = 'Checks and repairs PersonalProfile.phone_normalized against each profile\'s phone'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report inconsistent profiles; exit with an error if any are found',
+        )
+
+    def handle(self, *args, **options):
+        stale = {}
+        for pk, phone, phone_normalized in PersonalProfile.objects.values_list(
+            'pk', 'phone', 'phone_normalized'
+        ).iterator(chunk_size=2000):
+            expected = PersonalProfile.normalize_phone(phone)
+            if expected != phone_normalized:
+                stale[pk] = expected
+
+        if options['check']:
+            if stale:
+                for profile in PersonalProfile.objects.filter(pk__in=list(stale)[:20]).select_related('user'):
+                    self.stdout.write(f'  {profile.user.email}: phone={profile.phone!r} '
+                                      f'stored={profile.phone_normalized!r} expected={stale[profile.pk]!r}')
+                raise CommandError(f'{len(stale)} profile(s) have an out-of-date normalized phone')
+            self.stdout.write(self.style.SUCCESS('All normalized phones are consistent'))
+            return
+
+        for pk, phone_normalized in stale.items():
+            PersonalProfile.objects.filter(pk=pk).update(phone_normalized=phone_normalized)
+        self.stdout.write(self.style.SUCCESS(f'Updated normalized phone on {len(stale)} profile(s)'))
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.models import FastSwap, MySubject, subject_key_for
+from users.models import PersonalProfile
+
+
+class Command(BaseCommand):
+    help = (
+        'Checks and rebuilds the subject combination keys on PersonalProfile (from MySubject) '
+        'and FastSwap (from its subjects)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report stale keys; exit with an error if any are found',
+        )
+
+    def handle(self, *args, **options):
+        subjects_by_user = {}
+        rows = MySubject.objects.filter(subject__isnull=False).values_list('user_id', 'subject__id')
+        for user_id, subject_id in rows.iterator():
+            subjects_by_user.setdefault(user_id, set()).add(subject_id)
+
+        stale = []
+        for profile in PersonalProfile.objects.only('id', 'user_id', 'subject_key').iterator():
+            expected = subject_key_for(subjects_by_user.get(profile.user_id, ()))
+            if profile.subject_key != expected:
+                profile.subject_key = expected
+                stale.append(profile)
+
+        subjects_by_fast_swap = {}
+        for fast_swap_id, subject_id in FastSwap.subjects.through.objects.values_list('fastswap_id', 'subject_id').iterator():
+            subjects_by_fast_swap.setdefault(fast_swap_id, set()).add(subject_id)
+
+        stale_fast_swaps = []
+        for fast_swap in FastSwap.objects.only('id', 'subject_key').iterator():
+            expected = subject_key_for(subjects_by_fast_swap.get(fast_swap.id, ()))
+            if fast_swap.subject_key != expected:
+                fast_swap.subject_key = expected
+                stale_fast_swaps.append(fast_swap)
+
+        if options['check']:
+            if stale or stale_fast_swaps:
+                raise CommandError(
+                    f'{len(stale)} profile(s) and {len(stale_fast_swaps)} fast swap(s) have an out-of-date subject key'
+                )
+            self.stdout.write(self.style.SUCCESS('All subject keys are consistent'))
+            return
+
+        PersonalProfile.objects.bulk_update(stale, ['subject_key'], batch_size=1000)
+        FastSwap.objects.bulk_update(stale_fast_swaps, ['subject_key'], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated subject key on {len(stale)} profile(s) and {len(stale_fast_swaps)} fast swap(s)'
+        ))
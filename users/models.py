@@ -1,7 +1,8 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from home.models import Level, Schools
+from home.models import Constituencies, Counties, Level, MySubject, Schools, Wards, subject_key_for
 
 class MyUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -94,19 +95,106 @@ class PersonalProfile(models.Model):
         help_text='Upload a profile picture (JPG, PNG, or GIF, max 2MB)'
     )
     location = models.CharField(max_length=255, blank=True, null=True)
+    # Denormalized location of ``school`` so matching can filter on one
+    # indexed column instead of joining school -> ward -> constituency -> county.
+    # Kept in step by save() and the Schools post_save signal; check with
+    # ``manage.py sync_profile_locations --check``.
+    current_county = models.ForeignKey(
+        Counties,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        editable=False,
+        related_name='+',
+    )
+    current_constituency = models.ForeignKey(
+        Constituencies,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        editable=False,
+        related_name='+',
+    )
+    current_ward = models.ForeignKey(
+        Wards,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        editable=False,
+        related_name='+',
+    )
+    # Signature (home.models.subject_key_for) of the subjects across all of
+    # the user's MySubject rows, e.g. "3,7,12". Teachers with the same portfolio share a key, so
+    # combination analytics are a GROUP BY on this column. Maintained by
+    # signals on MySubject; check with ``manage.py sync_subject_keys --check``.
+    subject_key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
+    # ``phone`` in 2547XXXXXXXX form (chat.whatsapp_integration.normalize_phone_number)
+    # so staff search and phone lookups are one indexed equality. Set by
+    # save(); check with ``manage.py sync_profile_phones --check``.
+    phone_normalized = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['level', 'current_county']),
+            models.Index(fields=['level', 'current_constituency']),
+            models.Index(fields=['level', 'current_ward']),
+            # Prefix search on the staff user lists
+            models.Index(fields=['first_name']),
+            models.Index(fields=['last_name']),
+        ]
     
     def save(self, *args, **kwargs):
         # Delete old profile picture when updating to a new one
+        old_school_id = None
         try:
             old_instance = PersonalProfile.objects.get(pk=self.pk)
+            old_school_id = old_instance.school_id
             if old_instance.profile_picture and old_instance.profile_picture != self.profile_picture:
                 old_instance.profile_picture.delete(save=False)
         except PersonalProfile.DoesNotExist:
-            pass
+            # New profile: pick up any subjects recorded before it existed
+            if self.user_id and not self.subject_key:
+                self.subject_key = self.subject_key_for_user(self.user_id)
+
+        if self.school_id != old_school_id or (self.school_id and not self.current_ward_id):
+            self.current_county_id, self.current_constituency_id, self.current_ward_id = (
+                self.location_for_school(self.school_id)
+            )
+            if 'update_fields' in kwargs and kwargs['update_fields'] is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.LOCATION_FIELDS)
+
+        self.phone_normalized = self.normalize_phone(self.phone)
+        if kwargs.get('update_fields') is not None and 'phone' in kwargs['update_fields']:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'phone_normalized'}
             
         super().save(*args, **kwargs)
+
+    LOCATION_FIELDS = ('current_county', 'current_constituency', 'current_ward')
+
+    subject_key_for = staticmethod(subject_key_for)
+
+    @classmethod
+    def subject_key_for_user(cls, user_id):
+        return cls.subject_key_for(
+            MySubject.objects.filter(user_id=user_id, subject__isnull=False).values_list('subject__id', flat=True)
+        )
+
+    @staticmethod
+    def normalize_phone(phone):
+        from chat.whatsapp_integration import normalize_phone_number
+        return normalize_phone_number(phone)
+
+    @staticmethod
+    def location_for_school(school_id):
+        """Return ``(county_id, constituency_id, ward_id)`` for a school."""
+        if not school_id:
+            return (None, None, None)
+        location = Schools.objects.filter(pk=school_id).values_list(
+            'ward__constituency__county_id', 'ward__constituency_id', 'ward_id'
+        ).first()
+        return location or (None, None, None)
         
     def delete(self, *args, **kwargs):
         # Delete the profile picture file when the profile is deleted
@@ -122,3 +210,58 @@ class PersonalProfile(models.Model):
 
  
 
+
+
+class QueuedEmail(models.Model):
+    """
+    Outbox row for an email sent by the ``send_queued_emails`` worker rather
+    than on the request path. Queued in the caller's database transaction,
+    so it goes out only if that commits. See users.mail_queue.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=254, blank=True, default='')
+    to = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    # Not sent before this; pushed back while a worker holds the row and
+    # after each failed attempt
+    send_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'send_after']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.to} ({self.status})"
+
+
+class AdminNotification(models.Model):
+    """
+    An event for the site admin (registration, profile completion), mailed
+    in the next periodic digest instead of one email per event.
+    """
+    kind = models.CharField(max_length=50)
+    # Events with the same key replace each other until the digest goes out
+    key = models.CharField(max_length=100, blank=True, default='')
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+    digested_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return self.subject
@@ -1,18 +1,22 @@
 """
 Signals for user registration and management
 """
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
 from django.dispatch import receiver
-from django.core.mail import send_mail
 from django.conf import settings
 from django.template.loader import render_to_string
+from home.county_stats import refresh_county_stats, user_county_ids
+from home.demand_matrix import update_teacher_demand
+from home.match_pairs import refresh_match_pairs
+from home.models import MySubject, Schools, SwapPreference
+from .mail_queue import notify_admin, queue_email
 from .models import MyUser, PersonalProfile
 
 
 @receiver(post_save, sender=MyUser)
 def send_user_registration_notification(sender, instance, created, **kwargs):
     """
-    Send email notification when a new user is created
+    Add a new user to the admin's next notification digest
     """
     if created:  # Only send email for new users, not updates
         try:
@@ -45,28 +49,20 @@ Date Registered: {instance.date_joined.strftime('%B %d, %Y at %I:%M %p')}
 This notification was automatically sent from TSC Swap when a new user registered.
             """.strip()
             
-            # Send email to admin
-            admin_email = getattr(settings, 'ADMIN_EMAIL', 'kevingitundu@gmail.com')
+            # Mailed to the admin with the next digest (users.mail_queue)
+            notify_admin('New registration', subject, email_content)
             
-            send_mail(
-                subject=subject,
-                message=email_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[admin_email],
-                fail_silently=True,  # Don't break user registration if email fails
-            )
-            
-            print(f"✅ Admin notification sent for new user: {instance.username}")
+            print(f"✅ Admin notification queued for new user: {instance.username}")
             
         except Exception as e:
             # Log the error but don't break user registration
-            print(f"❌ Failed to send user registration notification: {e}")
+            print(f"❌ Failed to queue user registration notification: {e}")
 
 
 @receiver(post_save, sender=MyUser)
 def send_welcome_email_to_user(sender, instance, created, **kwargs):
     """
-    Send welcome email to new users
+    Queue a welcome email to new users
     """
     if created and instance.email:
         try:
@@ -100,26 +96,33 @@ The TSC Swap Team
 This is an automated welcome message. Please do not reply to this email.
             """.strip()
             
-            # Send welcome email to the new user
-            send_mail(
-                subject=subject,
-                message=welcome_message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[instance.email],
-                fail_silently=True,
-            )
+            # Queue the welcome email for the send_queued_emails worker
+            queue_email(subject, welcome_message, instance.email)
             
-            print(f"✅ Welcome email sent to: {instance.email}")
+            print(f"✅ Welcome email queued for: {instance.email}")
             
         except Exception as e:
             # Log the error but don't break user registration
-            print(f"❌ Failed to send welcome email: {e}")
+            print(f"❌ Failed to queue welcome email: {e}")
+
+
+@receiver(post_init, sender=MyUser)
+def remember_user_active(sender, instance, **kwargs):
+    instance._match_is_active = instance.__dict__.get('is_active')
+
+
+@receiver(post_save, sender=MyUser)
+def refresh_match_pairs_on_activation(sender, instance, created, **kwargs):
+    """Deactivated teachers drop out of (and reactivated ones return to) match pairs."""
+    if not created and instance._match_is_active != instance.is_active:
+        refresh_match_pairs([instance.pk])
+    instance._match_is_active = instance.is_active
 
 
 @receiver(post_save, sender=PersonalProfile)
 def send_profile_completion_notification(sender, instance, created, **kwargs):
     """
-    Send notification when user completes their profile
+    Add a completed profile to the admin's next notification digest
     """
     if not created and instance.user:  # Profile updated, not created
         try:
@@ -140,7 +143,6 @@ Full Name: {instance.user.get_full_name() or 'Not provided'}
 - Last Name: {instance.last_name or 'Not provided'}
 - Phone: {instance.phone or 'Not provided'}
 - Location: {instance.location or 'Not provided'}
-- Date of Birth: {instance.date_of_birth.strftime('%B %d, %Y') if instance.date_of_birth else 'Not provided'}
 - Profile Updated: {instance.updated_at.strftime('%B %d, %Y at %I:%M %p') if hasattr(instance, 'updated_at') else 'Recently'}
 
 🌐 Account Status:
@@ -152,19 +154,157 @@ Full Name: {instance.user.get_full_name() or 'Not provided'}
 This notification was automatically sent from TSC Swap when a user completed their profile.
                 """.strip()
                 
-                # Send email to admin
-                admin_email = getattr(settings, 'ADMIN_EMAIL', 'kevingitundu@gmail.com')
+                # One digest entry per user, however often the profile is saved
+                notify_admin('Profile completed', subject, profile_content, key=str(instance.user_id))
                 
-                send_mail(
-                    subject=subject,
-                    message=profile_content,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[admin_email],
-                    fail_silently=True,
-                )
-                
-                print(f"✅ Profile completion notification sent for user: {instance.user.username}")
+                print(f"✅ Profile completion notification queued for user: {instance.user.username}")
                 
         except Exception as e:
             # Log the error but don't break profile updates
-            print(f"❌ Failed to send profile completion notification: {e}")
+            print(f"❌ Failed to queue profile completion notification: {e}")
+
+
+@receiver(post_save, sender=Schools)
+def sync_profile_location_on_school_change(sender, instance, created, **kwargs):
+    """
+    Keep the denormalized PersonalProfile location in step when a school
+    moves ward.
+    """
+    if created:
+        return
+    county_id, constituency_id, ward_id = PersonalProfile.location_for_school(instance.pk)
+    moved = PersonalProfile.objects.filter(school=instance).exclude(
+        current_county_id=county_id,
+        current_constituency_id=constituency_id,
+        current_ward_id=ward_id,
+    )
+    stats_keys = set(moved.values_list('current_county_id', 'level_id'))
+    moved_user_ids = list(moved.values_list('user_id', flat=True))
+    moved.update(
+        current_county_id=county_id,
+        current_constituency_id=constituency_id,
+        current_ward_id=ward_id,
+    )
+    if stats_keys:
+        refresh_county_stats(
+            {old_county_id for old_county_id, _ in stats_keys} | {county_id},
+            {level_id for _, level_id in stats_keys},
+        )
+        refresh_teacher_matching(moved_user_ids)
+
+
+def refresh_teacher_matching(user_ids):
+    """Move the teachers' demand matrix cells and recompute their match pairs."""
+    update_teacher_demand(user_ids)
+    refresh_match_pairs(user_ids)
+
+
+def refresh_subject_keys(user_ids):
+    """Recompute PersonalProfile.subject_key for the given users."""
+    user_ids = set(user_ids)
+    for user_id in user_ids:
+        PersonalProfile.objects.filter(user_id=user_id).update(
+            subject_key=PersonalProfile.subject_key_for_user(user_id)
+        )
+    refresh_teacher_matching(user_ids)
+
+
+@receiver(m2m_changed, sender=MySubject.subject.through)
+def sync_subject_key_on_subjects_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the teacher's subject combination key in step with their subjects.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        refresh_subject_keys([instance.user_id])
+    elif pk_set:
+        # subject.mysubject_set.add/remove(...): pk_set holds MySubject ids
+        refresh_subject_keys(MySubject.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+
+
+@receiver(post_delete, sender=MySubject)
+def sync_subject_key_on_mysubject_delete(sender, instance, **kwargs):
+    refresh_subject_keys([instance.user_id])
+
+
+# CountyStats rollup, demand matrix and match pair maintenance. post_init
+# remembers the values the rollup depends on (read from __dict__ so deferred
+# fields are not loaded), and the save/delete handlers refresh only the
+# (county, level) rows, matrix cells and pairs that can change.
+
+@receiver(post_init, sender=PersonalProfile)
+def remember_profile_stats_key(sender, instance, **kwargs):
+    instance._stats_key = (instance.__dict__.get('current_county_id'), instance.__dict__.get('level_id'))
+    instance._match_school_id = instance.__dict__.get('school_id')
+
+
+@receiver(post_save, sender=PersonalProfile)
+def update_county_stats_on_profile_save(sender, instance, created, **kwargs):
+    old_county_id, old_level_id = instance._stats_key
+    old_school_id = instance._match_school_id
+    instance._stats_key = (instance.current_county_id, instance.level_id)
+    instance._match_school_id = instance.school_id
+    if created or instance._stats_key != (old_county_id, old_level_id):
+        refresh_county_stats(
+            user_county_ids(instance.user_id) | {old_county_id},
+            {old_level_id, instance.level_id},
+        )
+        refresh_teacher_matching([instance.user_id])
+    elif old_school_id != instance.school_id:
+        refresh_match_pairs([instance.user_id])
+
+
+@receiver(post_delete, sender=PersonalProfile)
+def update_county_stats_on_profile_delete(sender, instance, **kwargs):
+    refresh_county_stats(user_county_ids(instance.user_id) | {instance.current_county_id}, {instance.level_id})
+    refresh_teacher_matching([instance.user_id])
+
+
+def refresh_preference_stats(user_id, county_ids):
+    """Refresh the rollup and demand matrix for a preference change of one user."""
+    location = PersonalProfile.objects.filter(user_id=user_id).values_list('current_county_id', 'level_id').first()
+    if location:
+        current_county_id, level_id = location
+        refresh_county_stats(set(county_ids) | {current_county_id}, {level_id})
+        refresh_teacher_matching([user_id])
+
+
+@receiver(post_init, sender=SwapPreference)
+def remember_preference_stats_key(sender, instance, **kwargs):
+    instance._stats_desired_county_id = instance.__dict__.get('desired_county_id')
+
+
+@receiver(post_save, sender=SwapPreference)
+def update_county_stats_on_preference_save(sender, instance, created, **kwargs):
+    old_desired_county_id = instance._stats_desired_county_id
+    instance._stats_desired_county_id = instance.desired_county_id
+    if created or old_desired_county_id != instance.desired_county_id:
+        refresh_preference_stats(instance.user_id, {old_desired_county_id, instance.desired_county_id})
+
+
+@receiver(pre_delete, sender=SwapPreference)
+def remember_preference_counties(sender, instance, **kwargs):
+    instance._stats_county_ids = user_county_ids(instance.user_id)
+
+
+@receiver(post_delete, sender=SwapPreference)
+def update_county_stats_on_preference_delete(sender, instance, **kwargs):
+    refresh_preference_stats(instance.user_id, getattr(instance, '_stats_county_ids', set()))
+
+
+@receiver(m2m_changed, sender=SwapPreference.open_to_all.through)
+def update_county_stats_on_open_to_all_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # county.open_to_all.add(preference, ...): pk_set holds preference ids
+        if action in ('post_add', 'post_remove') and pk_set:
+            for user_id in SwapPreference.objects.filter(pk__in=pk_set).values_list('user_id', flat=True):
+                refresh_preference_stats(user_id, {instance.pk})
+        return
+
+    if action == 'pre_clear':
+        instance._stats_cleared_ids = set(instance.open_to_all.values_list('id', flat=True))
+    elif action == 'post_clear':
+        refresh_preference_stats(instance.user_id, getattr(instance, '_stats_cleared_ids', set()))
+    elif action in ('post_add', 'post_remove'):
+        refresh_preference_stats(instance.user_id, pk_set or set())
@@ -1,3 +1,379 @@
-from django.test import TestCase
+from datetime import timedelta
+from smtplib import SMTPServerDisconnected
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from home.models import Curriculum, Level, MySubject, Subject
+from users import mail_queue
+from users.models import AdminNotification, MyUser, PersonalProfile, QueuedEmail
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SubjectCombinationTests(TestCase):
+    def setUp(self):
+        curriculum = Curriculum.objects.create(name="CBC", description="Competency Based Curriculum")
+        self.level = Level.objects.create(name="Secondary", code="SEC", curriculum=curriculum)
+        self.math = Subject.objects.create(name="Mathematics", level=self.level)
+        self.chem = Subject.objects.create(name="Chemistry", level=self.level)
+        self.eng = Subject.objects.create(name="English", level=self.level)
+
+    def create_teacher(self, email, subjects):
+        user = MyUser.objects.create_user(email=email, password='password')
+        PersonalProfile.objects.get_or_create(user=user, defaults={'level': self.level, 'first_name': email.split('@')[0]})
+        MySubject.objects.create(user=user).subject.set(subjects)
+        return user
+
+    def test_subject_key_follows_subject_changes(self):
+        teacher = self.create_teacher('a@test.com', [self.math, self.chem])
+        expected = PersonalProfile.subject_key_for([self.math.id, self.chem.id])
+        self.assertEqual(PersonalProfile.objects.get(user=teacher).subject_key, expected)
+
+        teacher.mysubject_set.first().subject.remove(self.chem)
+        self.assertEqual(PersonalProfile.objects.get(user=teacher).subject_key, str(self.math.id))
+
+        teacher.mysubject_set.all().delete()
+        self.assertEqual(PersonalProfile.objects.get(user=teacher).subject_key, '')
+
+    def test_combinations_page_and_teacher_list(self):
+        self.create_teacher('a@test.com', [self.math, self.chem])
+        self.create_teacher('b@test.com', [self.chem, self.math])
+        self.create_teacher('c@test.com', [self.eng])
+        admin = MyUser.objects.create_user(email='admin@test.com', password='password', is_staff=True)
+        self.client.force_login(admin)
+
+        response = self.client.get('/users/admin/unique-subject-combinations/')
+        self.assertEqual(response.status_code, 200)
+        combinations = response.context['combinations']
+        self.assertEqual([(name, data['count']) for name, data in combinations],
+                         [("Chemistry / Mathematics", 2), ("English", 1)])
+
+        response = self.client.get('/users/admin/unique-subject-combinations/teachers/',
+                                   {'ids': combinations[0][1]['subject_ids']})
+        self.assertEqual([t['email'] for t in response.json()['teachers']], ['a@test.com', 'b@test.com'])
+
+    def test_sync_subject_keys_repairs_drift(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        teacher = self.create_teacher('a@test.com', [self.math])
+        PersonalProfile.objects.filter(user=teacher).update(subject_key='')
+
+        with self.assertRaises(CommandError):
+            call_command('sync_subject_keys', check=True, stdout=StringIO())
+        call_command('sync_subject_keys', stdout=StringIO())
+        self.assertEqual(PersonalProfile.objects.get(user=teacher).subject_key, str(self.math.id))
+
+    def test_combination_detail_uses_signature(self):
+        from home.models import Constituencies, Counties, FastSwap, Schools, SwapPreference, Wards
+        nairobi = Counties.objects.create(name="Nairobi")
+        mombasa = Counties.objects.create(name="Mombasa")
+        schools = {}
+        for county in (nairobi, mombasa):
+            ward = Wards.objects.create(name=county.name, constituency=Constituencies.objects.create(name=county.name, county=county))
+            schools[county.id] = Schools.objects.create(name=f"{county.name} High", gender="Mixed", level=self.level, boarding="Day", curriculum=self.level.curriculum, postal_code="00100", ward=ward)
+
+        for email, home, target in (('a@test.com', nairobi, mombasa), ('b@test.com', mombasa, nairobi)):
+            teacher = self.create_teacher(email, [self.math, self.chem])
+            profile = PersonalProfile.objects.get(user=teacher)
+            profile.school = schools[home.id]
+            profile.save()
+            SwapPreference.objects.create(user=teacher, desired_county=target)
+        # Superset portfolio must not be part of the cohort
+        self.create_teacher('c@test.com', [self.math, self.chem, self.eng])
+
+        fast_swap = FastSwap.objects.create(names="Fast", phone="0700000000", level=self.level)
+        fast_swap.subjects.set([self.chem, self.math])
+        self.assertEqual(FastSwap.objects.get(pk=fast_swap.pk).subject_key, PersonalProfile.subject_key_for([self.math.id, self.chem.id]))
+
+        admin = MyUser.objects.create_user(email='admin@test.com', password='password', is_staff=True)
+        self.client.force_login(admin)
+        response = self.client.get('/users/admin/unique-subject-combinations/detail/',
+                                   {'combination': 'Chemistry / Mathematics'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(t['user'].email for t in response.context['teachers']), ['a@test.com', 'b@test.com'])
+        self.assertEqual(len(response.context['mutual_matches']), 1)
+
+    def test_combination_detail_reads_triangle_snapshots(self):
+        from home.models import Constituencies, Counties, Schools, SwapPreference, Wards
+        from home.triangle_snapshots import refresh_triangle_snapshot
+        counties = [Counties.objects.create(name=name) for name in ("Nairobi", "Mombasa", "Kisumu", "Nakuru")]
+        schools = []
+        for county in counties:
+            ward = Wards.objects.create(name=county.name, constituency=Constituencies.objects.create(name=county.name, county=county))
+            schools.append(Schools.objects.create(name=f"{county.name} High", gender="Mixed", level=self.level, boarding="Day", curriculum=self.level.curriculum, postal_code="00100", ward=ward))
+
+        # Nairobi -> Mombasa -> Kisumu -> Nairobi, and a chain Nairobi -> Nakuru -> Mombasa
+        # that nobody in Mombasa can close
+        for email, home, target in (('a@test.com', 0, 1), ('b@test.com', 1, 2), ('c@test.com', 2, 0),
+                                    ('d@test.com', 3, 1), ('e@test.com', 0, 3)):
+            teacher = self.create_teacher(email, [self.math, self.chem])
+            profile = PersonalProfile.objects.get(user=teacher)
+            profile.school = schools[home]
+            profile.save()
+            SwapPreference.objects.create(user=teacher, desired_county=counties[target])
+        refresh_triangle_snapshot(self.level)
+
+        admin = MyUser.objects.create_user(email='admin@test.com', password='password', is_staff=True)
+        self.client.force_login(admin)
+        response = self.client.get('/users/admin/unique-subject-combinations/detail/',
+                                   {'combination': 'Chemistry / Mathematics'})
+        self.assertEqual(response.context['complete_triangles_count'], 1)
+        complete = [tri for tri in response.context['potential_triangles'] if tri['is_complete']][0]
+        self.assertEqual({complete[key]['user'].email for key in ('teacher_a', 'teacher_b', 'teacher_c')},
+                         {'a@test.com', 'b@test.com', 'c@test.com'})
+        incomplete = [(tri['teacher_a']['user'].email, tri['teacher_b']['user'].email)
+                      for tri in response.context['potential_triangles'] if not tri['is_complete']]
+        self.assertIn(('e@test.com', 'd@test.com'), incomplete)
+        self.assertEqual(response.context['mutual_matches'], [])
+
+
+class StaffTeacherFixtureMixin:
+    """Two primary schools (Nairobi, Mombasa), a logged-in staff user and a teacher factory."""
+
+    def setUp(self):
+        from home.models import Constituencies, Counties, Schools, Wards
+        curriculum = Curriculum.objects.create(name="CBC", description="Competency Based Curriculum")
+        self.level = Level.objects.create(name="Primary School", code="PRI", curriculum=curriculum)
+        self.nairobi = Counties.objects.create(name="Nairobi")
+        self.mombasa = Counties.objects.create(name="Mombasa")
+        self.schools = {}
+        for county in (self.nairobi, self.mombasa):
+            ward = Wards.objects.create(name=county.name, constituency=Constituencies.objects.create(name=county.name, county=county))
+            self.schools[county.id] = Schools.objects.create(name=f"{county.name} Pri", gender="Mixed", level=self.level, boarding="Day", curriculum=curriculum, postal_code="00100", ward=ward)
+        admin = MyUser.objects.create_user(email='admin@test.com', password='password', is_staff=True)
+        self.client.force_login(admin)
+
+    def create_teacher(self, email, county, desired_county=None):
+        from home.models import SwapPreference
+        user = MyUser.objects.create_user(email=email, password='password')
+        profile, _ = PersonalProfile.objects.get_or_create(user=user, defaults={'level': self.level})
+        profile.level = self.level
+        profile.school = self.schools[county.id]
+        profile.save()
+        SwapPreference.objects.create(user=user, desired_county=desired_county)
+        return user
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CountyStatsViewTests(StaffTeacherFixtureMixin, TestCase):
+    def test_locations_and_heatmap_read_rollup(self):
+        self.create_teacher('a@test.com', self.nairobi, desired_county=self.mombasa)
+        self.create_teacher('b@test.com', self.nairobi)
+        self.create_teacher('c@test.com', self.mombasa)
+
+        response = self.client.get('/users/admin/unique-locations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(name, data['count']) for name, data in response.context['locations']],
+                         [("Nairobi", 2), ("Mombasa", 1)])
+
+        response = self.client.get('/users/admin/unique-locations/teachers/',
+                                   {'county': self.nairobi.id, 'level': self.level.id})
+        self.assertEqual([t['email'] for t in response.json()['teachers']], ['a@test.com', 'b@test.com'])
+
+        response = self.client.get('/users/admin/unique-locations/detail/', {'county': 'Nairobi'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['county_stats'].teachers, 2)
+        self.assertEqual(response.context['location_analytics'], [{'name': 'Mombasa', 'count': 1}])
+
+        response = self.client.get('/users/admin/unique-locations/teachers/',
+                                   {'county': self.nairobi.id, 'level': self.level.id, 'to_county': self.mombasa.id})
+        teachers = response.json()['teachers']
+        self.assertEqual([(t['email'], t['desired_counties']) for t in teachers], [('a@test.com', ['Mombasa'])])
+
+        response = self.client.get('/users/admin/county-heatmap/', {'level': self.level.id})
+        self.assertEqual(response.status_code, 200)
+        rows = {row['county'].name: (row['teachers'], row['inbound'], row['outbound']) for row in response.context['rows']}
+        self.assertEqual(rows, {"Nairobi": (2, 0, 1), "Mombasa": (1, 1, 0)})
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    TRIANGLE_REFRESH_IN_PROCESS=False,
+)
+class SwapListingPageTests(StaffTeacherFixtureMixin, TestCase):
+    def test_page_reads_snapshot_and_refresh_request(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from home.models import Counties, Constituencies, Schools, TriangleSnapshot, Wards
+        kisumu = Counties.objects.create(name="Kisumu")
+        ward = Wards.objects.create(name="Kisumu", constituency=Constituencies.objects.create(name="Kisumu", county=kisumu))
+        self.schools[kisumu.id] = Schools.objects.create(name="Kisumu Pri", gender="Mixed", level=self.level, boarding="Day", curriculum=self.level.curriculum, postal_code="40100", ward=ward)
+        self.create_teacher('a@test.com', self.nairobi, desired_county=self.mombasa)
+        self.create_teacher('b@test.com', self.mombasa, desired_county=kisumu)
+        self.create_teacher('c@test.com', kisumu, desired_county=self.nairobi)
+
+        response = self.client.get('/users/admin/primary-triangle-swaps/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_triangles'], 0)
+
+        self.client.post('/users/admin/primary-triangle-swaps/', {'refresh': '1'})
+        self.assertTrue(TriangleSnapshot.objects.get(level=self.level).refresh_pending)
+        call_command('refresh_triangle_swaps', pending=True, stdout=StringIO())
+        self.assertFalse(TriangleSnapshot.objects.get(level=self.level).refresh_pending)
+
+        response = self.client.get('/users/admin/primary-triangle-swaps/')
+        self.assertEqual(response.context['total_triangles'], 1)
+        self.assertEqual([m['user'].email for m in response.context['triangle_swaps'][0]['members']],
+                         ['a@test.com', 'b@test.com', 'c@test.com'])
+
+        other = Counties.objects.create(name="Nakuru")
+        response = self.client.get('/users/admin/primary-triangle-swaps/', {'county': other.id})
+        self.assertEqual(response.context['total_triangles'], 0)
+
+    def test_primary_matched_swaps_page(self):
+        self.create_teacher('a@test.com', self.nairobi, desired_county=self.mombasa)
+        self.create_teacher('b@test.com', self.mombasa, desired_county=self.nairobi)
+        self.create_teacher('c@test.com', self.mombasa)
+
+        response = self.client.get('/users/admin/primary-matched-swaps/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_matches'], 1)
+        match = response.context['matched_pairs'][0]
+        self.assertEqual((match['teacher_a'].email, match['teacher_b'].email), ('a@test.com', 'b@test.com'))
+        self.assertEqual((match['current_county_a'], match['desired_county_a']), ('Nairobi', 'Mombasa'))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class MyUserAdminMatchTests(StaffTeacherFixtureMixin, TestCase):
+    def test_changelist_reads_match_pairs(self):
+        superuser = MyUser.objects.create_superuser(email='root@test.com', password='password')
+        self.client.force_login(superuser)
+        a = self.create_teacher('a@test.com', self.nairobi, desired_county=self.mombasa)
+        b = self.create_teacher('b@test.com', self.mombasa, desired_county=self.nairobi)
+        self.create_teacher('c@test.com', self.mombasa)
+
+        response = self.client.get('/admin/users/myuser/')
+        self.assertContains(response, f'?potential_swap_match={a.id}">1 potential match</a>')
+
+        response = self.client.get('/admin/users/myuser/', {'potential_swap_match': a.id})
+        self.assertEqual([user.id for user in response.context['cl'].result_list], [b.id])
+
+        response = self.client.get('/admin/autocomplete/', {
+            'app_label': 'home', 'model_name': 'matchpair', 'field_name': 'user', 'term': 'b@test',
+        })
+        self.assertEqual([result['id'] for result in response.json()['results']], [str(b.id)])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ExportViewTests(StaffTeacherFixtureMixin, TestCase):
+    def test_export_streams_csv(self):
+        self.create_teacher('a@test.com', self.nairobi, desired_county=self.mombasa)
+        response = self.client.get('/users/admin/export/teachers/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="teachers-', response['Content-Disposition'])
+        content = b''.join(response.streaming_content).decode()
+        self.assertTrue(content.startswith('user_id,email,'))
+        self.assertIn('a@test.com', content)
+
+        self.assertEqual(self.client.get('/users/admin/export/teachers/', {'format': 'xml'}).status_code, 404)
+        self.assertEqual(self.client.get('/users/admin/export/payments/').status_code, 404)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminUserListTests(StaffTeacherFixtureMixin, TestCase):
+    def page_queries(self, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_search_and_pagination(self):
+        teacher = self.create_teacher('jane@test.com', self.nairobi, desired_county=self.mombasa)
+        teacher.tsc_number = 'TSC123'
+        teacher.save()
+        profile = teacher.profile
+        profile.first_name = 'Jane'
+        profile.phone = '+254 712 345 678'
+        profile.save()
+        self.assertEqual(profile.phone_normalized, '254712345678')
+
+        for term in ('0712345678', 'TSC123', 'jan', 'JANE@'):
+            response = self.client.get('/users/admin/users/', {'q': term})
+            self.assertEqual([row['user'].email for row in response.context['users']], ['jane@test.com'], term)
+
+        for i in range(30):
+            MyUser.objects.create_user(email=f'user{i:02d}@test.com', password='password')
+        response = self.client.get('/users/admin/users/', {'sort': 'email', 'page': 2})
+        self.assertEqual(response.context['page_obj'].paginator.num_pages, 2)
+        self.assertEqual(len(response.context['users']), 32 - 25)
+        self.assertEqual(response.context['users'][-1]['user'].email, 'user29@test.com')
+
+    def test_page_cost_does_not_grow_with_users(self):
+        for i in range(3):
+            self.create_teacher(f'a{i}@test.com', self.nairobi, desired_county=self.mombasa)
+        before = [self.page_queries('/users/admin/users/'), self.page_queries('/admin-dashboard/users/')]
+        for i in range(6):
+            self.create_teacher(f'b{i}@test.com', self.mombasa, desired_county=self.nairobi)
+        after = [self.page_queries('/users/admin/users/'), self.page_queries('/admin-dashboard/users/')]
+        self.assertEqual(before, after)
+
+        response = self.client.get('/admin-dashboard/users/', {'status': 'matches'})
+        self.assertEqual(len(response.context['users']), 9)
+        self.assertEqual(response.context['users'][0]['potential_matches'], 3)
+
+
+class MailQueueTests(TestCase):
+    def test_signup_queues_instead_of_sending(self):
+        user = MyUser.objects.create_user(email='new@test.com', password='password')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(QueuedEmail.objects.get().to, 'new@test.com')
+        self.assertEqual(AdminNotification.objects.get().kind, 'New registration')
+
+        profile = PersonalProfile.objects.get_or_create(user=user)[0]
+        profile.phone, profile.location = '0712345678', 'Nairobi'
+        profile.save()
+        profile.save()
+        self.assertEqual(AdminNotification.objects.filter(kind='Profile completed').count(), 1)
+
+    def test_worker_sends_batches_over_one_connection(self):
+        for n in range(5):
+            mail_queue.queue_email(f'Hello {n}', 'Body', f'user{n}@test.com', html_body='<p>Body</p>')
+        with mock.patch.object(mail.get_connection().__class__, 'open', autospec=True) as opened:
+            result = mail_queue.send_queued_emails(batch_size=2)
+        self.assertEqual(result, (5, 0, 0))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>Body</p>', 'text/html')])
+        self.assertEqual(QueuedEmail.objects.filter(status='sent', attempts=1).count(), 5)
+        self.assertEqual(opened.call_count, 5)
+        self.assertEqual(mail_queue.send_queued_emails(), (0, 0, 0))
+
+    def test_failed_sends_are_retried_then_given_up(self):
+        email = mail_queue.queue_email('Hello', 'Body', 'user@test.com')
+        failing = mail.get_connection()
+        failing.send_messages = mock.Mock(side_effect=SMTPServerDisconnected('gone'))
+
+        self.assertEqual(mail_queue.send_queued_emails(connection=failing, max_attempts=2), (0, 1, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), ('pending', 1, 'gone'))
+        self.assertGreater(email.send_after, timezone.now())
+        # Not due again until the backoff has passed
+        self.assertEqual(mail_queue.send_queued_emails(connection=failing, max_attempts=2), (0, 0, 0))
+
+        QueuedEmail.objects.update(send_after=timezone.now())
+        self.assertEqual(mail_queue.send_queued_emails(connection=failing, max_attempts=2), (0, 0, 1))
+        self.assertEqual(QueuedEmail.objects.get().status, 'failed')
+
+    def test_admin_notifications_go_out_as_one_digest(self):
+        for n in range(3):
+            mail_queue.notify_admin('New registration', f'New user {n}', 'Details')
+        self.assertIsNone(mail_queue.queue_admin_digest())
+
+        AdminNotification.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        digest = mail_queue.queue_admin_digest()
+        self.assertEqual(digest.subject, 'TSC Swap digest: 3 event(s)')
+        self.assertIn('- New registration: 3', digest.body)
+        self.assertIn('New user 2', digest.body)
+        self.assertFalse(AdminNotification.objects.filter(digested_at__isnull=True).exists())
+        self.assertIsNone(mail_queue.queue_admin_digest(force=True))
+
+    def test_old_sent_emails_are_purged(self):
+        mail_queue.queue_email('Hello', 'Body', 'user@test.com')
+        mail_queue.send_queued_emails()
+        self.assertEqual(mail_queue.purge_sent(), 0)
+        QueuedEmail.objects.update(sent_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(mail_queue.purge_sent(), 1)
@@ -22,8 +22,12 @@ urlpatterns = [
     path('admin/users/<int:user_id>/delete/', views.admin_delete_user_view, name='admin_delete_user'),
     path('admin/unique-subject-combinations/', views.admin_unique_subject_combinations, name='admin_unique_subject_combinations'),
     path('admin/unique-subject-combinations/detail/', views.admin_subject_combination_detail, name='admin_subject_combination_detail'),
+    path('admin/unique-subject-combinations/teachers/', views.admin_subject_combination_teachers, name='admin_subject_combination_teachers'),
     path('admin/unique-locations/', views.admin_unique_locations, name='admin_unique_locations'),
     path('admin/unique-locations/detail/', views.admin_location_detail, name='admin_location_detail'),
+    path('admin/unique-locations/teachers/', views.admin_location_teachers, name='admin_location_teachers'),
+    path('admin/county-heatmap/', views.admin_county_heatmap, name='admin_county_heatmap'),
+    path('admin/export/<slug:dataset>/', views.admin_export, name='admin_export'),
     path('admin/unique-fast-swap-combinations/', views.admin_unique_fast_swap_combinations, name='admin_unique_fast_swap_combinations'),
     path('admin/unique-fast-swap-combinations/detail/', views.admin_fast_swap_combination_detail, name='admin_fast_swap_combination_detail'),
     
@@ -59,6 +63,8 @@ urlpatterns = [
     path('admin/high-school-matched-swaps/', 
          login_required(views.high_school_matched_swaps), 
          name='high_school_matched_swaps'),
+    path('admin/primary-triangle-swaps/', views.primary_triangle_swaps, name='primary_triangle_swaps'),
+    path('admin/secondary-triangle-swaps/', views.secondary_triangle_swaps, name='secondary_triangle_swaps'),
     path('api/levels/<int:level_id>/subjects/', 
          login_required(views.get_subjects_for_level), 
          name='get_subjects_for_level'),
@@ -11,7 +11,7 @@ from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import F, Q
 from django.http import JsonResponse, Http404
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
@@ -25,8 +25,9 @@ from django.http import HttpResponseForbidden
 from home.models import (
     Level, Subject, MySubject, Schools, SwapPreference, 
     Counties, Constituencies, Wards, Swaps, SwapRequests,
-    FastSwap, Bookmark
+    FastSwap, Bookmark, MatchPair, TriangleSwap
 )
+from payments.entitlements import entitlement_for
 from .models import MyUser, PersonalProfile
 
 def get_whatsapp_message(user, completion_data):
@@ -571,14 +572,14 @@ def dashboard(request):
         completion_percentage = 100.00
 
     # Get subscription status
-    subscription = getattr(user, 'my_subscription', None)
-    has_active_subscription = subscription.is_active if subscription else False
+    subscription = entitlement_for(request)
+    has_active_subscription = subscription.is_active
     subscription_status = {
-        'has_subscription': subscription is not None,
+        'has_subscription': subscription.has_subscription,
         'is_active': has_active_subscription,
-        'type': subscription.sub_type if subscription else 'None',
-        'expiry_date': subscription.expiry_date.strftime('%B %d, %Y') if subscription and subscription.expiry_date else 'N/A',
-        'days_remaining': subscription.days_remaining if subscription else 0,
+        'type': subscription.plan or 'None',
+        'expiry_date': subscription.expiry_date.strftime('%B %d, %Y') if subscription.expiry_date else 'N/A',
+        'days_remaining': subscription.days_remaining,
     }
     
     # Initialize potential matches
@@ -641,6 +642,7 @@ def dashboard(request):
             swappreference__isnull=False
         ).select_related(
             'profile__school__ward__constituency__county',
+            'profile__current_county',
             'swappreference__desired_county',
             'profile__school__level'
         ).prefetch_related(
@@ -986,22 +988,101 @@ def get_profile_completion_data(user, profile):
                            profile.level.name.lower() in ['secondary', 'high school']
     }
 
+# Sort options for the staff user lists: key -> (ordering, label)
+ADMIN_USER_SORTS = {
+    'newest': ('-date_joined', 'Newest first'),
+    'oldest': ('date_joined', 'Oldest first'),
+    'email': ('email', 'Email'),
+    'name': ('profile__first_name', 'First name'),
+    'last_login': ('-last_login', 'Last login'),
+}
+ADMIN_USERS_PER_PAGE = 25
+
+
+def search_users(queryset, term):
+    """
+    Narrow a user queryset to a staff search term with indexed lookups only:
+    an exact TSC number or normalized phone, or a prefix of the email, first
+    name or last name.
+    """
+    term = term.strip()
+    if not term:
+        return queryset
+    lookup = (
+        Q(email__istartswith=term)
+        | Q(tsc_number=term)
+        | Q(profile__first_name__istartswith=term)
+        | Q(profile__last_name__istartswith=term)
+    )
+    phone = PersonalProfile.normalize_phone(term)
+    if len(phone) >= 9:
+        lookup |= Q(profile__phone_normalized=phone)
+    return queryset.filter(lookup)
+
+
+def profile_completion_average(users):
+    """
+    Average of get_profile_completion_data()['percentage'] over a user
+    queryset, computed in one aggregate query. Each section is worth 20%.
+    """
+    from django.db.models import Count, Exists, OuterRef
+
+    secondary = Q(profile__level__name__iexact='secondary') | Q(profile__level__name__iexact='high school')
+    sections = [
+        Q(profile__phone__gt='', profile__first_name__gt=''),
+        Q(profile__school__isnull=False),
+        Q(profile__level__isnull=False),
+        Q(swappreference__desired_county__isnull=False),
+        Q(profile__level__isnull=False) & (~secondary | Exists(MySubject.objects.filter(user=OuterRef('pk')))),
+    ]
+    counts = users.aggregate(
+        total=Count('pk'),
+        **{f'section_{i}': Count('pk', filter=section) for i, section in enumerate(sections)}
+    )
+    total = counts.pop('total')
+    return 20 * sum(counts.values()) / total if total else 0
+
+
 @login_required
 def admin_users_view(request):
+    """
+    Paginated staff list of users. Expects optional 'q' (search), 'status'
+    (subscribed or inactive), 'sort' (a key of ADMIN_USER_SORTS) and 'page'.
+    Completion, WhatsApp links and subscriptions are worked out for the
+    visible page only.
+    """
     if not request.user.is_staff:
         return redirect('home:home')
     
+    from django.core.paginator import Paginator
+    from home.exports import DATASET_LABELS
+    from payments.models import MySubscription
+    import urllib.parse
+    from chat.whatsapp_integration import normalize_phone_number
+
     User = get_user_model()
-    users = User.objects.select_related('profile', 'swappreference').prefetch_related('mysubject_set').order_by('-date_joined')
-    
-    # Get all user profiles in one query
-    from users.models import PersonalProfile
-    user_profiles = {profile.user_id: profile for profile in PersonalProfile.objects.select_related('school', 'level')}
+    search = request.GET.get('q', '').strip()
+    status = request.GET.get('status', '')
+    sort = request.GET.get('sort', 'newest')
+    if sort not in ADMIN_USER_SORTS:
+        sort = 'newest'
+
+    users = search_users(User.objects.all(), search)
+    if status == 'subscribed':
+        users = users.filter(my_subscription__expiry_date__gt=timezone.now())
+    elif status == 'inactive':
+        users = users.filter(is_active=False)
+    users = users.order_by(ADMIN_USER_SORTS[sort][0], '-id')
+
+    paginator = Paginator(users, ADMIN_USERS_PER_PAGE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    page_users = page_obj.object_list.select_related(
+        'profile__level', 'profile__school', 'swappreference__desired_county', 'my_subscription',
+    ).prefetch_related('mysubject_set')
     
-    # Calculate profile completion for each user
     user_data = []
-    for user in users:
-        profile = user_profiles.get(user.id)
+    for user in page_users:
+        profile = getattr(user, 'profile', None)
         
         # Use our helper function to get completion data
         completion = get_profile_completion_data(user, profile)
@@ -1009,57 +1090,54 @@ def admin_users_view(request):
         # Generate WhatsApp message
         whatsapp_message = get_whatsapp_message(user, completion)
         # URL encode the message for WhatsApp
-        import urllib.parse
         encoded_message = urllib.parse.quote(whatsapp_message)
         
-        # Get phone number from profile if available
-        phone_number = profile.phone if profile and hasattr(profile, 'phone') and profile.phone else ''
         # Normalize phone number to use Kenya country code 254
-        if phone_number:
-            # Import normalize function
-            from chat.whatsapp_integration import normalize_phone_number
-            # Normalize: if starts with 0, replace with 254
-            normalized_phone = normalize_phone_number(phone_number)
-            # Store normalized phone for display
-            phone_number = normalized_phone
+        phone_number = normalize_phone_number(profile.phone) if profile and profile.phone else ''
         
-        # Get user's subscription status
-        has_active_subscription = hasattr(user, 'subscription') and user.subscription.is_active
+        subscription = getattr(user, 'my_subscription', None)
         
         user_data.append({
             'user': user,
             'profile': profile,
             'completion_percentage': completion['percentage'],
             'completion_data': completion,  # Include detailed completion data
-            'has_active_subscription': has_active_subscription,
+            'has_active_subscription': bool(subscription and subscription.is_active),
             'is_active': user.is_active,
             'is_staff': user.is_staff,
             'is_superuser': user.is_superuser,
             'date_joined': user.date_joined,
             'last_login': user.last_login,
-            'subscription': getattr(user, 'subscription', None),
+            'subscription': subscription,
             'phone_number': phone_number,  # Store normalized phone number
             'whatsapp_url': f'https://wa.me/{phone_number}?text={encoded_message}' if phone_number else None,
             'has_phone': bool(phone_number)
         })
     
-    # Calculate statistics
-    total_users = len(user_data)
-    active_users = sum(1 for u in user_data if u['is_active'])
-    staff_users = sum(1 for u in user_data if u['is_staff'])
-    active_subscriptions = sum(1 for u in user_data if u['has_active_subscription'])
-    avg_completion = sum(u['completion_percentage'] for u in user_data) / total_users if total_users > 0 else 0
+    # Statistics over all users, as aggregates
+    all_users = User.objects.all()
+    avg_completion = profile_completion_average(all_users)
     
+    query = request.GET.copy()
+    query.pop('page', None)
     context = {
         'users': user_data,
-        'total_users': total_users,
-        'active_users': active_users,
-        'staff_users': staff_users,
-        'active_subscriptions': active_subscriptions,
+        'page_obj': page_obj,
+        'query_string': query.urlencode(),
+        'search': search,
+        'status': status,
+        'sort': sort,
+        'sort_options': [(key, label) for key, (_, label) in ADMIN_USER_SORTS.items()],
+        'total_users': all_users.count(),
+        'matching_users': paginator.count,
+        'active_users': all_users.filter(is_active=True).count(),
+        'staff_users': all_users.filter(is_staff=True).count(),
+        'active_subscriptions': MySubscription.objects.filter(expiry_date__gt=timezone.now()).count(),
         'avg_completion': round(avg_completion, 1),  # Round to 1 decimal place
         'now': timezone.now(),
         'page_title': 'User Management',
-        'active_tab': 'users'
+        'active_tab': 'users',
+        'export_datasets': DATASET_LABELS,
     }
     
     return render(request, 'users/admin_users.html', context)
@@ -1276,427 +1354,206 @@ def manage_teacher_subjects(request, user_id):
         return redirect('users:admin_users')
 
 
+def matched_swaps_page(request, level, template, by_subjects):
+    """
+    Render the level's mutual swap pairs (see home.pair_matching), 25 per
+    page. Only the teachers and subjects on the current page are loaded.
+    """
+    from django.core.paginator import Paginator
+    from home.gazetteer import get_gazetteer
+    from home.pair_matching import mask_subject_ids, mutual_pairs
+
+    pairs, subject_ids = mutual_pairs(level, by_subjects)
+    page = Paginator(pairs, 25).get_page(request.GET.get('page'))
+
+    page_user_ids = {user_id for pair in page for user_id in pair[:2]}
+    users = MyUser.objects.filter(id__in=page_user_ids).select_related('profile__school').in_bulk()
+    page_subject_ids = {sid for pair in page for sid in mask_subject_ids(pair[4], subject_ids)}
+    subject_names = dict(Subject.objects.filter(id__in=page_subject_ids).values_list('id', 'name'))
+    gazetteer = get_gazetteer()
+
+    matched_pairs = []
+    for a_id, b_id, county_a_id, county_b_id, common_mask in page:
+        teacher_a, teacher_b = users[a_id], users[b_id]
+        county_a = gazetteer.county(county_a_id)
+        county_b = gazetteer.county(county_b_id)
+        matched_pairs.append({
+            'teacher_a': teacher_a,
+            'teacher_b': teacher_b,
+            'match_score': 100,  # Perfect match
+            'current_county_a': county_a.name if county_a else 'Unknown',
+            'desired_county_a': county_b.name if county_b else 'Unknown',
+            'current_county_b': county_b.name if county_b else 'Unknown',
+            'desired_county_b': county_a.name if county_a else 'Unknown',  # They're swapping
+            'teacher_a_school': teacher_a.profile.school.name if teacher_a.profile.school else '',
+            'teacher_b_school': teacher_b.profile.school.name if teacher_b.profile.school else '',
+            'common_subjects': sorted(
+                subject_names.get(sid, '') for sid in mask_subject_ids(common_mask, subject_ids)
+            ),
+        })
+
+    return render(request, template, {
+        'matched_pairs': matched_pairs,
+        'page_obj': page,
+        'total_matches': page.paginator.count,
+    })
+
 @login_required
 @staff_required(login_url='users:login')
 def primary_matched_swaps(request):
     """
     View to find perfect location swap matches between primary school teachers.
     Matches are based on:
-    - Teacher A's current county matches Teacher B's desired county
-    - Teacher B's current county matches Teacher A's desired county
+    - Teacher A's current county is one of Teacher B's wanted counties
+    - Teacher B's current county is one of Teacher A's wanted counties
+    (wanted = desired county or open_to_all)
     """
-    # Debug logging
-    print(f"[DEBUG] primary_matched_swaps - User: {request.user}, is_authenticated: {request.user.is_authenticated}, is_staff: {request.user.is_staff}")
-    
-    # Check if user is staff (double check)
-    if not request.user.is_staff:
-        print("[DEBUG] User is not staff, will redirect to login")
-        from django.contrib.auth.views import redirect_to_login
-        return redirect_to_login(request.get_full_path(), login_url='users:login')
-    
-    print("[DEBUG] User is staff, proceeding with view")
-        
-    # Get all active teachers with their profiles and swap preferences
-    print("[DEBUG] Fetching teachers with profiles, schools, and swap preferences")
-    teachers = MyUser.objects.filter(
-        is_active=True,
-        role='Teacher',
-        profile__isnull=False,
-        profile__school__isnull=False,
-        swappreference__isnull=False  # Only teachers with swap preferences
-    ).select_related(
-        'profile__school__ward__constituency__county',
-        'swappreference__desired_county',  # Direct county reference
-        'profile__school__level'
-    ).prefetch_related(
-        'swappreference__open_to_all'
-    )
-    
-    print(f"[DEBUG] Found {teachers.count()} teachers with profiles, schools, and swap preferences")
-    
-    # Debug: Print first few teachers' school levels
-    for i, t in enumerate(teachers[:3]):  # Print first 3 for debugging
-        if hasattr(t, 'profile') and hasattr(t.profile, 'school') and t.profile.school:
-            level = getattr(t.profile.school, 'level', None)
-            print(f"[DEBUG] Teacher {i+1} school level: {level}")
-        else:
-            print(f"[DEBUG] Teacher {i+1} missing profile or school")
-    
-    # Get the primary school level object
     try:
         primary_level = Level.objects.get(name__iexact='Primary School')
     except Level.DoesNotExist:
         messages.error(request, "Primary School level not found in the system. Please add it first.")
         return redirect('users:admin_users')
-    
-    # Filter for primary school teachers
-    primary_teachers = []
-    for t in teachers:
-        try:
-            if (hasattr(t, 'profile') and 
-                hasattr(t.profile, 'school') and 
-                t.profile.school and 
-                hasattr(t.profile.school, 'level') and 
-                t.profile.school.level and 
-                t.profile.school.level.id == primary_level.id):
-                primary_teachers.append(t)
-        except Exception as e:
-            print(f"[DEBUG] Error processing teacher {t.id}: {str(e)}")
-    
-    print(f"[DEBUG] Found {len(primary_teachers)} primary school teachers with swap preferences")
-    
-    if not primary_teachers:
-        msg = "No primary school teachers with swap preferences found."
-        print(f"[DEBUG] {msg}")
-        messages.warning(request, msg)
-        return render(request, 'users/primary_matched_swaps.html', {
-            'matched_pairs': [],
-            'total_matches': 0,
-            'error_message': msg
-        })
 
-    matched_pairs = []
-    processed_pairs = set()  # To avoid duplicate matches
+    return matched_swaps_page(request, primary_level, 'users/primary_matched_swaps.html', by_subjects=False)
 
-    # Convert to list to avoid multiple database queries
-    teachers_list = list(teachers)
+def triangle_swaps_page(request, level, title):
+    """
+    Render one level's precomputed triangle listing, paginated and optionally
+    filtered by county ('county' id) or subject combination ('subjects', the
+    comma separated subject ids).
+    A POST with 'refresh' asks for the snapshot to be recomputed.
+    """
+    from django.core.paginator import Paginator
+    from home.gazetteer import get_gazetteer
+    from home.models import TriangleSnapshot, TriangleSwap, subject_key_for
+    from home.triangle_snapshots import level_uses_subjects, request_triangle_refresh
+
+    if request.method == 'POST' and 'refresh' in request.POST:
+        request_triangle_refresh(level)
+        messages.success(request, "Triangle swaps are being recomputed. Reload the page in a moment.")
+        return redirect(request.get_full_path())
+
+    snapshot = TriangleSnapshot.objects.filter(level=level).first()
+    triangles = TriangleSwap.objects.filter(snapshot=snapshot).select_related(
+        'teacher_a__profile', 'teacher_b__profile', 'teacher_c__profile',
+        'county_a', 'county_b', 'county_c',
+    )
 
-    # Create a dictionary to store teachers by their current county
-    teachers_by_county = {}
-    for teacher in teachers_list:
-        if not hasattr(teacher, 'profile') or not teacher.profile.school:
-            continue
-            
-        county = teacher.profile.school.ward.constituency.county
-        if county:
-            teachers_by_county.setdefault(county.id, []).append(teacher)
+    county_id = request.GET.get('county', '')
+    if county_id.isdigit():
+        triangles = triangles.filter(Q(county_a_id=county_id) | Q(county_b_id=county_id) | Q(county_c_id=county_id))
 
-    # Find matches
-    for teacher in teachers_list:
-        if not hasattr(teacher, 'profile') or not teacher.profile.school:
-            continue
-            
-        current_county = teacher.profile.school.ward.constituency.county
-        swap_pref = getattr(teacher, 'swappreference', None)
-        
-        if not swap_pref or not swap_pref.desired_ward:
-            continue
-            
-        desired_county = swap_pref.desired_ward.constituency.county
-        
-        # Find teachers in the desired county who want to come to this teacher's current county
-        potential_matches = teachers_by_county.get(desired_county.id, []) if desired_county else []
-        
-        for match in potential_matches:
-            if match == teacher or match.id in processed_pairs:
-                continue
+    uses_subjects = level_uses_subjects(level)
+    subject_ids = request.GET.get('subjects', '')
+    if uses_subjects and subject_ids:
+        try:
+            triangles = triangles.filter(subject_key=subject_key_for(int(sid) for sid in subject_ids.split(',')))
+        except ValueError:
+            messages.error(request, "Invalid subject combination.")
+
+    page = Paginator(triangles, 25).get_page(request.GET.get('page'))
+
+    # Subject combinations present in the snapshot, for the filter and the cards
+    subject_names = {}
+    subject_options = []
+    if uses_subjects:
+        keys = sorted(set(
+            TriangleSwap.objects.filter(snapshot=snapshot).exclude(subject_key='')
+            .values_list('subject_key', flat=True).distinct()
+        ))
+        all_ids = {int(sid) for key in keys for sid in key.split(',')}
+        subject_names = dict(Subject.objects.filter(id__in=all_ids).values_list('id', 'name'))
+        subject_options = sorted(
+            (key, ' / '.join(sorted(subject_names.get(int(sid), sid) for sid in key.split(','))))
+            for key in keys
+        )
+
+    formatted_triangles = []
+    for row in page:
+        members = [
+            {'user': row.teacher_a, 'current_location': row.county_a.name, 'wants_location': row.county_b.name},
+            {'user': row.teacher_b, 'current_location': row.county_b.name, 'wants_location': row.county_c.name},
+            {'user': row.teacher_c, 'current_location': row.county_c.name, 'wants_location': row.county_a.name},
+        ]
+        formatted_triangles.append({
+            'teacher_a': members[0],
+            'teacher_b': members[1],
+            'teacher_c': members[2],
+            'members': members,
+            'common_subjects': [
+                subject_names.get(int(sid), sid) for sid in row.subject_key.split(',') if sid
+            ],
+            'subject_key': row.subject_key,
+        })
+
+    query = request.GET.copy()
+    query.pop('page', None)
+
+    return render(request, 'users/admin_triangle_swaps.html', {
+        'title': title,
+        'level': level,
+        'snapshot': snapshot,
+        'triangle_swaps': formatted_triangles,
+        'page_obj': page,
+        'total_triangles': page.paginator.count,
+        'counties': get_gazetteer().counties(),
+        'selected_county': county_id,
+        'uses_subjects': uses_subjects,
+        'subject_options': subject_options,
+        'selected_subjects': subject_ids,
+        'query_string': query.urlencode(),
+    })
 
 @login_required
 @staff_required(login_url='users:login')
 def primary_triangle_swaps(request):
     """
-    View to find triangle swaps for PRIMARY level teachers.
+    Triangle swaps for PRIMARY level teachers.
     Triangle swap: Three teachers exchange locations in a circular pattern.
     Only checks location matching (no subject requirement for primary).
+    Reads the precomputed snapshot (see home.triangle_snapshots).
     """
-    from home.triangle_swap_utils import find_triangle_swaps_primary, get_current_county
-    from home.models import Level
-    
-    # Get the primary school level object
     try:
         primary_level = Level.objects.get(name__iexact='Primary School')
     except Level.DoesNotExist:
         messages.error(request, "Primary School level not found in the system. Please add it first.")
         return redirect('users:admin_users')
-    
-    # Get all active primary school teachers with profiles, schools, and swap preferences
-    teachers = MyUser.objects.filter(
-        is_active=True,
-        role='Teacher',
-        profile__isnull=False,
-        profile__school__isnull=False,
-        profile__school__level=primary_level,
-        swappreference__isnull=False
-    ).select_related(
-        'profile__school__ward__constituency__county',
-        'swappreference__desired_county',
-        'profile__school__level'
-    ).prefetch_related(
-        'swappreference__open_to_all'
-    ).distinct()
-    
-    print(f"[DEBUG] Found {teachers.count()} primary teachers for triangle swap detection")
-    
-    # Find triangle swaps
-    triangle_swaps = find_triangle_swaps_primary(teachers)
-    
-    # Format triangle swaps for display
-    formatted_triangles = []
-    for teacher_a, teacher_b, teacher_c in triangle_swaps:
-        county_a = get_current_county(teacher_a)
-        county_b = get_current_county(teacher_b)
-        county_c = get_current_county(teacher_c)
-        
-        formatted_triangles.append({
-            'teacher_a': {
-                'user': teacher_a,
-                'current_location': county_a.name if county_a else 'Unknown',
-                'wants_location': county_b.name if county_b else 'Unknown',
-            },
-            'teacher_b': {
-                'user': teacher_b,
-                'current_location': county_b.name if county_b else 'Unknown',
-                'wants_location': county_c.name if county_c else 'Unknown',
-            },
-            'teacher_c': {
-                'user': teacher_c,
-                'current_location': county_c.name if county_c else 'Unknown',
-                'wants_location': county_a.name if county_a else 'Unknown',
-            },
-        })
-    
-    return render(request, 'users/primary_triangle_swaps.html', {
-        'triangle_swaps': formatted_triangles,
-        'total_triangles': len(formatted_triangles),
-    })
+
+    return triangle_swaps_page(request, primary_level, 'Primary Triangle Swaps')
 
 @login_required
 @staff_required(login_url='users:login')
 def secondary_triangle_swaps(request):
     """
-    View to find triangle swaps for SECONDARY level teachers.
+    Triangle swaps for SECONDARY level teachers.
     Triangle swap: Three teachers exchange locations in a circular pattern.
-    Requires BOTH location AND subject matching (all three must share at least one subject).
+    Requires BOTH location AND subject matching (same subject combination).
+    Reads the precomputed snapshot (see home.triangle_snapshots).
     """
-    from home.triangle_swap_utils import find_triangle_swaps_secondary, get_current_county, get_user_subjects
-    from home.models import Level
-    
-    # Get the secondary/high school level object
     try:
         secondary_level = Level.objects.get(name__iexact='Secondary/High School')
     except Level.DoesNotExist:
         messages.error(request, "Secondary/High School level not found in the system. Please add it first.")
         return redirect('users:admin_users')
-    
-    # Get all active secondary school teachers with profiles, schools, swap preferences, and subjects
-    teachers = MyUser.objects.filter(
-        is_active=True,
-        role='Teacher',
-        profile__isnull=False,
-        profile__school__isnull=False,
-        profile__school__level=secondary_level,
-        swappreference__isnull=False
-    ).select_related(
-        'profile__school__ward__constituency__county',
-        'swappreference__desired_county',
-        'profile__school__level'
-    ).prefetch_related(
-        'swappreference__open_to_all',
-        'mysubject_set__subject'
-    ).distinct()
-    
-    print(f"[DEBUG] Found {teachers.count()} secondary teachers for triangle swap detection")
-    
-    # Find triangle swaps
-    triangle_swaps = find_triangle_swaps_secondary(teachers)
-    
-    # Format triangle swaps for display
-    formatted_triangles = []
-    for teacher_a, teacher_b, teacher_c in triangle_swaps:
-        county_a = get_current_county(teacher_a)
-        county_b = get_current_county(teacher_b)
-        county_c = get_current_county(teacher_c)
-        
-        # Get common subjects for display
-        subjects_a = get_user_subjects(teacher_a)
-        subjects_b = get_user_subjects(teacher_b)
-        subjects_c = get_user_subjects(teacher_c)
-        common_subjects = subjects_a.intersection(subjects_b).intersection(subjects_c)
-        
-        formatted_triangles.append({
-            'teacher_a': {
-                'user': teacher_a,
-                'current_location': county_a.name if county_a else 'Unknown',
-                'wants_location': county_b.name if county_b else 'Unknown',
-            },
-            'teacher_b': {
-                'user': teacher_b,
-                'current_location': county_b.name if county_b else 'Unknown',
-                'wants_location': county_c.name if county_c else 'Unknown',
-            },
-            'teacher_c': {
-                'user': teacher_c,
-                'current_location': county_c.name if county_c else 'Unknown',
-                'wants_location': county_a.name if county_a else 'Unknown',
-            },
-            'common_subjects': common_subjects,
-        })
-    
-    return render(request, 'users/secondary_triangle_swaps.html', {
-        'triangle_swaps': formatted_triangles,
-        'total_triangles': len(formatted_triangles),
-    })
+
+    return triangle_swaps_page(request, secondary_level, 'Secondary Triangle Swaps')
 
 @staff_required(login_url='users:login')
 def high_school_matched_swaps(request):
     """
     View to find perfect location and subject swap matches between high school teachers.
     Matches are based on:
-    - Teacher A's current county matches Teacher B's desired county
-    - Teacher B's current county matches Teacher A's desired county
+    - Teacher A's current county is one of Teacher B's wanted counties
+    - Teacher B's current county is one of Teacher A's wanted counties
     - Both teachers teach at least one common subject
     """
-    print(f"[DEBUG] high_school_matched_swaps - User: {request.user}")
-    
-    # Get the high school level object
     try:
         high_school_level = Level.objects.get(name__iexact='Secondary/High School')
     except Level.DoesNotExist:
         messages.error(request, "Secondary/High School level not found in the system. Please add it first.")
         return redirect('users:admin_users')
 
-    # Get all active high school teachers with their profiles, schools, and subjects
-    teachers = MyUser.objects.filter(
-        is_active=True,
-        role='Teacher',
-        profile__isnull=False,
-        profile__school__isnull=False,
-        profile__school__level=high_school_level,
-        swappreference__isnull=False
-    ).select_related(
-        'profile__school__ward__constituency__county',
-        'swappreference__desired_county'  # Only need county-level preference
-    ).prefetch_related(
-        'swappreference__open_to_all',
-        'mysubject_set__subject'
-    ).distinct()
-
-    matched_pairs = []
-    processed_pairs = set()
-    teachers_list = list(teachers)
-    
-    print(f"[DEBUG] Found {len(teachers_list)} high school teachers with swap preferences")
-
-    # Create a dictionary to store teachers by their current county
-    teachers_by_county = {}
-    for teacher in teachers_list:
-        if not hasattr(teacher, 'profile') or not teacher.profile.school:
-            continue
-            
-        county = teacher.profile.school.ward.constituency.county
-        if county:
-            teachers_by_county.setdefault(county.id, []).append(teacher)
-
-    # Find matches
-    print(f"[DEBUG] Starting to find matches among {len(teachers_list)} teachers")
-    
-    for teacher in teachers_list:
-        if not hasattr(teacher, 'profile') or not teacher.profile.school:
-            print(f"[DEBUG] Skipping teacher {teacher.id} - missing profile or school")
-            continue
-            
-        current_county = teacher.profile.school.ward.constituency.county
-        if not current_county:
-            print(f"[DEBUG] Skipping teacher {teacher.id} - school has no county")
-            continue
-            
-        swap_pref = getattr(teacher, 'swappreference', None)
-        if not swap_pref:
-            print(f"[DEBUG] Skipping teacher {teacher.id} - no swap preferences")
-            continue
-        
-        # Get teacher's desired counties (from direct county preference and open_to_all)
-        desired_counties = set()
-        
-        # 1. Check direct county preference
-        if swap_pref.desired_county:
-            print(f"[DEBUG] Teacher {teacher.id} has direct county preference: {swap_pref.desired_county.name}")
-            desired_counties.add(swap_pref.desired_county.id)
-        
-        # 2. Add open_to_all counties if any
-        if hasattr(swap_pref, 'open_to_all'):
-            open_to_all = list(swap_pref.open_to_all.values_list('name', flat=True))
-            print(f"[DEBUG] Teacher {teacher.id} open to these counties: {open_to_all}")
-            desired_counties.update(swap_pref.open_to_all.values_list('id', flat=True))
-        
-        if not desired_counties:
-            print(f"[DEBUG] Skipping teacher {teacher.id} - no desired counties specified")
-            continue  # Skip if no desired counties specified
-        
-        # Find teachers in the desired county who want to come to this teacher's current county
-        for desired_county_id in desired_counties:
-            potential_matches = teachers_by_county.get(desired_county_id, [])
-            
-            for match in potential_matches:
-                if match == teacher or match.id in processed_pairs:
-                    continue
-                    
-                match_pref = getattr(match, 'swappreference', None)
-                if not match_pref or not match_pref.desired_county:
-                    continue
-                    
-                # Check if the match wants to come to this teacher's current county
-                match_wants_current_county = (
-                    # Direct county match
-                    (match_pref.desired_county and match_pref.desired_county == current_county) or
-                    # Or in open_to_all counties
-                    (hasattr(match_pref, 'open_to_all') and match_pref.open_to_all.filter(id=current_county.id).exists())
-                )
-                
-                if not match_wants_current_county:
-                    continue
-                    
-                # Get teacher's subjects
-                teacher_subjects = set()
-                for my_subject in teacher.mysubject_set.all():
-                    teacher_subjects.update(s.id for s in my_subject.subject.all())
-                
-                if not teacher_subjects:
-                    continue  # Skip teachers with no subjects
-                
-                # Get match's subjects
-                match_subjects = set()
-                for my_subject in match.mysubject_set.all():
-                    match_subjects.update(s.id for s in my_subject.subject.all())
-                
-                # Check for subject overlap
-                common_subjects = teacher_subjects.intersection(match_subjects)
-                if not common_subjects:
-                    continue  # Skip if no common subjects
-                
-                # Create a unique pair ID to avoid duplicates (smaller ID first)
-                pair_id = tuple(sorted([teacher.id, match.id]))
-                if pair_id in processed_pairs:
-                    continue
-                    
-                processed_pairs.add(pair_id)
-                
-                # Get common subject names
-                common_subject_names = Subject.objects.filter(
-                    id__in=common_subjects
-                ).values_list('name', flat=True)
-                
-                # Found a perfect match!
-                print(f"[DEBUG] Found match between {teacher.id} and {match.id}")
-                print(f"[DEBUG] Common subjects: {list(common_subject_names)}")
-                
-                matched_pairs.append({
-                    'teacher_a': teacher,
-                    'teacher_b': match,
-                    'match_score': 100,  # Perfect match
-                    'current_county_a': current_county.name,
-                    'desired_county_a': desired_county.name,
-                    'current_county_b': match.profile.school.ward.constituency.county.name if hasattr(match, 'profile') and hasattr(match.profile, 'school') else 'Unknown',
-                    'desired_county_b': current_county.name,  # They're swapping
-                    'teacher_a_school': teacher.profile.school.name,
-                    'teacher_b_school': match.profile.school.name,
-                    'common_subjects': list(common_subject_names)
-                })
-
-    return render(request, 'users/high_school_matched_swaps.html', {
-        'matched_pairs': matched_pairs,
-        'total_matches': len(matched_pairs)
-    })
+    return matched_swaps_page(request, high_school_level, 'users/high_school_matched_swaps.html', by_subjects=True)
 
 
 @login_required
@@ -1983,70 +1840,40 @@ def admin_unique_subject_combinations(request):
     """
     View for admin to see unique subject combinations among teachers.
     Groups teachers by their specific subject combinations based on their entire portfolio.
+
+    Each teacher's portfolio is stored as PersonalProfile.subject_key, so the
+    grouping is a single GROUP BY; teacher lists are loaded on demand from
+    admin_subject_combination_teachers.
     """
-    User = get_user_model()
-    # Fetch teachers and their subjects in one go
-    teachers = User.objects.filter(role='Teacher').prefetch_related(
-        'mysubject_set__subject'
-    ).select_related('profile', 'profile__level')
-    
-    combinations = {}
-    
-    for teacher in teachers:
-        # Collect ALL subjects across ALL MySubject records for this teacher
-        all_subjects = []
-        for ms in teacher.mysubject_set.all():
-            all_subjects.extend(list(ms.subject.all()))
-            
-        if not all_subjects:
-            continue
-            
-        # Get unique subjects (in case of overlap across records) and sort them
-        # Convert to set of IDs first to avoid duplicates, then get objects
-        unique_subject_ids = set(s.id for s in all_subjects)
-        final_subjects = Subject.objects.filter(id__in=unique_subject_ids).order_by('name')
-        
-        subject_names = [s.name for s in final_subjects]
-        subject_ids = [str(s.id) for s in final_subjects]
-        combination_key = " / ".join(subject_names)
-        combination_ids = ",".join(subject_ids)
-        
-        # Get teacher display name
-        profile = getattr(teacher, 'profile', None)
-        if profile and profile.get_full_name():
-            name = profile.get_full_name()
-        elif profile and profile.first_name:
-            name = f"{profile.first_name} {profile.last_name or ''}".strip()
-        else:
-            name = teacher.email
-            
-        level = profile.level.name if profile and profile.level else "N/A"
-        
-        if combination_key not in combinations:
-            combinations[combination_key] = {
-                'subjects': subject_names,
-                'subject_ids': combination_ids,
-                'teachers': [],
-                'count': 0
-            }
-            
-        combinations[combination_key]['teachers'].append({
-            'name': name,
-            'email': teacher.email,
-            'level': level,
-            'id': teacher.id
-        })
-        combinations[combination_key]['count'] += 1
-    
+    from django.db.models import Count
+
+    rows = PersonalProfile.objects.filter(
+        user__role='Teacher'
+    ).exclude(
+        subject_key=''
+    ).values('subject_key').annotate(
+        count=Count('id')
+    ).order_by()
+
+    # Name every subject that appears in any combination with one query
+    subject_ids = {int(sid) for row in rows for sid in row['subject_key'].split(',')}
+    subject_names = dict(Subject.objects.filter(id__in=subject_ids).values_list('id', 'name'))
+
+    combinations = []
+    for row in rows:
+        names = sorted(subject_names.get(int(sid), '?') for sid in row['subject_key'].split(','))
+        combinations.append((" / ".join(names), {
+            'subjects': names,
+            'subject_ids': row['subject_key'],
+            'count': row['count'],
+        }))
+
     # Sort combinations by count descending, then by name
-    sorted_combinations = sorted(
-        combinations.items(), 
-        key=lambda x: (-x[1]['count'], x[0])
-    )
+    combinations.sort(key=lambda x: (-x[1]['count'], x[0]))
     
     context = {
-        'combinations': sorted_combinations,
-        'total_teachers_with_subjects': sum(c['count'] for c in combinations.values()),
+        'combinations': combinations,
+        'total_teachers_with_subjects': sum(c['count'] for _, c in combinations),
         'total_unique_combinations': len(combinations),
         'page_title': 'Unique Subject Combinations',
         'active_tab': 'subject_combinations'
@@ -2054,65 +1881,188 @@ def admin_unique_subject_combinations(request):
     
     return render(request, 'users/admin_unique_subject_combinations.html', context)
 
+@login_required
+@staff_required(login_url='users:login')
+@require_GET
+def admin_subject_combination_teachers(request):
+    """
+    JSON page of teachers sharing one subject combination.
+    Expects the combination key as 'ids' (e.g. ?ids=3,7,12&page=2).
+    """
+    from django.core.paginator import Paginator
+
+    subject_key = request.GET.get('ids', '')
+    try:
+        subject_key = PersonalProfile.subject_key_for(int(sid) for sid in subject_key.split(','))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid combination'}, status=400)
+
+    profiles = PersonalProfile.objects.filter(
+        user__role='Teacher', subject_key=subject_key
+    ).select_related('user', 'level').order_by('user__email')
+
+    page = Paginator(profiles, 50).get_page(request.GET.get('page'))
+    teachers = []
+    for profile in page:
+        if profile.first_name:
+            name = f"{profile.first_name} {profile.last_name or ''}".strip()
+        else:
+            name = profile.user.email
+        teachers.append({
+            'id': profile.user_id,
+            'name': name,
+            'email': profile.user.email,
+            'level': profile.level.name if profile.level else "N/A",
+            'edit_url': reverse('users:manage_teacher_subjects', args=[profile.user_id]),
+        })
+
+    return JsonResponse({
+        'teachers': teachers,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'has_next': page.has_next(),
+    })
+
+def combination_signatures(request):
+    """
+    Resolve the combination in the request ('ids' or 'combination' names) to
+    ``(subject_names, subject_keys)``. Subject names are only unique per level,
+    so a name combination can map to more than one signature. Returns None
+    (after flashing an error) when the request does not name a combination.
+    """
+    from itertools import product
+
+    combination = request.GET.get('combination', '')
+    if combination:
+        subject_names = combination.split(' / ')
+        ids_by_name = {}
+        for name, subject_id in Subject.objects.filter(name__in=subject_names).values_list('name', 'id'):
+            ids_by_name.setdefault(name, []).append(subject_id)
+        candidates = [ids_by_name.get(name, []) for name in subject_names]
+        return subject_names, {PersonalProfile.subject_key_for(ids) for ids in product(*candidates)}
+
+    subject_ids_str = request.GET.get('ids', '')
+    if not subject_ids_str:
+        messages.error(request, "No combination specified.")
+        return None
+    try:
+        subject_ids = [int(sid) for sid in subject_ids_str.split(',')]
+    except ValueError:
+        messages.error(request, "Invalid parameters.")
+        return None
+
+    subject_names = list(Subject.objects.filter(id__in=subject_ids).order_by('name').values_list('name', flat=True))
+    return subject_names, {PersonalProfile.subject_key_for(subject_ids)}
+
+
+def find_cohort_swaps(items, combination_name):
+    """
+    Mutual swaps and triangle chains within one subject cohort.
+
+    ``items`` are dicts with 'user', 'county_name' and 'desired_counties'.
+    Mutual swaps are the cohort's MatchPair rows and complete triangles its
+    TriangleSwap rows (from the levels' triangle snapshots), so both follow
+    the same rules as the matched-swaps and triangle pages. Incomplete
+    chains (A -> B -> Z where nobody in Z wants A's county; 'teacher_c' is
+    None) have no precomputed structure: they are found from the cohort's
+    one-way links, checking Z against the counties each county's teachers
+    want instead of scanning the teachers.
+    """
+    by_id = {item['user'].id: item for item in items}
+    counties = Counties.objects.in_bulk()
+    counties_by_name = {county.name: county for county in counties.values()}
+
+    mutual_matches = []
+    pairs = MatchPair.objects.filter(
+        user_id__in=by_id, partner_id__in=by_id, user_id__lt=F('partner_id')
+    ).values_list('user_id', 'partner_id')
+    for user_id, partner_id in pairs:
+        mutual_matches.append({
+            'teacher_a': by_id[user_id],
+            'teacher_b': by_id[partner_id],
+            'is_complete': True,
+            'combination': combination_name
+        })
+
+    potential_triangles = []
+    triangles = TriangleSwap.objects.filter(
+        teacher_a_id__in=by_id, teacher_b_id__in=by_id, teacher_c_id__in=by_id
+    ).values_list('teacher_a_id', 'teacher_b_id', 'teacher_c_id', 'county_a_id', 'county_c_id')
+    for a, b, c, county_a_id, county_c_id in triangles:
+        potential_triangles.append({
+            'teacher_a': by_id[a],
+            'teacher_b': by_id[b],
+            'teacher_c': by_id[c],
+            'missing_from': counties.get(county_c_id),
+            'missing_to': counties.get(county_a_id),
+            'is_complete': True,
+            'combination': combination_name
+        })
+
+    # Incomplete chains
+    by_county = {}
+    wanted_from = {}  # county -> counties wanted by the cohort's teachers there
+    for item in items:
+        if item['county_name'] and item['desired_counties']:
+            by_county.setdefault(item['county_name'], []).append(item)
+            wanted_from.setdefault(item['county_name'], set()).update(item['desired_counties'])
+
+    for teacher_a in items:
+        county_a = teacher_a['county_name']
+        if not county_a or not teacher_a['desired_counties']:
+            continue
+        for wanted_county in teacher_a['desired_counties']:
+            for teacher_b in by_county.get(wanted_county, ()):
+                if teacher_b is teacher_a or county_a in teacher_b['desired_counties']:
+                    continue
+                for wanted_county_z in teacher_b['desired_counties']:
+                    if county_a in wanted_from.get(wanted_county_z, ()):
+                        continue
+                    potential_triangles.append({
+                        'teacher_a': teacher_a,
+                        'teacher_b': teacher_b,
+                        'teacher_c': None,
+                        'missing_from': counties_by_name.get(wanted_county_z),
+                        'missing_to': counties_by_name.get(county_a),
+                        'is_complete': False,
+                        'combination': combination_name
+                    })
+
+    return mutual_matches, potential_triangles
+
+
 @login_required
 @staff_required(login_url='users:login')
 def admin_subject_combination_detail(request):
     """
     Detailed view for a specific subject combination.
-    Expects combination name as a query parameter 'combination'.
-    Example: ?combination=English / Mathematics
+    Expects the combination key as 'ids' (?ids=3,7) or the combination name
+    as 'combination' (?combination=English / Mathematics).
     """
-    combination_key = request.GET.get('combination', '')
-    
-    # Fallback to IDs if combination is not provided
-    if not combination_key:
-        subject_ids_str = request.GET.get('ids', '')
-        if not subject_ids_str:
-            messages.error(request, "No combination specified.")
-            return redirect('users:admin_unique_subject_combinations')
-        
-        try:
-            subject_ids = [int(sid) for sid in subject_ids_str.split(',')]
-        except ValueError:
-            messages.error(request, "Invalid parameters.")
-            return redirect('users:admin_unique_subject_combinations')
-        
-        # Get names from IDs to determine the combination key
-        subjects = Subject.objects.filter(id__in=subject_ids).order_by('name')
-        subject_names = [s.name for s in subjects]
-    else:
-        subject_names = combination_key.split(' / ')
+    signatures = combination_signatures(request)
+    if signatures is None:
+        return redirect('users:admin_unique_subject_combinations')
+    subject_names, subject_keys = signatures
 
     combination_name = " / ".join(subject_names)
     
-    # Import Counties for triangle detection
-    from home.models import Counties
-    
-    # Strict Portfolio Matching: Find teachers whose TOTAL subject count is exactly len(subject_names)
-    # and who have all the specified subjects in their portfolio.
-    from django.db.models import Count
-    
-    teachers = MyUser.objects.filter(role='Teacher').annotate(
-        total_subjects=Count('mysubject__subject', distinct=True)
-    ).filter(
-        total_subjects=len(subject_names)
-    )
-    
-    # Ensure every subject in the combination is present in their portfolio
-    for name in subject_names:
-        teachers = teachers.filter(mysubject__subject__name=name)
-    
-    teachers = teachers.select_related(
+    # Strict Portfolio Matching: teachers whose whole portfolio has exactly
+    # this signature (PersonalProfile.subject_key is indexed)
+    teachers = MyUser.objects.filter(
+        role='Teacher',
+        profile__subject_key__in=subject_keys,
+    ).select_related(
         'profile', 
         'profile__school', 
         'profile__school__ward__constituency__county',
+        'profile__current_county',
         'profile__level',
         'swappreference',
         'swappreference__desired_county'
     ).prefetch_related(
         'mysubject_set__subject',
         'swappreference__open_to_all'
-    ).distinct()
+    )
     
     teacher_data = []
     for teacher in teachers:
@@ -2145,6 +2095,7 @@ def admin_subject_combination_detail(request):
             'school': profile.school if profile else None,
             'swap_pref': pref,
             'desired_counties': desired_counties,
+            'county_name': profile.current_county.name if profile and profile.current_county else None,
         })
     
     # Calculate location analytics (considering ALL desired counties)
@@ -2160,90 +2111,7 @@ def admin_subject_combination_detail(request):
         reverse=True
     )
 
-    
-    # Detect Mutual Swaps
-    mutual_matches = []
-    seen_mutual_keys = set()
-    
-    # Detect Triangle Swaps (Complete or Potential Chains of 2)
-    potential_triangles = []
-    
-    # Helper to get current county name
-    def get_county_name(t_item):
-        if t_item['school'] and t_item['school'].ward:
-            return t_item['school'].ward.constituency.county.name
-        return None
-
-    # First pass: Find mutual swaps
-    for i, teacher_a in enumerate(teacher_data):
-        county_a = get_county_name(teacher_a)
-        if not county_a or not teacher_a['desired_counties']:
-            continue
-
-        for j, teacher_b in enumerate(teacher_data):
-            if i >= j:  # Avoid duplicates
-                continue
-            
-            county_b = get_county_name(teacher_b)
-            if not county_b or not teacher_b['desired_counties']:
-                continue
-
-            # Check if mutual: A wants B's county AND B wants A's county
-            if county_b in teacher_a['desired_counties'] and county_a in teacher_b['desired_counties']:
-                key = tuple(sorted([teacher_a['user'].id, teacher_b['user'].id]))
-                if key not in seen_mutual_keys:
-                    seen_mutual_keys.add(key)
-                    mutual_matches.append({
-                        'teacher_a': teacher_a,
-                        'teacher_b': teacher_b,
-                        'is_complete': True,
-                        'combination': combination_name
-                    })
-
-    for i, teacher_a in enumerate(teacher_data):
-        county_a = get_county_name(teacher_a)
-        if not county_a or not teacher_a['desired_counties']:
-            continue
-
-        for j, teacher_b in enumerate(teacher_data):
-            if i == j: continue
-            
-            county_b = get_county_name(teacher_b)
-            if not county_b or not teacher_b['desired_counties']:
-                continue
-
-            # Case: Teacher A wants to go to Teacher B's location
-            if county_b in teacher_a['desired_counties']:
-                # To be a triangle (instead of mutual), B must NOT want to go to A
-                if county_a not in teacher_b['desired_counties']:
-                    # We have a chain: A -> B -> Z
-                    # We need someone in Z who wants to go to A (county_a)
-                    # Since B can want multiple Zs, we iterate through B's desired counties
-                    for wanted_county_z in teacher_b['desired_counties']:
-                        # Check if such a person (Teacher C) exists in our list
-                        third_person = None
-                        for k, teacher_c in enumerate(teacher_data):
-                            if k in [i, j]: continue
-                            county_c = get_county_name(teacher_c)
-                            
-                            if county_c == wanted_county_z and county_a in teacher_c['desired_counties']:
-                                third_person = teacher_c
-                                break
-                        
-                        
-                        # Convert county names to County objects for template compatibility
-                        missing_from_obj = Counties.objects.filter(name=wanted_county_z).first() if wanted_county_z else None
-                        missing_to_obj = Counties.objects.filter(name=county_a).first() if county_a else None
-                        
-                        potential_triangles.append({
-                            'teacher_a': teacher_a,
-                            'teacher_b': teacher_b,
-                            'teacher_c': third_person, # None if incomplete
-                            'missing_from': missing_from_obj,
-                            'missing_to': missing_to_obj,
-                            'is_complete': third_person is not None,
-                            'combination': combination_name
-                        })
+    mutual_matches, potential_triangles = find_cohort_swaps(teacher_data, combination_name)
 
     # Remove duplicate combinations (especially for complete triangles where A->B->C is same as B->C->A)
     unique_triangles = []
@@ -2275,7 +2143,7 @@ def admin_subject_combination_detail(request):
     filtered_teacher_data = []
     for item in teacher_data:
         score = 0
-        current = get_county_name(item)
+        current = item['county_name']
         
         match_found = False
         is_perfect = False
@@ -2391,41 +2259,19 @@ def admin_fast_swap_combination_detail(request):
     """
     from home.fast_swap_utils import find_triangle_matches_for_fast_swap
     
-    combination_key = request.GET.get('combination', '')
-    
-    if not combination_key:
-        subject_ids_str = request.GET.get('ids', '')
-        if not subject_ids_str:
-            messages.error(request, "No combination specified.")
-            return redirect('users:admin_unique_fast_swap_combinations')
-        
-        try:
-            subject_ids = [int(sid) for sid in subject_ids_str.split(',')]
-        except ValueError:
-            messages.error(request, "Invalid parameters.")
-            return redirect('users:admin_unique_fast_swap_combinations')
-        
-        subjects = Subject.objects.filter(id__in=subject_ids).order_by('name')
-        subject_names = [s.name for s in subjects]
-    else:
-        subject_names = combination_key.split(' / ')
+    signatures = combination_signatures(request)
+    if signatures is None:
+        return redirect('users:admin_unique_fast_swap_combinations')
+    subject_names, subject_keys = signatures
 
     combination_name = " / ".join(subject_names)
     
-    # Find FastSwaps with exactly these subjects
-    from django.db.models import Count
-    fast_swaps = FastSwap.objects.annotate(
-        total_subjects=Count('subjects')
-    ).filter(
-        total_subjects=len(subject_names)
-    )
-    
-    for name in subject_names:
-        fast_swaps = fast_swaps.filter(subjects__name=name)
-        
-    fast_swaps = fast_swaps.select_related(
+    # Find FastSwaps with exactly these subjects (FastSwap.subject_key is indexed)
+    fast_swaps = FastSwap.objects.filter(
+        subject_key__in=subject_keys
+    ).select_related(
         'level', 'current_county', 'current_constituency', 'current_ward', 'most_preferred'
-    ).prefetch_related('acceptable_county', 'subjects').distinct()
+    ).prefetch_related('acceptable_county', 'subjects')
     
     fs_data = []
     for fs in fast_swaps:
@@ -2529,10 +2375,11 @@ def admin_fast_swap_combination_detail(request):
 def admin_unique_locations(request):
     """
     View for admin to see unique locations (Counties) among primary level teachers.
-    Groups primary teachers by their current county.
+    Counts come from the CountyStats rollup; teacher lists are loaded per county
+    from admin_location_teachers.
     """
-    User = get_user_model()
-    
+    from home.models import CountyStats
+
     # Get the primary school level object
     try:
         primary_level = Level.objects.get(name__iexact='Primary School')
@@ -2540,75 +2387,189 @@ def admin_unique_locations(request):
         messages.error(request, "Primary School level not found in the system. Please add it first.")
         return redirect('users:admin_users')
 
-    # Fetch primary teachers and their school locations
-    teachers = User.objects.filter(
-        role='Teacher',
-        profile__level=primary_level
-    ).select_related(
-        'profile', 
-        'profile__school', 
-        'profile__school__ward__constituency__county'
-    )
-    
-    locations = {}
+    stats = CountyStats.objects.filter(
+        level=primary_level, teachers__gt=0
+    ).select_related('county').order_by('-teachers', 'county__name')
+
+    locations = [
+        (row.county.name, {'county_id': row.county_id, 'count': row.teachers})
+        for row in stats
+    ]
+
+    context = {
+        'locations': locations,
+        'level_id': primary_level.id,
+        'total_primary_teachers': sum(data['count'] for _, data in locations),
+        'total_unique_counties': len(locations),
+        'page_title': 'Unique Primary Teacher Locations',
+        'active_tab': 'unique_locations'
+    }
     
-    for teacher in teachers:
-        profile = getattr(teacher, 'profile', None)
-        county = None
-        if profile and profile.school and profile.school.ward:
-            county = profile.school.ward.constituency.county
-            
-        if not county:
-            continue
-            
-        county_name = county.name
-        county_id = county.id
-        
-        # Get teacher display name
-        if profile and profile.get_full_name():
-            name = profile.get_full_name()
-        elif profile and profile.first_name:
+    return render(request, 'users/admin_unique_locations.html', context)
+
+@login_required
+@staff_required(login_url='users:login')
+def admin_location_teachers(request):
+    """
+    JSON page of teachers of one level currently in a county.
+    Expects 'county' and 'level' ids and an optional desired 'to_county' id
+    (e.g. ?county=47&level=1&to_county=30&page=2).
+    """
+    from django.core.paginator import Paginator
+    from chat.whatsapp_integration import normalize_phone_number
+
+    try:
+        county_id = int(request.GET.get('county', ''))
+        level_id = int(request.GET.get('level', ''))
+        to_county_id = int(request.GET['to_county']) if request.GET.get('to_county') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid county or level'}, status=400)
+
+    profiles = PersonalProfile.objects.filter(
+        user__role='Teacher', level_id=level_id, current_county_id=county_id
+    )
+    if to_county_id is not None:
+        profiles = profiles.filter(
+            Q(user__swappreference__desired_county_id=to_county_id)
+            | Q(user__swappreference__open_to_all=to_county_id)
+        ).distinct()
+    profiles = profiles.select_related(
+        'user', 'school__ward__constituency', 'user__swappreference__desired_county'
+    ).prefetch_related('user__swappreference__open_to_all').order_by('user__email')
+
+    page = Paginator(profiles, 50).get_page(request.GET.get('page'))
+    teachers = []
+    for profile in page:
+        if profile.first_name:
             name = f"{profile.first_name} {profile.last_name or ''}".strip()
         else:
-            name = teacher.email
-            
-        if county_name not in locations:
-            locations[county_name] = {
-                'county_id': county_id,
-                'teachers': [],
-                'count': 0
-            }
-            
-        locations[county_name]['teachers'].append({
+            name = profile.user.email
+
+        # Desired county first, then the open_to_all counties
+        pref = getattr(profile.user, 'swappreference', None)
+        desired_counties = []
+        if pref:
+            if pref.desired_county:
+                desired_counties.append(pref.desired_county.name)
+            for oc in pref.open_to_all.all():
+                if oc.name not in desired_counties:
+                    desired_counties.append(oc.name)
+
+        school = profile.school
+        teachers.append({
+            'id': profile.user_id,
             'name': name,
-            'email': teacher.email,
-            'id': teacher.id
+            'email': profile.user.email,
+            'phone': profile.phone,
+            'whatsapp_url': f'https://wa.me/{normalize_phone_number(profile.phone)}' if profile.phone else None,
+            'school': school.name if school else None,
+            'school_location': (
+                f"{school.ward.name}, {school.ward.constituency.name}" if school and school.ward else None
+            ),
+            'has_preferences': pref is not None,
+            'desired_counties': desired_counties,
+            'profile_url': reverse('users:profile_view', args=[profile.user_id]),
         })
-        locations[county_name]['count'] += 1
-    
-    # Sort locations by count descending, then by name
-    sorted_locations = sorted(
-        locations.items(), 
-        key=lambda x: (-x[1]['count'], x[0])
-    )
-    
+
+    return JsonResponse({
+        'teachers': teachers,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'has_next': page.has_next(),
+    })
+
+@login_required
+@staff_required(login_url='users:login')
+def admin_county_heatmap(request):
+    """
+    Supply and demand per county for one level, read from the CountyStats
+    rollup: teachers in the county, teachers wanting to move in, and teachers
+    wanting to move out. Expects an optional 'level' id (defaults to the first level).
+    """
+    from home.models import Counties, CountyStats
+
+    levels = list(Level.objects.order_by('name'))
+    level = None
+    level_id = request.GET.get('level')
+    if level_id and level_id.isdigit():
+        level = next((lv for lv in levels if lv.id == int(level_id)), None)
+    if level is None and levels:
+        level = levels[0]
+
+    stats = {
+        row['county_id']: row
+        for row in CountyStats.objects.filter(level=level).values('county_id', 'teachers', 'inbound', 'outbound')
+    }
+
+    rows = []
+    for county in Counties.objects.order_by('name'):
+        row = stats.get(county.id, {'teachers': 0, 'inbound': 0, 'outbound': 0})
+        rows.append({
+            'county': county,
+            'teachers': row['teachers'],
+            'inbound': row['inbound'],
+            'outbound': row['outbound'],
+            'net': row['inbound'] - row['outbound'],
+        })
+
+    peak = max([max(r['inbound'], r['outbound']) for r in rows] + [1])
+    for row in rows:
+        # Cell background opacity, relative to the busiest county
+        row['inbound_shade'] = f"{0.8 * row['inbound'] / peak:.2f}"
+        row['outbound_shade'] = f"{0.8 * row['outbound'] / peak:.2f}"
+
+    sort = request.GET.get('sort', 'inbound')
+    if sort in ('teachers', 'inbound', 'outbound', 'net'):
+        rows.sort(key=lambda r: (-r[sort], r['county'].name))
+
     context = {
-        'locations': sorted_locations,
-        'total_primary_teachers': sum(l['count'] for l in locations.values()),
-        'total_unique_counties': len(locations),
-        'page_title': 'Unique Primary Teacher Locations',
+        'rows': rows,
+        'levels': levels,
+        'level': level,
+        'sort': sort,
+        'totals': {
+            key: sum(r[key] for r in rows) for key in ('teachers', 'inbound', 'outbound')
+        },
+        'page_title': 'County Demand Heatmap',
         'active_tab': 'unique_locations'
     }
-    
-    return render(request, 'users/admin_unique_locations.html', context)
+
+    return render(request, 'users/admin_county_heatmap.html', context)
+
+
+@login_required
+@staff_required(login_url='users:login')
+def admin_export(request, dataset):
+    """
+    Stream a dataset (teachers, swaps, fast-swaps, pairs or triangles) as a
+    CSV or JSON Lines download. Expects an optional 'format' (csv or jsonl).
+    """
+    from django.http import StreamingHttpResponse
+    from home.exports import DATASETS, FORMATS, stream_export
+
+    fmt = request.GET.get('format', 'csv')
+    if dataset not in DATASETS or fmt not in FORMATS:
+        return JsonResponse({'error': 'Unknown export'}, status=404)
+
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(stream_export(dataset, fmt), content_type=f'{content_type}; charset=utf-8')
+    filename = f"{dataset}-{timezone.localdate():%Y%m%d}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 @login_required
 @staff_required(login_url='users:login')
 def admin_location_detail(request):
     """
     Detailed view for a specific location (County).
-    Expects county name as a query parameter 'county'.
+    Expects county name as a query parameter 'county' and an optional
+    desired 'to_county' name. Totals come from the CountyStats rollup and
+    destination counts from the demand matrix; the teacher list is loaded a
+    page at a time from admin_location_teachers.
     """
+    from home.demand_matrix import get_demand_matrix
+    from home.models import Counties, CountyStats
+
     county_name = request.GET.get('county', '')
     
     if not county_name:
@@ -2622,80 +2583,34 @@ def admin_location_detail(request):
         messages.error(request, "Primary School level not found in the system.")
         return redirect('users:admin_unique_locations')
 
-    # Find primary teachers in this county
-    teachers = MyUser.objects.filter(
-        role='Teacher',
-        profile__level=primary_level,
-        profile__school__ward__constituency__county__name=county_name
-    ).select_related(
-        'profile', 
-        'profile__school', 
-        'profile__school__ward__constituency__county',
-        'swappreference',
-        'swappreference__desired_county'
-    ).prefetch_related(
-        'swappreference__open_to_all'
-    ).distinct()
-    
-    teacher_data = []
-    for teacher in teachers:
-        profile = getattr(teacher, 'profile', None)
-        phone = profile.phone if profile else None
-        
-        # Prepare WhatsApp URL
-        whatsapp_url = None
-        if phone:
-            from chat.whatsapp_integration import normalize_phone_number
-            normalized_phone = normalize_phone_number(phone)
-            whatsapp_url = f'https://wa.me/{normalized_phone}'
-        
-        # Extract ALL desired counties
-        pref = getattr(teacher, 'swappreference', None)
-        desired_counties = []
-        if pref:
-            if pref.desired_county:
-                desired_counties.append(pref.desired_county.name)
-            for oc in pref.open_to_all.all():
-                if oc.name not in desired_counties:
-                    desired_counties.append(oc.name)
-            
-        teacher_data.append({
-            'user': teacher,
-            'profile': profile,
-            'phone': phone,
-            'whatsapp_url': whatsapp_url,
-            'school': profile.school if profile else None,
-            'swap_pref': pref,
-            'desired_counties': desired_counties,
-        })
-    
-    # Calculate destination analytics
-    destination_counts = {}
-    for item in teacher_data:
-        for d_county in item['desired_counties']:
-            destination_counts[d_county] = destination_counts.get(d_county, 0) + 1
-            
+    all_counties = list(Counties.objects.all().order_by('name'))
+    county = next((c for c in all_counties if c.name == county_name), None)
+    if county is None:
+        messages.error(request, f"County '{county_name}' not found.")
+        return redirect('users:admin_unique_locations')
+
+    county_stats = CountyStats.objects.filter(level=primary_level, county=county).first()
+
+    # Teachers in this county wanting each destination: one demand matrix row
+    _, destination_ids, rows = get_demand_matrix().slice(primary_level.id, origin_ids=[county.id])
+    names = {c.id: c.name for c in all_counties}
     sorted_analytics = sorted(
-        [{'name': name, 'count': count} for name, count in destination_counts.items()],
-        key=lambda x: x['count'],
-        reverse=True
+        [
+            {'name': names[county_id], 'count': count}
+            for county_id, count in zip(destination_ids, rows[0] if rows else []) if count
+        ],
+        key=lambda x: (-x['count'], x['name'])
     )
-    
-    # Simplified search logic matching the county detail
-    search_to = request.GET.get('to_county', '')
-    from home.models import Counties
-    all_counties = Counties.objects.all().order_by('name')
 
-    if search_to:
-        filtered_data = []
-        for item in teacher_data:
-            if search_to in item['desired_counties']:
-                filtered_data.append(item)
-        teacher_data = filtered_data
+    search_to = request.GET.get('to_county', '')
+    to_county = next((c for c in all_counties if c.name == search_to), None)
 
     context = {
         'county_name': county_name,
-        'teachers': teacher_data,
+        'county': county,
+        'county_stats': county_stats,
+        'level_id': primary_level.id,
+        'to_county': to_county,
         'location_analytics': sorted_analytics,
         'counties': all_counties,
         'search_to': search_to,
@@ -1,114 +1,113 @@
+from collections import Counter
+
 from django.contrib.admin.views.decorators import staff_member_required
+from django.core.paginator import Paginator
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import user_passes_test
-from django.db.models import Q
-from home.models import MySubject, Subject, SwapPreference, Schools
+from django.db.models import Count, Q
+from home.models import MySubject, Subject, SwapPreference, Schools, TriangleSwap
 from home.matching import find_matches
 from .models import MyUser
 
+def triangle_counts(user_ids):
+    """``{user_id: triangles}`` for the given users, from the triangle snapshots."""
+    counts = Counter()
+    for field in ('teacher_a_id', 'teacher_b_id', 'teacher_c_id'):
+        rows = TriangleSwap.objects.filter(**{f'{field}__in': user_ids}).values(field).annotate(n=Count('id')).order_by()
+        for row in rows:
+            counts[row[field]] += row['n']
+    return counts
+
+
 @staff_member_required
 def user_management(request):
-    # Get all users with their related data
-    users = MyUser.objects.prefetch_related(
+    """
+    Paginated users with their mutual match and triangle counts. Expects
+    optional 'q' (search), 'status' ('matches' for users with any match),
+    'sort' and 'page'. Counts come from the PotentialMatchCount and
+    TriangleSwap tables for the visible page only.
+    """
+    from .views import ADMIN_USER_SORTS, ADMIN_USERS_PER_PAGE, search_users
+
+    search = request.GET.get('q', '').strip()
+    status = request.GET.get('status', 'all')
+    sort = request.GET.get('sort', 'newest')
+    if sort not in ADMIN_USER_SORTS:
+        sort = 'newest'
+
+    with_matches = Q(potential_match_count__count__gt=0)
+    for field in ('teacher_a_id', 'teacher_b_id', 'teacher_c_id'):
+        with_matches |= Q(id__in=TriangleSwap.objects.values(field))
+
+    users = search_users(MyUser.objects.all(), search)
+    if status == 'matches':
+        users = users.filter(with_matches)
+    users = users.order_by(ADMIN_USER_SORTS[sort][0], '-id')
+
+    paginator = Paginator(users, ADMIN_USERS_PER_PAGE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    page_users = list(page_obj.object_list.select_related(
         'profile__school__level',
         'profile__school__ward__constituency__county',
-        'swappreference',
-        'mysubject_set__subject'
-    ).order_by('-date_joined')
+        'potential_match_count',
+    ))
+    triangles = triangle_counts([user.id for user in page_users])
 
     # Prepare user data for the template
     user_data = []
-    for user in users:
+    for user in page_users:
+        profile = getattr(user, 'profile', None)
         # Build full name from profile if available
         full_name = 'No Name'
-        if hasattr(user, 'profile') and user.profile:
+        if profile:
             name_parts = []
-            if user.profile.first_name:
-                name_parts.append(user.profile.first_name)
-            if user.profile.surname:
-                name_parts.append(user.profile.surname)
-            if user.profile.last_name and not user.profile.surname:  # Only use last_name if surname isn't set
-                name_parts.append(user.profile.last_name)
+            if profile.first_name:
+                name_parts.append(profile.first_name)
+            if profile.surname:
+                name_parts.append(profile.surname)
+            if profile.last_name and not profile.surname:  # Only use last_name if surname isn't set
+                name_parts.append(profile.last_name)
             if name_parts:
                 full_name = ' '.join(name_parts)
-        
+
+        match_count = getattr(user, 'potential_match_count', None)
         user_dict = {
             'id': user.id,
             'email': user.email,
             'full_name': full_name,
             'is_active': user.is_active,
             'date_joined': user.date_joined,
-            'phone': user.profile.phone if hasattr(user, 'profile') and user.profile.phone else '-',
+            'phone': profile.phone if profile and profile.phone else '-',
             'school': None,
-            'triangle_swaps': 0,
-            'potential_matches': 0
+            'triangle_swaps': triangles.get(user.id, 0),
+            'potential_matches': match_count.count if match_count else 0,
         }
 
         # Add school info if available
-        if hasattr(user, 'profile') and hasattr(user.profile, 'school') and user.profile.school:
-            school = user.profile.school
+        if profile and profile.school:
+            school = profile.school
             user_dict['school'] = {
                 'name': school.name,
                 'ward': school.ward.name if school.ward else 'N/A',
                 'constituency': school.ward.constituency.name if school.ward and school.ward.constituency else 'N/A',
                 'county': school.ward.constituency.county.name if school.ward and school.ward.constituency and school.ward.constituency.county else 'N/A',
-                'level': school.level.name if hasattr(school, 'level') and school.level else 'N/A'
+                'level': school.level.name if school.level else 'N/A'
             }
 
-        # Calculate triangle swaps
-        try:
-            if hasattr(user, 'profile') and user.profile.school and hasattr(user.profile.school, 'level') and hasattr(user, 'swappreference'):
-                from home.triangle_swap_utils import find_triangle_swaps_primary, find_triangle_swaps_secondary
-                from home.models import Level
-                
-                user_level = user.profile.school.level
-                is_secondary = 'secondary' in user_level.name.lower() or 'high' in user_level.name.lower()
-                
-                # Get all teachers at the same level
-                teachers = MyUser.objects.filter(
-                    is_active=True,
-                    role='Teacher',
-                    profile__isnull=False,
-                    profile__school__isnull=False,
-                    profile__school__level=user_level,
-                    swappreference__isnull=False
-                ).select_related(
-                    'profile__school__ward__constituency__county',
-                    'swappreference__desired_county',
-                    'profile__school__level'
-                ).prefetch_related(
-                    'swappreference__open_to_all',
-                    'mysubject_set__subject'
-                ).distinct()
-                
-                # Find triangle swaps
-                if is_secondary:
-                    all_triangles = find_triangle_swaps_secondary(teachers)
-                else:
-                    all_triangles = find_triangle_swaps_primary(teachers)
-                
-                # Count triangles that include this user
-                triangle_count = sum(1 for triangle in all_triangles if user.id in [t.id for t in triangle])
-                user_dict['triangle_swaps'] = triangle_count
-        except Exception as e:
-            print(f"Error calculating triangle swaps for user {user.id}: {str(e)}")
-            user_dict['triangle_swaps'] = 0
-
-        # Calculate potential matches using the central logic
-        try:
-            # use find_matches to ensure consistency with dashboard and individual view
-            user_dict['potential_matches'] = find_matches(user).count()
-        except Exception as e:
-            print(f"Error calculating matches for user {user.id}: {str(e)}")
-            user_dict['potential_matches'] = 0
-
         user_data.append(user_dict)
 
+    query = request.GET.copy()
+    query.pop('page', None)
     context = {
         'title': 'User Management',
         'users': user_data,
-        'total_users': len(user_data),
-        'active_users': len([u for u in user_data if u['is_active']])
+        'page_obj': page_obj,
+        'query_string': query.urlencode(),
+        'search': search,
+        'status': status,
+        'total_users': MyUser.objects.count(),
+        'active_users': MyUser.objects.filter(is_active=True).count(),
+        'users_with_matches': MyUser.objects.filter(with_matches).count(),
     }
     
     return render(request, 'users/admin/user_management.html', context)